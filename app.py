@@ -1,28 +1,320 @@
 import os
+import copy
+import atexit
 import json
+import bisect
+import time
+import functools
+import itertools
+import math
 import hashlib
 import hmac
+import gzip
+import io
+import shutil
+import mimetypes
+import csv
+import queue
 import sqlite3
 import random
+import secrets
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from types import MappingProxyType
 from urllib.parse import unquote
 
+import click
+import numpy as np
+from markupsafe import Markup, escape
+
+try:
+    import brotli # optional: pages and assets are also served gzip-compressed without it
+except ImportError:
+    brotli = None
+try:
+    import msgpack # optional: the player API answers in JSON only without it
+except ImportError:
+    msgpack = None
+
 from flask import (
     Flask, request, jsonify, render_template,
-    session, redirect, url_for, g
+    session, redirect, url_for, g, send_from_directory
 )
 
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface, SessionInterface
+from itsdangerous import BadSignature
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
-app = Flask(__name__)
-app.secret_key = os.urandom(24) # A strong secret key for session management
+app = Flask(__name__) # secret key and session store: see Login Sessions
+
+# --- Instrumentation ---
+# Every request is counted and timed into a per-route latency histogram, served as Prometheus text
+# on /metrics. A sampled fraction of requests (METRICS_SAMPLE_RATE) is also broken down by stage
+# (auth, load, pulls, save, commit...), by SQLite query and by payload size, and carries that
+# breakdown in a Server-Timing header. Unsampled requests only pay for two perf_counter() calls
+# and a counter update, which keeps the overhead around 1% at the default 5% sampling.
+# Metrics are per process: with several workers, each one reports its own.
+METRICS_SAMPLE_RATE = float(os.environ.get('NOVAFLARE_METRICS_SAMPLE_RATE', 0.05))
+METRICS_TOKEN = os.environ.get('NOVAFLARE_METRICS_TOKEN') # bearer token for /metrics, otherwise admins only
+# Also let requests from 127.0.0.1/::1 in without the token. Only for a scraper on the same host with
+# no reverse proxy in front: behind a same-host proxy every internet request looks local.
+METRICS_ALLOW_LOOPBACK = os.environ.get('NOVAFLARE_METRICS_ALLOW_LOOPBACK') == '1'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0) # seconds
+
+class RequestTimer:
+    """Stage and query timings of one sampled request."""
+    __slots__ = ('stages', 'db_queries', 'db_seconds')
+
+    def __init__(self):
+        self.stages = {}
+        self.db_queries = 0
+        self.db_seconds = 0.0
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+_request_timer = ContextVar('request_timer', default=None) # RequestTimer while a sampled request runs
+_request_start = ContextVar('request_start', default=None)
+_metrics_rng = random.Random() # keeps sampling off the global RNG that pulls use
+
+class timed_stage:
+    """with timed_stage('pulls'): ... adds the block's time to the sampled request's stages."""
+    __slots__ = ('name', 'timer', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timer = _request_timer.get()
+        if self.timer is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timer is not None:
+            self.timer.add(self.name, time.perf_counter() - self.start)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        timer = _request_timer.get()
+        if timer is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            timer.db_queries += 1
+            timer.db_seconds += time.perf_counter() - start
+
+    def executemany(self, sql, seq_of_parameters):
+        timer = _request_timer.get()
+        if timer is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            timer.db_queries += 1
+            timer.db_seconds += time.perf_counter() - start
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Connection.execute runs its cursor in C, so it is timed here rather than by the cursor
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        timer = _request_timer.get()
+        if timer is None:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            timer.db_queries += 1
+            timer.db_seconds += time.perf_counter() - start
+
+    def executemany(self, sql, seq_of_parameters):
+        timer = _request_timer.get()
+        if timer is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            timer.db_queries += 1
+            timer.db_seconds += time.perf_counter() - start
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (route, status) -> count
+        self.latency = {}   # route -> [count per bucket..., count above the last bucket, total seconds]
+        self.payload = {}   # route -> [request bytes, response bytes], sampled requests only
+        self.sampled = {}   # route -> sampled requests
+        self.stages = {}    # (route, stage) -> seconds, sampled requests only
+        self.db = {}        # route -> [queries, seconds], sampled requests only
+
+    def observe(self, route, status, seconds, timer, request_bytes=0, response_bytes=0):
+        """Count a request. Sampled requests (timer set) also pass the payload sizes."""
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            latency = self.latency.get(route)
+            if latency is None:
+                latency = self.latency[route] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            latency[bucket] += 1
+            latency[-1] += seconds
+            if timer is not None:
+                self.sampled[route] = self.sampled.get(route, 0) + 1
+                payload = self.payload.setdefault(route, [0, 0])
+                payload[0] += request_bytes
+                payload[1] += response_bytes
+                for stage, stage_seconds in timer.stages.items():
+                    self.stages[(route, stage)] = self.stages.get((route, stage), 0.0) + stage_seconds
+                db = self.db.setdefault(route, [0, 0.0])
+                db[0] += timer.db_queries
+                db[1] += timer.db_seconds
+
+    def percentile(self, route, quantile):
+        """Latency quantile in seconds, interpolated within the histogram bucket it falls in."""
+        counts = self.latency[route][:-1]
+        rank = quantile * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+                upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1] * 2
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def summary(self):
+        """Per-route numbers for the admin dashboard."""
+        with self.lock:
+            routes = {}
+            for route, latency in self.latency.items():
+                count = sum(latency[:-1])
+                sampled = self.sampled.get(route, 0)
+                errors = sum(n for (r, status), n in self.requests.items() if r == route and status >= 500)
+                routes[route] = {
+                    'requests': count,
+                    'errors': errors,
+                    'mean_ms': latency[-1] / count * 1e3,
+                    'p50_ms': self.percentile(route, 0.50) * 1e3,
+                    'p95_ms': self.percentile(route, 0.95) * 1e3,
+                    'p99_ms': self.percentile(route, 0.99) * 1e3,
+                    'response_bytes': self.payload[route][1] / sampled if sampled else None,
+                    'sampled': sampled,
+                    'stages_ms': {stage: seconds / sampled * 1e3 for (r, stage), seconds in self.stages.items() if r == route},
+                    'db_queries': self.db[route][0] / sampled if sampled else None,
+                }
+            return routes
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        with self.lock:
+            family('novaflare_requests_total', 'counter', 'Requests by route and status.')
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append(f'novaflare_requests_total{{route="{route}",status="{status}"}} {count}')
+            family('novaflare_request_duration_seconds', 'histogram', 'Request latency by route.')
+            for route, latency in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), latency[:-1]):
+                    cumulative += count
+                    lines.append(f'novaflare_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {cumulative}')
+                lines.append(f'novaflare_request_duration_seconds_sum{{route="{route}"}} {latency[-1]:.6f}')
+                lines.append(f'novaflare_request_duration_seconds_count{{route="{route}"}} {cumulative}')
+            family('novaflare_request_bytes_total', 'counter', 'Request body bytes, sampled requests only.')
+            for route, (request_bytes, _) in sorted(self.payload.items()):
+                lines.append(f'novaflare_request_bytes_total{{route="{route}"}} {request_bytes}')
+            family('novaflare_response_bytes_total', 'counter', 'Response body bytes, sampled requests only.')
+            for route, (_, response_bytes) in sorted(self.payload.items()):
+                lines.append(f'novaflare_response_bytes_total{{route="{route}"}} {response_bytes}')
+            family('novaflare_sampled_requests_total', 'counter', 'Requests traced by stage and query.')
+            for route, count in sorted(self.sampled.items()):
+                lines.append(f'novaflare_sampled_requests_total{{route="{route}"}} {count}')
+            family('novaflare_stage_seconds_total', 'counter', 'Time per request stage, sampled requests only.')
+            for (route, stage), seconds in sorted(self.stages.items()):
+                lines.append(f'novaflare_stage_seconds_total{{route="{route}",stage="{stage}"}} {seconds:.6f}')
+            family('novaflare_db_queries_total', 'counter', 'SQLite statements, sampled requests only.')
+            for route, (queries, _) in sorted(self.db.items()):
+                lines.append(f'novaflare_db_queries_total{{route="{route}"}} {queries}')
+            family('novaflare_db_seconds_total', 'counter', 'Time in SQLite statements, sampled requests only.')
+            for route, (_, seconds) in sorted(self.db.items()):
+                lines.append(f'novaflare_db_seconds_total{{route="{route}"}} {seconds:.6f}')
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+@app.before_request
+def start_request_timer():
+    _request_start.set(time.perf_counter())
+    # Always set, so a thread's next request never inherits the previous one's timer
+    _request_timer.set(RequestTimer() if _metrics_rng.random() < METRICS_SAMPLE_RATE else None)
+
+@app.after_request
+def record_request_metrics(response):
+    start = _request_start.get()
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    req = request._get_current_object() # one proxy lookup instead of one per attribute
+    rule = req.url_rule
+    if rule is not None and rule.endpoint == 'static':
+        return response
+    timer = _request_timer.get()
+    route = rule.rule if rule is not None else 'unmatched'
+    if timer is None:
+        METRICS.observe(route, response.status_code, seconds, None)
+    else:
+        METRICS.observe(route, response.status_code, seconds, timer,
+                        int(req.environ.get('CONTENT_LENGTH') or 0), response.content_length or 0)
+        response.headers['Server-Timing'] = server_timing(seconds, timer)
+    return response
+
+def server_timing(seconds, timer):
+    """Server-Timing header value for a sampled request."""
+    timings = [f"total;dur={seconds * 1e3:.2f}"]
+    timings += [f"{stage};dur={stage_seconds * 1e3:.2f}" for stage, stage_seconds in timer.stages.items()]
+    timings.append(f'db;dur={timer.db_seconds * 1e3:.2f};desc="{timer.db_queries} queries"')
+    return ", ".join(timings)
+
+@app.route('/metrics')
+def metrics():
+    authorized = (session.get('role') == 'admin' or (METRICS_ALLOW_LOOPBACK and request.remote_addr in ('127.0.0.1', '::1'))
+                  or (METRICS_TOKEN and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')))
+    if not authorized:
+        return jsonify({'status': 'error', 'message': 'Access Denied.'}), 403
+    return METRICS.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 # --- Database Configuration ---
-DATABASE = 'novaflare.db'
+DATABASE = os.environ.get('NOVAFLARE_DATABASE', 'novaflare.db')
+# Connections are pooled per process and handed to one request at a time, so pragmas and
+# sqlite3's prepared statement cache survive between requests. WAL lets readers run alongside
+# the single writer; synchronous=NORMAL is safe with WAL (a power loss can drop the last few
+# commits, never corrupt the file).
+DB_POOL_SIZE = int(os.environ.get('NOVAFLARE_DB_POOL_SIZE', 16)) # idle connections kept, 0 disables pooling
+DB_BUSY_TIMEOUT = 5.0 # seconds to wait for the write lock before raising "database is locked"
+DB_CACHED_STATEMENTS = 256
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -32000, # KiB, i.e. ~32 MB of page cache per connection
+    'temp_store': 'MEMORY',
+}
 
 # --- Default User Data ---
 # IMPORTANT: If you change the structure here, you might need to re-initialize your database
-# or add migration logic if users already exist. For development, deleting novaflare.db is easiest.
+# or add a migration (see Schema Migrations) if users already exist. For development, deleting novaflare.db is easiest.
 DEFAULT_USER_DATA = {
     'star_night_crystals': 1000,
     'lumen_orbs': 5,
@@ -38,91 +330,628 @@ DEFAULT_USER_DATA = {
         "limited_weapon_1": {"4_star": 0, "5_star": 0},
         "limited_weapon_2": {"4_star": 0, "5_star": 0},
     },
-    'monthly_exchanges': {
-        'exchange_lumen': 0,
-        'exchange_halo': 0,
-        'exchange_snc_with_oj': 0 # New monthly limit for OJ exchange
-    }
+    # Monthly exchange limits are counted in the exchange_limits table, see Exchange Limits
+    'rng_seed': None, # set per player on creation, see Pull Streams
+    'rng_counter': 0,
 }
 
+def open_db_connection(check=True, path=None):
+    # Autocommit mode, transactions are explicit (see transaction()). check_same_thread is off
+    # because a pooled connection may serve consecutive requests on different threads.
+    # path is a shard file (see User Data Shards), default DATABASE.
+    db = sqlite3.connect(path or DATABASE, isolation_level=None, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                         cached_statements=DB_CACHED_STATEMENTS, factory=InstrumentedConnection)
+    db.row_factory = sqlite3.Row # This makes rows behave like dictionaries
+    for pragma, value in SQLITE_PRAGMAS.items():
+        db.execute(f"PRAGMA {pragma} = {value}")
+    if check and _schema_checked_pid != os.getpid():
+        main = db if path is None else open_db_connection(check=False)
+        try:
+            check_schema(main)
+        finally:
+            if main is not db:
+                main.close()
+    return db
+
+class ConnectionPool:
+    """LIFO pool of idle connections to DATABASE (or a shard file), one per process (rebuilt after a fork)."""
+
+    def __init__(self, size, path=None):
+        self.size = size
+        self.path = path
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return open_db_connection(path=self.path)
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback() # a request failed half way, don't hand its writes to the next one
+        if self.idle.qsize() < self.size:
+            self.idle.put(db)
+        else:
+            db.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+_db_pool = None
+_shard_pools = {} # shard -> ConnectionPool, for shards 1 and up (shard 0 is DATABASE)
+_db_pool_lock = threading.Lock()
+
+def get_db_pool(shard=0):
+    global _db_pool, _shard_pools
+    if _db_pool is None or _db_pool.pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool.pid != os.getpid():
+                # Connections inherited through fork() belong to the parent, never reuse them
+                _db_pool = ConnectionPool(DB_POOL_SIZE)
+                _shard_pools = {}
+    if shard == 0:
+        return _db_pool
+    pool = _shard_pools.get(shard)
+    if pool is None:
+        with _db_pool_lock:
+            pool = _shard_pools.get(shard)
+            if pool is None:
+                pool = _shard_pools[shard] = ConnectionPool(DB_POOL_SIZE, shard_path(shard))
+    return pool
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row # This makes rows behave like dictionaries
+        db = g._database = get_db_pool().acquire()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        get_db_pool().release(db)
+    for shard, db in g.pop('_shards', {}).items():
+        get_db_pool(shard).release(db)
 
-def init_db():
-    with app.app_context():
-        db = get_db()
-        cursor = db.cursor()
-        # Create users table for login
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL DEFAULT 'player'
-            )
-        ''')
-        # Create user_data table for game progress, including new currency fields
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_data (
-                user_id TEXT PRIMARY KEY,
-                star_night_crystals INTEGER DEFAULT 1000,
-                lumen_orbs INTEGER DEFAULT 5,
-                halo_orbs INTEGER DEFAULT 0,
-                auric_crescents INTEGER DEFAULT 0,
-                orbital_jewels INTEGER DEFAULT 0,
-                inventory TEXT DEFAULT '[]',
-                pity_counters TEXT DEFAULT '{}',
-                monthly_exchanges TEXT DEFAULT '{}'
+def add_column_if_missing(db_conn, table, column, definition):
+    columns = [row[1] for row in db_conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        db_conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# --- Schema Migrations ---
+# The schema is built by numbered migrations, applied in order and recorded in schema_migrations
+# so each runs once per database. Apply them once per deploy, before workers start:
+#   flask migrate-db
+# (`python app.py`, asgi.py's main() and gunicorn.conf.py do it for you). Importing this module does
+# no database work; the first connection a process opens only checks the schema version, and
+# migrates with a warning if it is behind, so a fresh checkout still runs without the extra step.
+# Add new migrations at the end and never change one that has shipped. Every statement is
+# idempotent, so databases created before schema_migrations existed upgrade in place.
+# Shard files (see User Data Shards) get the same migrations, except main_only ones.
+MIGRATIONS = [] # (version, description, fn(db_conn), main_only), in version order
+
+def migration(version, description, main_only=False):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn, main_only))
+        return fn
+    return register
+
+@migration(1, 'login users and player state')
+def _create_users(db_conn):
+    # Create users table for login
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'player'
+        )
+    ''')
+    # Create user_data table for game progress, including new currency fields
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id TEXT PRIMARY KEY,
+            star_night_crystals INTEGER DEFAULT 1000,
+            lumen_orbs INTEGER DEFAULT 5,
+            halo_orbs INTEGER DEFAULT 0,
+            auric_crescents INTEGER DEFAULT 0,
+            orbital_jewels INTEGER DEFAULT 0,
+            inventory TEXT DEFAULT '[]',
+            pity_counters TEXT DEFAULT '{}',
+            monthly_exchanges TEXT DEFAULT '{}',
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Databases created before state versioning
+    add_column_if_missing(db_conn, 'user_data', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+@migration(2, 'item catalog and inventory tables')
+def _create_inventory(db_conn):
+    # Item catalog, one row per distinct item name across all banners
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            rarity INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            is_limited INTEGER NOT NULL DEFAULT 0,
+            image TEXT
+        )
+    ''')
+    # Append-only inventory, one row per pulled item (replaces the user_data.inventory JSON blob)
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            item_id INTEGER NOT NULL REFERENCES items (id),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    add_column_if_missing(db_conn, 'inventory', 'version', 'INTEGER NOT NULL DEFAULT 0')
+    db_conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_user ON inventory (user_id, id)')
+    # user_data.version the item was added at, for "changes since version X" queries
+    db_conn.execute('CREATE INDEX IF NOT EXISTS idx_inventory_user_version ON inventory (user_id, version)')
+    # Copies owned per item, used for duplicate (Spectra) detection
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS inventory_counts (
+            user_id TEXT NOT NULL,
+            item_id INTEGER NOT NULL REFERENCES items (id),
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, item_id)
+        ) WITHOUT ROWID
+    ''')
+
+@migration(3, 'exchange limits table')
+def _create_exchange_limits(db_conn):
+    # Exchanges of limited shop items per period (replaces the user_data.monthly_exchanges JSON blob)
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS exchange_limits (
+            user_id TEXT NOT NULL,
+            item TEXT NOT NULL,
+            period TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, item, period)
+        ) WITHOUT ROWID
+    ''')
+    # Finds expired periods for purge_exchange_limits without a table scan
+    db_conn.execute('CREATE INDEX IF NOT EXISTS idx_exchange_limits_period ON exchange_limits (period)')
+
+@migration(4, 'event log')
+def _create_events(db_conn):
+    # Append-only log of every pull and exchange, see Event Log
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            source TEXT NOT NULL,
+            item_id INTEGER,
+            rarity INTEGER,
+            pity_4 INTEGER,
+            pity_5 INTEGER,
+            is_duplicate INTEGER,
+            star_night_crystals INTEGER NOT NULL DEFAULT 0,
+            lumen_orbs INTEGER NOT NULL DEFAULT 0,
+            halo_orbs INTEGER NOT NULL DEFAULT 0,
+            auric_crescents INTEGER NOT NULL DEFAULT 0,
+            orbital_jewels INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    db_conn.execute('CREATE INDEX IF NOT EXISTS idx_events_user ON events (user_id, id)')
+
+@migration(5, 'analytics rollup tables')
+def _create_rollups(db_conn):
+    # Dashboard counters kept up to date from the event log, see Analytics Rollups
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_hourly (
+            hour INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            source TEXT NOT NULL,
+            events INTEGER NOT NULL DEFAULT 0,
+            rarity_3 INTEGER NOT NULL DEFAULT 0,
+            rarity_4 INTEGER NOT NULL DEFAULT 0,
+            rarity_5 INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            star_night_crystals_spent INTEGER NOT NULL DEFAULT 0,
+            star_night_crystals_earned INTEGER NOT NULL DEFAULT 0,
+            lumen_orbs_spent INTEGER NOT NULL DEFAULT 0,
+            lumen_orbs_earned INTEGER NOT NULL DEFAULT 0,
+            halo_orbs_spent INTEGER NOT NULL DEFAULT 0,
+            halo_orbs_earned INTEGER NOT NULL DEFAULT 0,
+            auric_crescents_spent INTEGER NOT NULL DEFAULT 0,
+            auric_crescents_earned INTEGER NOT NULL DEFAULT 0,
+            orbital_jewels_spent INTEGER NOT NULL DEFAULT 0,
+            orbital_jewels_earned INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, kind, source)
+        ) WITHOUT ROWID
+    ''')
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_active (
+            scope TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (scope, bucket, user_id)
+        ) WITHOUT ROWID
+    ''')
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_active_counts (
+            scope TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            users INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, bucket)
+        ) WITHOUT ROWID
+    ''')
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            last_event_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+@migration(6, 'default admin and player accounts', main_only=True)
+def _create_default_users(db_conn):
+    # Admin: username='admin', password='adminpassword'
+    # Player: username='player', password='playerpassword'
+    for username, password, role in (('admin', 'adminpassword', 'admin'), ('player', 'playerpassword', 'player')):
+        if db_conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone() is None:
+            db_conn.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                            (username, generate_password_hash(password), role))
+            print(f"Default {role} user created: username='{username}', password='{password}'")
+
+@migration(7, 'bulk admin jobs')
+def _create_admin_jobs(db_conn):
+    # One row per bulk operation, see Bulk Admin Jobs; cursor is the last user_id it finished
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS admin_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            filters TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            cursor TEXT NOT NULL DEFAULT '',
+            scanned INTEGER NOT NULL DEFAULT 0,
+            affected INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            error TEXT,
+            created_by TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+
+@migration(8, 'pull streams and banner configs')
+def _create_pull_streams(db_conn):
+    # Per-player generator seed and draws used, see Pull Streams. Players without a seed get one on
+    # their next pull, so there is no backfill here
+    add_column_if_missing(db_conn, 'user_data', 'rng_seed', 'TEXT')
+    add_column_if_missing(db_conn, 'user_data', 'rng_counter', 'INTEGER NOT NULL DEFAULT 0')
+    # Stream position and banner config of each pull; NULL for pulls from before streams
+    add_column_if_missing(db_conn, 'events', 'rng_counter', 'INTEGER')
+    add_column_if_missing(db_conn, 'events', 'config_id', 'INTEGER')
+    # Every banner config pulls have been made with, as the tables that decide outcomes
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS banner_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            digest TEXT UNIQUE NOT NULL,
+            config TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+@migration(9, 'user data shards')
+def _create_shards(db_conn):
+    # Shard count, see User Data Shards; without a row DATABASE is the only shard
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS shard_layout (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            shards INTEGER NOT NULL,
+            resharding_to INTEGER
+        )
+    ''')
+    # A bulk job's progress through the players of one shard, kept in that shard's file so it
+    # commits with the chunk it records; cursor is the last user_id finished there
+    db_conn.execute('''
+        CREATE TABLE IF NOT EXISTS admin_job_progress (
+            job_id INTEGER PRIMARY KEY,
+            cursor TEXT NOT NULL DEFAULT '',
+            scanned INTEGER NOT NULL DEFAULT 0,
+            affected INTEGER NOT NULL DEFAULT 0,
+            active_since_id INTEGER,
+            done INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Unfinished jobs carry on from the cursor they had in admin_jobs
+    db_conn.execute('''
+        INSERT OR IGNORE INTO admin_job_progress (job_id, cursor, scanned, affected, active_since_id)
+        SELECT id, cursor, scanned, affected, json_extract(filters, '$.active_since_id') FROM admin_jobs WHERE status != 'done'
+    ''')
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+_schema_checked_pid = None # process that has seen DATABASE at SCHEMA_VERSION
+_schema_lock = threading.Lock()
+
+def schema_version(db_conn):
+    try:
+        return db_conn.execute("SELECT max(version) FROM schema_migrations").fetchone()[0] or 0
+    except sqlite3.OperationalError: # no schema_migrations table, nothing applied yet
+        return 0
+
+def migrate_db(db_conn, main=True):
+    """Apply the migrations db_conn's file doesn't have yet, all in one transaction. Returns their versions.
+    main=False for shard files: main_only migrations are recorded without running."""
+    with transaction(db_conn):
+        db_conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at INTEGER NOT NULL
             )
         ''')
-        db.commit()
+        # Read under the write lock, so two processes migrating at once apply each step once
+        applied = {row[0] for row in db_conn.execute("SELECT version FROM schema_migrations")}
+        versions = []
+        for version, description, fn, main_only in MIGRATIONS:
+            if version not in applied:
+                if main or not main_only:
+                    fn(db_conn)
+                db_conn.execute("INSERT INTO schema_migrations (version, description, applied_at) VALUES (?, ?, ?)",
+                                (version, description, int(time.time())))
+                versions.append(version)
+    return versions
 
-        # Add default admin and player users if they don't exist
-        # Admin: username='admin', password='adminpassword'
-        # Player: username='player', password='playerpassword'
-        
-        # Check if admin exists
-        cursor.execute("SELECT id FROM users WHERE username = 'admin'")
-        if cursor.fetchone() is None:
-            hashed_password = generate_password_hash('adminpassword')
-            cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                           ('admin', hashed_password, 'admin'))
-            print("Default admin user created: username='admin', password='adminpassword'")
-
-        # Check if player exists
-        cursor.execute("SELECT id FROM users WHERE username = 'player'")
-        if cursor.fetchone() is None:
-            hashed_password = generate_password_hash('playerpassword')
-            cursor.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                           ('player', hashed_password, 'player'))
-            print("Default player user created: username='player', password='playerpassword'")
-        
-        db.commit()
+def check_schema(db_conn):
+    """Once per process: migrate DATABASE if it is behind SCHEMA_VERSION (see Schema Migrations)."""
+    global _schema_checked_pid
+    with _schema_lock:
+        if _schema_checked_pid == os.getpid():
+            return
+        current = schema_version(db_conn)
+        if current < SCHEMA_VERSION:
+            print(f"Warning: {DATABASE} is at schema version {current} of {SCHEMA_VERSION}, migrating now. "
+                  "Run `flask migrate-db` before starting workers instead.")
+            migrate_db(db_conn)
+        load_shard_layout(db_conn)
+        _schema_checked_pid = os.getpid()
+
+def init_db():
+    """Bring DATABASE and its shards up to SCHEMA_VERSION. Returns the migrations applied to DATABASE."""
+    db_conn = open_db_connection(check=False)
+    try:
+        applied = migrate_db(db_conn)
+        load_shard_layout(db_conn)
+    finally:
+        db_conn.close()
+    global _schema_checked_pid
+    _schema_checked_pid = os.getpid()
+    return applied
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Create or upgrade the database schema. Run once per deploy, before starting workers."""
+    start = time.perf_counter()
+    applied = init_db()
+    if applied:
+        click.echo(f"Applied migrations {', '.join(map(str, applied))} in {time.perf_counter() - start:.2f}s; "
+                   f"{DATABASE} is at schema version {SCHEMA_VERSION}.")
+    else:
+        click.echo(f"{DATABASE} is up to date (schema version {SCHEMA_VERSION}).")
+    if SHARD_COUNT > 1:
+        click.echo(f"Player data is split over {SHARD_COUNT} shards: {', '.join(shard_path(shard) for shard in range(SHARD_COUNT))}")
+
+# --- User Data Shards ---
+# SQLite lets one writer at a time into a file, so with all players in DATABASE every pull queues
+# behind every other player's. The per-player tables (SHARDED_TABLES) can be split over several
+# files by hashed user_id instead; each has its own write lock, so players on different shards
+# commit in parallel. Shard 0 is DATABASE itself, which also keeps everything that isn't per player
+# (users, items, banner_configs, admin_jobs, the rollups); shard n is novaflare.shard<n>.db next to
+# it. A request only writes its player's shard, so every transaction still covers one file.
+# The shard count is recorded in DATABASE (shard_layout), not taken from the environment, so every
+# process routes a player to the same file. Change it with the server stopped:
+#   flask reshard --shards 4
+# Players are placed with a jump consistent hash: going from N to N+1 shards moves only 1/(N+1) of
+# them, all into the new file. Moved inventory and event rows get new ids in their new shard, so
+# event ids are only unique per shard; outside this module they are shard * SHARD_EVENT_ID_STRIDE
+# + the row id, which for shard 0 (and a single shard) is the row id itself.
+# Experimental: sharding only pays off when pulls are held up by the write lock, not by CPU, i.e.
+# several worker processes on several cores. That has not been shown yet: on a 1-CPU host
+# `bench.py shards` measured 2 shards at 0.73x the pulls/s of one. Keep a single shard unless that
+# bench reports a speedup on the production hardware.
+SHARDED_TABLES = ('user_data', 'inventory', 'inventory_counts', 'exchange_limits', 'events')
+SHARD_EVENT_ID_STRIDE = 1 << 48
+RESHARD_BATCH = 500 # players moved per transaction
+
+SHARD_COUNT = 1 # from shard_layout, see load_shard_layout
+_shard_connections = threading.local() # per thread: (pid, {path: connection}), see shard_connection
+
+def shard_path(shard):
+    """The file holding a shard."""
+    if shard == 0:
+        return DATABASE
+    root, extension = os.path.splitext(DATABASE)
+    return f"{root}.shard{shard}{extension}"
+
+def shard_of(user_id, shards=None):
+    """The shard a player lives on with `shards` shards (default: the current layout)."""
+    shards = shards or SHARD_COUNT
+    if shards == 1:
+        return 0
+    # Jump consistent hash (Lamping and Veach) of a stable 64-bit hash; hash() differs per process
+    key = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), 'big')
+    shard, candidate = -1, 0
+    while candidate < shards:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((shard + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return shard
+
+def load_shard_layout(db_conn):
+    """Read the shard count from DATABASE and bring the other shard files up to SCHEMA_VERSION."""
+    global SHARD_COUNT
+    row = db_conn.execute("SELECT shards, resharding_to FROM shard_layout WHERE id = 1").fetchone()
+    if row is not None and row['resharding_to'] is not None:
+        raise RuntimeError(f"{DATABASE} is being resharded, players may be in either layout. "
+                           f"Finish with `flask reshard --shards {row['resharding_to']}` before starting the server.")
+    SHARD_COUNT = row['shards'] if row else 1
+    for shard in range(1, SHARD_COUNT):
+        shard_conn = open_db_connection(check=False, path=shard_path(shard))
+        try:
+            if schema_version(shard_conn) < SCHEMA_VERSION:
+                migrate_db(shard_conn, main=False)
+        finally:
+            shard_conn.close()
+
+def shard_count():
+    """SHARD_COUNT, for code that may run before the process opened a connection (which loads it)."""
+    if _schema_checked_pid != os.getpid():
+        open_db_connection().close()
+    return SHARD_COUNT
+
+def get_shard_db(user_id):
+    """The request's pooled connection to the shard holding user_id (get_db()'s own for shard 0)."""
+    db = get_db() # a process's first connection also loads the layout
+    shard = shard_of(user_id)
+    if shard == 0:
+        return db
+    shards = g.setdefault('_shards', {})
+    if shard not in shards:
+        shards[shard] = get_db_pool(shard).acquire()
+    return shards[shard]
 
-# Call init_db once when the app starts
-with app.app_context():
-    init_db()
+def shard_connection(db_conn, shard):
+    """A connection to a shard for code that isn't serving one player's request (background threads,
+    admin tools): db_conn itself, a DATABASE connection, for shard 0, otherwise the calling thread's
+    own connection to the shard's file, opened on first use."""
+    if shard == 0:
+        return db_conn
+    if getattr(_shard_connections, 'pid', None) != os.getpid():
+        _shard_connections.pid, _shard_connections.conns = os.getpid(), {} # never reuse a parent's after fork()
+    path = shard_path(shard)
+    shard_conn = _shard_connections.conns.get(path)
+    if shard_conn is None:
+        shard_conn = _shard_connections.conns[path] = open_db_connection(path=path)
+    return shard_conn
+
+def _copy_players(source, target, user_ids):
+    """Copy players' rows from one shard file to another, in one transaction on the target. Players
+    already there are skipped: a reshard interrupted after this commit only has the source's copies
+    left to delete."""
+    with transaction(target):
+        present = {row[0] for row in target.execute(
+            "SELECT user_id FROM user_data WHERE user_id IN (SELECT value FROM json_each(?))", (json.dumps(user_ids),))}
+        players = json.dumps([user_id for user_id in user_ids if user_id not in present])
+        for table in SHARDED_TABLES:
+            # inventory and events rows get new ids there, in their old order
+            columns = [row[1] for row in source.execute(f"PRAGMA table_info({table})") if row[1] != 'id']
+            order = " ORDER BY id" if table in ('inventory', 'events') else ""
+            rows = source.execute(f"SELECT {', '.join(columns)} FROM {table} "
+                                  f"WHERE user_id IN (SELECT value FROM json_each(?)){order}", (players,))
+            target.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                               map(tuple, rows))
+
+def _move_players(conns, source, shards, batch_size):
+    # Move the players of one shard file that belong elsewhere with `shards` shards. Returns how many moved.
+    source_conn = conns[source]
+    moved, after = 0, ''
+    while True:
+        user_ids = [row[0] for row in source_conn.execute(
+            "SELECT user_id FROM user_data WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, batch_size))]
+        if not user_ids:
+            return moved
+        after = user_ids[-1]
+        targets = {}
+        for user_id in user_ids:
+            target = shard_of(user_id, shards)
+            if target != source:
+                targets.setdefault(target, []).append(user_id)
+        for target, players in sorted(targets.items()):
+            _copy_players(source_conn, conns[target], players)
+            with transaction(source_conn):
+                for table in SHARDED_TABLES:
+                    source_conn.execute(f"DELETE FROM {table} WHERE user_id IN (SELECT value FROM json_each(?))",
+                                        (json.dumps(players),))
+            moved += len(players)
+
+def reshard(shards, batch_size=RESHARD_BATCH):
+    """Move every player to their shard with `shards` shards. Returns the number of players moved.
+
+    Run it with the server stopped. Each batch is copied in one transaction and then deleted from
+    where it was, and the layout only changes at the end, so an interrupted run is finished by
+    running it again (processes refuse to start until then).
+    """
+    global SHARD_COUNT, _schema_checked_pid
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+    main = open_db_connection(check=False)
+    conns = [main]
+    try:
+        migrate_db(main)
+        row = main.execute("SELECT shards, resharding_to FROM shard_layout WHERE id = 1").fetchone()
+        resuming = row is not None and row['resharding_to'] is not None
+        if resuming and row['resharding_to'] != shards:
+            raise ValueError(f"an interrupted reshard to {row['resharding_to']} shards has to be finished first")
+        if main.execute("SELECT 1 FROM admin_jobs WHERE status IN ('pending', 'running')").fetchone():
+            raise ValueError("bulk admin jobs are running or pending, let them finish or cancel them first")
+        SHARD_COUNT = row['shards'] if row else 1
+        _schema_checked_pid = os.getpid() # every file is migrated right here
+        for shard in range(1, max(SHARD_COUNT, shards)):
+            conns.append(open_db_connection(check=False, path=shard_path(shard)))
+            migrate_db(conns[shard], main=False)
+        if not resuming:
+            # Fold every event into the rollups first: moved events get new ids, and are marked as
+            # counted below by moving each shard's rollup cursor to its newest event
+            catch_up_rollups(main)
+            with transaction(main):
+                main.execute("INSERT INTO shard_layout (id, shards, resharding_to) VALUES (1, ?, ?) "
+                             "ON CONFLICT (id) DO UPDATE SET resharding_to = excluded.resharding_to", (SHARD_COUNT, shards))
+        moved = sum(_move_players(conns, source, shards, batch_size) for source in range(len(conns)))
+        with transaction(main):
+            for shard in range(len(conns)):
+                newest = conns[shard].execute("SELECT max(id) FROM events").fetchone()[0] or 0
+                main.execute("DELETE FROM rollup_state WHERE name = ?", (rollup_state_name(shard),))
+                if shard < shards:
+                    main.execute("INSERT INTO rollup_state (name, last_event_id) VALUES (?, ?)", (rollup_state_name(shard), newest))
+            main.execute("UPDATE shard_layout SET shards = ?, resharding_to = NULL WHERE id = 1", (shards,))
+        SHARD_COUNT = shards
+        return moved
+    finally:
+        for conn in conns:
+            conn.close()
+
+@app.cli.command('reshard')
+@click.option('--shards', type=int, required=True, help='Shard files to spread players over, 1 puts everyone back in DATABASE.')
+@click.option('--batch-size', default=RESHARD_BATCH, show_default=True, help='Players moved per transaction.')
+def reshard_command(shards, batch_size):
+    """Move players between shard files (see User Data Shards). Stop the server first."""
+    start = time.perf_counter()
+    try:
+        moved = reshard(shards, batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Moved {moved} players in {time.perf_counter() - start:.1f}s; players are on {shards} shard(s): "
+               f"{', '.join(shard_path(shard) for shard in range(shards))}")
+    for shard in itertools.count(shards):
+        if not os.path.exists(shard_path(shard)):
+            break
+        click.echo(f"{shard_path(shard)} no longer holds players and can be deleted.")
 
 # --- Gacha Configuration and Item Pool ---
 # Define costs for shop and gacha pulls
 COST_MAP = {
-    # Gacha pull costs (per pull)
-    'standard_character': {'orb': 'lumen_orbs', 'snc': 70},
-    'standard_weapon': {'orb': 'lumen_orbs', 'snc': 70},
-    'limited_character_1': {'orb': 'halo_orbs', 'snc': 100},
-    'limited_character_2': {'orb': 'halo_orbs', 'snc': 100},
-    'limited_weapon_1': {'orb': 'halo_orbs', 'snc': 100},
-    'limited_weapon_2': {'orb': 'halo_orbs', 'snc': 100},
+    # Gacha pull costs (SNC per single pull, and the discounted SNC price of a 10-pull)
+    'standard_character': {'orb': 'lumen_orbs', 'snc': 70, 'snc_multi': 595},
+    'standard_weapon': {'orb': 'lumen_orbs', 'snc': 70, 'snc_multi': 595},
+    'limited_character_1': {'orb': 'halo_orbs', 'snc': 100, 'snc_multi': 900},
+    'limited_character_2': {'orb': 'halo_orbs', 'snc': 100, 'snc_multi': 900},
+    'limited_weapon_1': {'orb': 'halo_orbs', 'snc': 100, 'snc_multi': 900},
+    'limited_weapon_2': {'orb': 'halo_orbs', 'snc': 100, 'snc_multi': 900},
 
     # Shop exchange costs
     'buy_lumen_1': {'cost_type': 'star_night_crystals', 'cost_amount': 70, 'reward_type': 'lumen_orbs', 'reward_amount': 1},
@@ -211,51 +1040,614 @@ GACHA_POOL = {
     ],
 }
 
-def get_pull_result(banner_type, pity_4, pity_5):
-    pool = list(GACHA_POOL.get(banner_type, []))
-    if not pool:
-        return {"name": "Error", "rarity": 0, "type": "Error", "image": "error.png"}
+# --- Compiled Banner Tables ---
+# get_pull_result runs once per pull (10x per multi-pull), so everything that only depends on
+# the banner config is computed up front: per-rarity item tuples and the 5-star soft pity curve.
+# Whenever GACHA_POOL or GACHA_RATES change, COMPILED_BANNERS must be replaced by a new compile_banners().
+SOFT_PITY_STEP = 0.05 # 5-star rate increase per pull after pity_start
+
+CompiledBanner = namedtuple('CompiledBanner', [
+    'five_star',       # tuple of 5-star items
+    'four_star',       # tuple of 4-star items
+    'low',             # items for a roll above the 4/5-star thresholds (3-stars, or whole pool for characters)
+    'hard_pity_5',     # pity_5 value that forces a 5-star
+    'hard_pity_4',     # pity_4 value that forces a 4-star
+    'rate_5',          # rate_5[pity_5] -> 5-star threshold (base rate + soft pity)
+    'rate_4_5',        # rate_4_5[pity_5] -> combined 4+5-star threshold
+    'items',           # five_star + four_star + low, indexed by the batch pull engine
+    'tier_offsets',    # start of each tier (5-star, 4-star, low) inside items
+    'tier_sizes',      # number of items in each tier
+    'rates_array',     # numpy copies of rate_5 / rate_4_5 for vectorized resolution
+    'rates_4_5_array',
+    'item_rarities',   # numpy array of item rarities, aligned with items
+    'soft_pity_start', # first pity_5 value where base rates stop applying
+    'low_resets_4',    # every low-tier item is 4-star or better (character banners)
+])
 
+def compile_banner(banner_type, pool, rates):
     # Filter pool based on banner type to ensure correct rarities are pulled
     if "character" in banner_type:
-        valid_rarities = [4, 5]
+        valid_rarities = (4, 5)
     else: # Weapon banners
-        valid_rarities = [3, 4, 5]
-    
-    filtered_pool = [item for item in pool if item["rarity"] in valid_rarities]
+        valid_rarities = (3, 4, 5)
+    filtered_pool = tuple(item for item in pool if item["rarity"] in valid_rarities)
+
+    five = rates[5]
+    hard_pity_5 = five["hard_pity"]
+    rate_5 = []
+    for pity_5 in range(hard_pity_5):
+        rate = five["base_rate"]
+        if pity_5 >= five["pity_start"]:
+            rate += SOFT_PITY_STEP * (pity_5 - five["pity_start"] + 1)
+        rate_5.append(rate)
+    rate_4_5 = tuple(rate + rates[4]["base_rate"] for rate in rate_5)
+
+    if 3 in valid_rarities:
+        low = tuple(item for item in filtered_pool if item["rarity"] == 3)
+    else:
+        # Rates don't sum to 1.0 for character banners, anything above the 4-star threshold
+        # falls back to the whole (filtered) pool.
+        low = filtered_pool
+
+    five_star = tuple(item for item in filtered_pool if item["rarity"] == 5)
+    four_star = tuple(item for item in filtered_pool if item["rarity"] == 4)
+    items = five_star + four_star + low
+
+    return CompiledBanner(
+        five_star=five_star,
+        four_star=four_star,
+        low=low,
+        hard_pity_5=hard_pity_5,
+        hard_pity_4=rates[4]["hard_pity"],
+        rate_5=tuple(rate_5),
+        rate_4_5=rate_4_5,
+        items=items,
+        tier_offsets=_readonly_array([0, len(five_star), len(five_star) + len(four_star)]),
+        tier_sizes=_readonly_array([len(five_star), len(four_star), len(low)]),
+        rates_array=_readonly_array(rate_5),
+        rates_4_5_array=_readonly_array(rate_4_5),
+        item_rarities=_readonly_array([item["rarity"] for item in items]),
+        soft_pity_start=min(five["pity_start"], hard_pity_5 - 1),
+        low_resets_4=all(item["rarity"] >= 4 for item in low),
+    )
+
+def _readonly_array(values):
+    array = np.array(values)
+    array.flags.writeable = False
+    return array
+
+def compile_banners(gacha_pool, gacha_rates):
+    """Every banner of a config, compiled, as a read-only mapping. Assign it to COMPILED_BANNERS in
+    one go so concurrent pulls never see a half-built table."""
+    compiled = {}
+    for banner_type, pool in gacha_pool.items():
+        if pool:
+            compiled[banner_type] = compile_banner(banner_type, pool, gacha_rates[banner_type])
+    return MappingProxyType(compiled)
+
+COMPILED_BANNERS = compile_banners(GACHA_POOL, GACHA_RATES)
+
+def get_pull_result(banner_type, pity_4, pity_5):
+    # One pull from the global random module. Requests draw from the player's stream instead (see
+    # Pull Streams); this stays as the reference the tables and the batch engine are checked against
+    banner = COMPILED_BANNERS.get(banner_type)
+    if banner is None:
+        return {"name": "Error", "rarity": 0, "type": "Error", "image": "error.png"}
 
     # Check for hard pity first
-    if pity_5 >= GACHA_RATES[banner_type][5]["hard_pity"] - 1:
-        # Ensure we only pull 5-star items from the filtered pool
-        return random.choice([item for item in filtered_pool if item["rarity"] == 5])
-    
-    if pity_4 >= GACHA_RATES[banner_type][4]["hard_pity"] - 1:
-        # Ensure we only pull 4-star items from the filtered pool
-        return random.choice([item for item in filtered_pool if item["rarity"] == 4])
+    if pity_5 >= banner.hard_pity_5 - 1:
+        return random.choice(banner.five_star)
+    if pity_4 >= banner.hard_pity_4 - 1:
+        return random.choice(banner.four_star)
 
     roll = random.random()
+    if roll < banner.rate_5[pity_5]:
+        return random.choice(banner.five_star)
+    elif roll < banner.rate_4_5[pity_5]:
+        return random.choice(banner.four_star)
+    return random.choice(banner.low)
+
+
+# --- Batch Pull Engine ---
+# Resolves N pulls from bulk random draws instead of N get_pull_result calls. Every pull consumes
+# two uniforms: `rolls` picks the rarity tier exactly like get_pull_result's roll, `picks` chooses
+# the item inside the tier. Most pulls happen below soft pity and 4-star hard pity, where the
+# outcome only depends on the roll, so all of them are resolved at once with the base rates.
+# Pity is still sequential, so the resolver then walks the sequence from one reset to the next,
+# skipping whole stretches of base-rate pulls, and only re-resolves the pulls where a soft or
+# hard pity rule is actually in play.
+BatchPullResult = namedtuple('BatchPullResult', ['items', 'rarities', 'pity_4', 'pity_5'])
+
+def resolve_pulls(banner, pity_4, pity_5, rolls, picks):
+    """Vectorized get_pull_result. pity_4/pity_5 are post-increment pity arrays.
+    Returns (rarities, item indexes into banner.items)."""
+    hard_5 = pity_5 >= banner.hard_pity_5 - 1
+    hard_4 = ~hard_5 & (pity_4 >= banner.hard_pity_4 - 1)
+    curve_index = np.minimum(pity_5, banner.hard_pity_5 - 1)
+    rolled = ~hard_5 & ~hard_4
+
+    tier = np.full(rolls.shape, 2) # 0 = 5-star, 1 = 4-star, 2 = low
+    tier[rolled & (rolls < banner.rates_4_5_array[curve_index])] = 1
+    tier[rolled & (rolls < banner.rates_array[curve_index])] = 0
+    tier[hard_4] = 1
+    tier[hard_5] = 0
+
+    sizes = banner.tier_sizes[tier]
+    if not sizes.all():
+        raise IndexError('Cannot choose from an empty sequence') # same failure as random.choice
+    item_index = banner.tier_offsets[tier] + (picks * sizes).astype(np.intp)
+    return banner.item_rarities[item_index], item_index
+
+def _resolve_one(banner, pity_4, pity_5, roll, pick):
+    # Scalar resolve_pulls for a single pity-sensitive pull
+    if pity_5 >= banner.hard_pity_5 - 1:
+        tier = 0
+    elif pity_4 >= banner.hard_pity_4 - 1:
+        tier = 1
+    elif roll < banner.rate_5[pity_5]:
+        tier = 0
+    elif roll < banner.rate_4_5[pity_5]:
+        tier = 1
+    else:
+        tier = 2
+    size = int(banner.tier_sizes[tier])
+    if not size:
+        raise IndexError('Cannot choose from an empty sequence')
+    index = int(banner.tier_offsets[tier]) + int(pick * size)
+    return banner.items[index]['rarity'], index
+
+def _pity_after(rarities, pity_4, pity_5):
+    # Stored pity counters after a resolved sequence of pulls
+    resets_5 = np.flatnonzero(rarities == 5)
+    resets_4 = np.flatnonzero(rarities >= 4) # a 5-star resets 4-star pity too
+    n = rarities.size
+    pity_5 = n - 1 - int(resets_5[-1]) if resets_5.size else pity_5 + n
+    pity_4 = n - 1 - int(resets_4[-1]) if resets_4.size else pity_4 + n
+    return pity_4, pity_5
+
+def batch_pull(banner_type, num_pulls, pity_4=0, pity_5=0, rng=None, stop_at_rarity=None, draws=None):
+    """Pull num_pulls times on a banner in bulk, starting from the stored pity counters.
+
+    Same distribution as calling get_pull_result in pull_gacha's loop. With stop_at_rarity the
+    batch ends at the first pull of at least that rarity, e.g. stop_at_rarity=5 with
+    num_pulls=banner.hard_pity_5 is "pull until 5-star". draws is (rolls, picks) to use instead
+    of drawing from rng, e.g. pull_draws() of a player's stream. Returns a BatchPullResult with
+    the pulled items, a numpy array of their rarities and the final pity counters.
+    """
+    banner = COMPILED_BANNERS[banner_type]
+    if num_pulls <= 0:
+        return BatchPullResult([], np.empty(0, dtype=int), pity_4, pity_5)
+    if draws is not None:
+        rolls, picks = draws
+    else:
+        rng = rng if rng is not None else np.random.default_rng()
+        rolls = rng.random(num_pulls)
+        picks = rng.random(num_pulls)
+
+    # Outcome of every pull as if no pity rule applied
+    base_pity = np.ones(num_pulls, dtype=int)
+    rarities, item_index = resolve_pulls(banner, base_pity, base_pity, rolls, picks)
+
+    # Next pull (at or after each position) whose base outcome resets a pity counter. On banners
+    # where every pull is 4-star or better, 4-star pity can never build up and only 5-stars matter.
+    resets = rarities == 5 if banner.low_resets_4 else rarities >= 4
+    positions = np.where(resets, np.arange(num_pulls), num_pulls)
+    next_reset = np.minimum.accumulate(positions[::-1])[::-1].tolist()
+    base_rarities = rarities.tolist()
+
+    i = 0
+    p4, p5 = pity_4, pity_5
+    while i < num_pulls:
+        # How many upcoming pulls stay below soft pity and both hard pities
+        safe = banner.soft_pity_start - 1 - p5
+        if not banner.low_resets_4 or p4:
+            safe = min(safe, banner.hard_pity_4 - 2 - p4)
+        if safe > 0:
+            j = next_reset[i]
+            if j < i + safe and j < num_pulls:
+                # Base outcomes hold up to and including the next reset
+                steps = j - i + 1
+                rarity = base_rarities[j]
+                p5 = 0 if rarity == 5 else p5 + steps
+                p4 = 0 if rarity >= 4 or banner.low_resets_4 else p4 + steps
+                i = j + 1
+            else:
+                end = min(i + safe, num_pulls)
+                p5 += end - i
+                p4 = 0 if banner.low_resets_4 else p4 + end - i
+                i = end
+            continue
+
+        # A pity rule is in play for this pull, resolve it exactly
+        rarity, index = _resolve_one(banner, p4 + 1, p5 + 1, rolls[i], picks[i])
+        rarities[i] = rarity
+        item_index[i] = index
+        p5 = 0 if rarity == 5 else p5 + 1
+        p4 = 0 if rarity >= 4 else p4 + 1
+        i += 1
+
+    if stop_at_rarity is not None:
+        hits = np.flatnonzero(rarities >= stop_at_rarity)
+        if hits.size:
+            # Pulls before the cut don't depend on anything after it, so truncating is exact
+            end = int(hits[0]) + 1
+            rarities, item_index = rarities[:end], item_index[:end]
+            p4, p5 = _pity_after(rarities, pity_4, pity_5)
+
+    items = [banner.items[i] for i in item_index.tolist()]
+    return BatchPullResult(items, rarities, p4, p5)
+
+# --- Pull Streams ---
+# Pulls draw their two uniforms (roll and pick, see Batch Pull Engine) from the player's own
+# counter-based stream: draw n of a player is a pure function of their seed and n, with no state
+# in between. With the banner config a pull was made under (banner_configs) and the pity counters
+# the event log records, any pull can be recomputed from a few integers. verify_pulls does that
+# for whole histories, replay_pull for a single disputed pull.
+#
+# user_data.rng_seed is "<stream>:<hex key>", so new players can be moved to another generator
+# without breaking replays of old ones; rng_counter is how many draws the player has used.
+PULL_STREAM = os.environ.get('NOVAFLARE_PULL_STREAM', 'philox') # generator for new seeds
+PULL_SEED_BYTES = 16
+
+def _unit_floats(raw):
+    # uint64 words -> floats in [0, 1) from their top 53 bits, like numpy's Generator.random()
+    return (raw.astype(np.uint64) >> np.uint64(11)) * (1.0 / (1 << 53))
+
+def philox_draws(key, counter, n):
+    """Philox4x64-10 keyed with the seed: counter block counter+i gives draw i's roll (word 0) and pick (word 1)."""
+    raw = np.random.Philox(key=np.frombuffer(key, dtype='<u8'), counter=counter).random_raw(4 * n).reshape(n, 4)
+    return _unit_floats(raw[:, 0]), _unit_floats(raw[:, 1])
+
+def sha256_draws(key, counter, n):
+    """sha256(key + draw number as 8 big-endian bytes): the first two 8-byte words are the roll and
+    the pick. Much slower than philox, but anyone can recompute it with nothing but SHA-256."""
+    digests = b''.join(hashlib.sha256(key + (counter + i).to_bytes(8, 'big')).digest()[:16] for i in range(n))
+    raw = np.frombuffer(digests, dtype='>u8').reshape(n, 2)
+    return _unit_floats(raw[:, 0]), _unit_floats(raw[:, 1])
+
+PULL_STREAMS = {'philox': philox_draws, 'sha256': sha256_draws}
+if PULL_STREAM not in PULL_STREAMS:
+    raise ValueError(f'Unknown pull stream: {PULL_STREAM}')
+
+def new_pull_seed():
+    return f"{PULL_STREAM}:{secrets.token_hex(PULL_SEED_BYTES)}"
+
+def pull_draws(seed, counter, n):
+    """(rolls, picks) arrays for draws counter .. counter+n-1 of the stream a seed names."""
+    stream, _, key = seed.partition(':')
+    return PULL_STREAMS[stream](bytes.fromhex(key), counter, n)
+
+def banner_config(banners):
+    """What decides pull outcomes in a set of compiled banners, as JSON-ready data for banner_configs."""
+    return {
+        banner_type: {
+            'items': list(banner.items),
+            'tier_sizes': banner.tier_sizes.tolist(),
+            'hard_pity_4': banner.hard_pity_4,
+            'hard_pity_5': banner.hard_pity_5,
+            'rate_5': list(banner.rate_5),
+            'rate_4_5': list(banner.rate_4_5),
+        }
+        for banner_type, banner in banners.items()
+    }
+
+def banners_from_config(config):
+    """Compiled banners back from banner_config() data, for replaying pulls made under it."""
+    banners = {}
+    for banner_type, entry in config.items():
+        items = tuple(entry['items'])
+        five, four, low = entry['tier_sizes']
+        rate_5 = tuple(entry['rate_5'])
+        soft_start = next((pity for pity, rate in enumerate(rate_5) if rate != rate_5[0]), len(rate_5))
+        banners[banner_type] = CompiledBanner(
+            five_star=items[:five],
+            four_star=items[five:five + four],
+            low=items[five + four:],
+            hard_pity_5=entry['hard_pity_5'],
+            hard_pity_4=entry['hard_pity_4'],
+            rate_5=rate_5,
+            rate_4_5=tuple(entry['rate_4_5']),
+            items=items,
+            tier_offsets=_readonly_array([0, five, five + four]),
+            tier_sizes=_readonly_array([five, four, low]),
+            rates_array=_readonly_array(rate_5),
+            rates_4_5_array=_readonly_array(entry['rate_4_5']),
+            item_rarities=_readonly_array([item['rarity'] for item in items]),
+            soft_pity_start=min(soft_start, entry['hard_pity_5'] - 1),
+            low_resets_4=all(item['rarity'] >= 4 for item in items[five + four:]),
+        )
+    return banners
+
+_banner_config_id = (None, None) # (COMPILED_BANNERS, its banner_configs id)
+
+def current_banner_config(db_conn):
+    """(COMPILED_BANNERS, its banner_configs id), storing the config on first use. Call it outside
+    a transaction, like ensure_item_catalog: it may write, once per config and process."""
+    global _banner_config_id
+    banners = COMPILED_BANNERS
+    cached_for, config_id = _banner_config_id
+    if cached_for is banners:
+        return banners, config_id
+    config = json.dumps(banner_config(banners), sort_keys=True, separators=(',', ':'))
+    digest = hashlib.sha256(config.encode()).hexdigest()
+    row = db_conn.execute("SELECT id FROM banner_configs WHERE digest = ?", (digest,)).fetchone()
+    if row is None:
+        db_conn.execute("INSERT OR IGNORE INTO banner_configs (digest, config, created_at) VALUES (?, ?, ?)",
+                        (digest, config, int(time.time())))
+        row = db_conn.execute("SELECT id FROM banner_configs WHERE digest = ?", (digest,)).fetchone()
+    _banner_config_id = (banners, row[0])
+    return banners, row[0]
+
+# --- Pull Costs and Rewards ---
+# Shared by pull_gacha and the banner economy simulator so both always apply the same rules.
+
+# Orbital Jewels (OJ) and Auric Crescents (AC) awarded per pull, by rarity
+PULL_REWARDS = {
+    3: {'orbital_jewels': 25},
+    4: {'orbital_jewels': 50, 'auric_crescents': 10},
+    5: {'orbital_jewels': 100, 'auric_crescents': 20},
+}
+SPECTRA_AC_REWARD = 50
+
+def get_pull_cost(banner_type, num_pulls, cost_map=None):
+    """Returns (star_night_crystals, orbs) needed for num_pulls on a banner (priced by COST_MAP unless
+    another cost_map is given)."""
+    costs = (COST_MAP if cost_map is None else cost_map)[banner_type]
+    cost_snc_total = costs['snc'] * num_pulls
+    cost_orb_total = 1 * num_pulls # 1 orb per pull
+
+    # A 10-pull bought with SNC costs the banner's discounted snc_multi price
+    if num_pulls == 10:
+        cost_snc_total = costs['snc_multi']
+    return cost_snc_total, cost_orb_total
+
+def award_pull_rewards(user, item, is_duplicate):
+    """Add a pulled item's currency rewards to user. Returns them as {currency: amount}."""
+    rewards = dict(PULL_REWARDS.get(item['rarity'], {}))
+
+    # Spectra: a 4-star or 5-star character the player already owns awards extra Auric Crescents
+    if is_duplicate and item['type'] == 'Character' and item['rarity'] in (4, 5):
+        rewards['auric_crescents'] = rewards.get('auric_crescents', 0) + SPECTRA_AC_REWARD
 
-    # Calculate soft pity rate for 5-star
-    roll_rate_5 = GACHA_RATES[banner_type][5]["base_rate"]
-    if pity_5 >= GACHA_RATES[banner_type][5]["pity_start"]:
-        soft_pity_pulls = pity_5 - GACHA_RATES[banner_type][5]["pity_start"] + 1
-        roll_rate_5 += 0.05 * soft_pity_pulls # Increase rate by 5% per pull after soft pity start
+    for currency, amount in rewards.items():
+        user[currency] += amount
+    return rewards
 
-    # Determine rarity based on roll and available rarities
-    if roll < roll_rate_5 and 5 in valid_rarities:
-        return random.choice([item for item in filtered_pool if item["rarity"] == 5])
-    elif roll < (GACHA_RATES[banner_type][4]["base_rate"] + roll_rate_5) and 4 in valid_rarities:
-        return random.choice([item for item in filtered_pool if item["rarity"] == 4])
-    elif 3 in valid_rarities: # Only pull 3-star if it's a weapon banner
-        return random.choice([item for item in filtered_pool if item["rarity"] == 3])
-    else: # Fallback if somehow no valid rarity is found (shouldn't happen with correct pool setup)
-        # In a real system, rates should sum to 1.0 for all valid rarities.
-        return random.choice(filtered_pool)
+
+# --- Banner Economy Simulator ---
+# Replays pull_gacha's pull, pity, cost and reward rules for large populations of virtual players.
+# Players are simulated in lockstep (one resolve_pulls pass per pull across a whole shard) and
+# shards are spread over a process pool. Each shard draws from its own child of one SeedSequence,
+# so a given seed reproduces the same report no matter how many workers run it.
+SIMULATION_SHARD_SIZE = 50000
+SIMULATION_PERCENTILES = (10, 25, 50, 75, 90, 99)
+SIMULATION_MAX_PLAYERS_HTTP = 100000 # larger runs belong on the CLI
+SIMULATION_MAX_PULLS_HTTP = 1000 # per player
+
+def _item_reward_arrays(banner):
+    # Run every item through award_pull_rewards once so the simulator can't drift from it.
+    # Returns per-item OJ, AC, extra AC when the item is a duplicate, and a distinct-item key
+    # (the same item can sit in several tiers of banner.items).
+    orbital_jewels, auric_crescents, duplicate_bonus, keys = [], [], [], {}
+    for item in banner.items:
+        rewards = {'orbital_jewels': 0, 'auric_crescents': 0}
+        award_pull_rewards(rewards, item, is_duplicate=False)
+        duplicate = {'orbital_jewels': 0, 'auric_crescents': 0}
+        award_pull_rewards(duplicate, item, is_duplicate=True)
+        orbital_jewels.append(rewards['orbital_jewels'])
+        auric_crescents.append(rewards['auric_crescents'])
+        duplicate_bonus.append(duplicate['auric_crescents'] - rewards['auric_crescents'])
+        keys.setdefault(item['name'], len(keys))
+    item_keys = np.array([keys[item['name']] for item in banner.items])
+    return np.array(orbital_jewels), np.array(auric_crescents), np.array(duplicate_bonus), item_keys
+
+def _value_counts(values):
+    unique, counts = np.unique(values, return_counts=True)
+    return dict(zip(unique.tolist(), counts.tolist()))
+
+def _merge_counts(total, counts):
+    for value, count in counts.items():
+        total[value] = total.get(value, 0) + count
+    return total
+
+def _percentiles(counts):
+    # Percentiles straight from a {value: count} histogram
+    values = sorted(counts)
+    cumulative = np.cumsum([counts[value] for value in values])
+    result = {}
+    for p in SIMULATION_PERCENTILES:
+        position = int(np.searchsorted(cumulative, cumulative[-1] * p / 100))
+        result[p] = values[min(position, len(values) - 1)]
+    return result
+
+def _mean(counts):
+    return sum(value * count for value, count in counts.items()) / max(sum(counts.values()), 1)
+
+def _simulate_shard(banner_type, num_players, pulls_per_player, seed_sequence):
+    banner = COMPILED_BANNERS[banner_type]
+    rng = np.random.default_rng(seed_sequence)
+    orbital_jewels_per_item, auric_crescents_per_item, duplicate_bonus, item_keys = _item_reward_arrays(banner)
+    players = np.arange(num_players)
+    owned = np.zeros((num_players, item_keys.max() + 1), dtype=bool)
+
+    pity_4 = np.zeros(num_players, dtype=np.int64)
+    pity_5 = np.zeros(num_players, dtype=np.int64)
+    first_5_star = np.zeros(num_players, dtype=np.int64) # pull number of the first 5-star, 0 = none
+    orbital_jewels = np.zeros(num_players, dtype=np.int64)
+    auric_crescents = np.zeros(num_players, dtype=np.int64)
+    five_star_pity = {}
+
+    for pull in range(1, pulls_per_player + 1):
+        pity_4 += 1
+        pity_5 += 1
+        rarities, item_index = resolve_pulls(banner, pity_4, pity_5, rng.random(num_players), rng.random(num_players))
+        orbital_jewels += orbital_jewels_per_item[item_index]
+        auric_crescents += auric_crescents_per_item[item_index]
+        pulled = item_keys[item_index]
+        auric_crescents += duplicate_bonus[item_index] * owned[players, pulled]
+        owned[players, pulled] = True
+
+        hit_5 = rarities == 5
+        _merge_counts(five_star_pity, _value_counts(pity_5[hit_5]))
+        first_5_star[hit_5 & (first_5_star == 0)] = pull
+        pity_4[rarities >= 4] = 0 # 5-star resets 4-star pity too
+        pity_5[hit_5] = 0
+
+    return {
+        'first_5_star': _value_counts(first_5_star),
+        'five_star_pity': five_star_pity,
+        'orbital_jewels': _value_counts(orbital_jewels),
+        'auric_crescents': _value_counts(auric_crescents),
+    }
+
+def simulate_banner(banner_type, num_players, pulls_per_player=180, workers=None, seed=None):
+    """Simulate num_players fresh accounts doing pulls_per_player pulls each on a banner.
+    Returns a JSON-serializable report (see format_simulation_report)."""
+    if banner_type not in COMPILED_BANNERS:
+        raise ValueError(f'Invalid banner type: {banner_type}.')
+    if num_players <= 0 or pulls_per_player <= 0:
+        raise ValueError('Players and pulls per player must be at least 1.')
+    seed_sequence = np.random.SeedSequence(seed)
+    shard_sizes = [min(SIMULATION_SHARD_SIZE, num_players - start)
+                   for start in range(0, num_players, SIMULATION_SHARD_SIZE)]
+    tasks = [(banner_type, size, pulls_per_player, child)
+             for size, child in zip(shard_sizes, seed_sequence.spawn(len(shard_sizes)))]
+
+    if workers == 1 or len(tasks) == 1:
+        shard_results = [_simulate_shard(*task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            shard_results = pool.starmap(_simulate_shard, tasks)
+
+    merged = {key: {} for key in ('first_5_star', 'five_star_pity', 'orbital_jewels', 'auric_crescents')}
+    for result in shard_results:
+        for key, counts in result.items():
+            _merge_counts(merged[key], counts)
+
+    # Players pay per 10-pull session (pull_type 'multi') or per single pull
+    snc_single, _ = get_pull_cost(banner_type, 1)
+    snc_multi, _ = get_pull_cost(banner_type, 10)
+    reached = {pulls: count for pulls, count in merged['first_5_star'].items() if pulls}
+    cost_multi = {}
+    for pulls, count in reached.items():
+        _merge_counts(cost_multi, {-(-pulls // 10) * snc_multi: count})
+    total_pulls = num_players * pulls_per_player
+
+    return {
+        'banner_type': banner_type,
+        'players': num_players,
+        'pulls_per_player': pulls_per_player,
+        'seed': seed_sequence.entropy,
+        'first_5_star': {
+            'players_without_5_star': merged['first_5_star'].get(0, 0),
+            'mean_pulls': _mean(reached),
+            'mean_snc_single': _mean(reached) * snc_single,
+            'mean_snc_multi': _mean(cost_multi),
+            'percentiles': {
+                p: {'pulls': pulls, 'snc_single': pulls * snc_single, 'snc_multi': _percentiles(cost_multi)[p]}
+                for p, pulls in (_percentiles(reached).items() if reached else ())
+            },
+            'histogram': sorted(reached.items()),
+        },
+        'five_star_pity': {
+            'percentiles': _percentiles(merged['five_star_pity']) if merged['five_star_pity'] else {},
+            'histogram': sorted(merged['five_star_pity'].items()),
+        },
+        'earn_rates': {
+            'orbital_jewels_per_pull': sum(v * c for v, c in merged['orbital_jewels'].items()) / total_pulls,
+            'auric_crescents_per_pull': sum(v * c for v, c in merged['auric_crescents'].items()) / total_pulls,
+            'orbital_jewels_percentiles': _percentiles(merged['orbital_jewels']),
+            'auric_crescents_percentiles': _percentiles(merged['auric_crescents']),
+        },
+    }
+
+def format_simulation_report(report, bucket=10):
+    first = report['first_5_star']
+    lines = [
+        f"Banner {report['banner_type']}: {report['players']:,} players x {report['pulls_per_player']} pulls "
+        f"(seed {report['seed']})",
+        '',
+        f"Cost to first 5-star: mean {first['mean_pulls']:.1f} pulls, {first['mean_snc_multi']:,.0f} SNC in "
+        f"10-pulls, {first['mean_snc_single']:,.0f} SNC in single pulls "
+        f"({first['players_without_5_star']:,} players without one)",
+        f"{'percentile':>10} {'pulls':>7} {'SNC multi':>10} {'SNC single':>11}",
+    ]
+    for p, row in first['percentiles'].items():
+        lines.append(f"{'p' + str(p):>10} {row['pulls']:>7} {row['snc_multi']:>10,} {row['snc_single']:>11,}")
+
+    def histogram(title, pairs):
+        buckets = {}
+        for value, count in pairs:
+            buckets[value // bucket * bucket] = buckets.get(value // bucket * bucket, 0) + count
+        total = sum(buckets.values()) or 1
+        lines.extend(['', title])
+        for start, count in sorted(buckets.items()):
+            share = count / total
+            lines.append(f"{start:>4}-{start + bucket - 1:<4} {share:>7.2%} {'#' * round(share * 60)}")
+
+    histogram('Pulls to first 5-star', first['histogram'])
+    histogram('Pity at 5-star', report['five_star_pity']['histogram'])
+
+    earn = report['earn_rates']
+    lines.extend([
+        '',
+        f"Earn rates: {earn['orbital_jewels_per_pull']:.2f} OJ/pull, {earn['auric_crescents_per_pull']:.2f} AC/pull",
+        f"{'percentile':>10} {'OJ/player':>10} {'AC/player':>10}",
+    ])
+    for p in SIMULATION_PERCENTILES:
+        lines.append(f"{'p' + str(p):>10} {earn['orbital_jewels_percentiles'][p]:>10,} "
+                     f"{earn['auric_crescents_percentiles'][p]:>10,}")
+    return '\n'.join(lines)
+
+@app.cli.command('simulate-banner')
+@click.argument('banner_type')
+@click.option('--players', default=100000, show_default=True, help='Virtual players to simulate.')
+@click.option('--pulls', default=180, show_default=True, help='Pulls per player.')
+@click.option('--workers', default=None, type=int, help='Worker processes (default: one per core).')
+@click.option('--seed', default=None, type=int, help='Seed for a reproducible run.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the raw report as JSON.')
+def simulate_banner_command(banner_type, players, pulls, workers, seed, as_json):
+    """Monte Carlo economy report for a banner (cost to 5-star, pity, OJ/AC earn rates)."""
+    try:
+        report = simulate_banner(banner_type, players, pulls, workers, seed)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    click.echo(json.dumps(report, indent=2) if as_json else format_simulation_report(report))
 
 
 # --- Telegram Web App Validation ---
-# Replace with your actual bot token
-BOT_TOKEN = "YOUR_TELEGRAM_BOT_TOKEN_HERE" 
+# Set NOVAFLARE_BOT_TOKEN to your actual bot token
+BOT_TOKEN = os.environ.get('NOVAFLARE_BOT_TOKEN', "YOUR_TELEGRAM_BOT_TOKEN_HERE")
+TELEGRAM_AUTH_MAX_AGE = 24 * 3600 # seconds an initData stays valid after its auth_date
+TELEGRAM_CACHE_SIZE = 10000 # verified initData strings remembered
+TELEGRAM_CACHE_TTL = 300 # seconds before a cached initData is verified again
+
+# The Mini App sends the same initData with every call of a session, so verified strings are
+# cached (by SHA-256 of the whole string) until their TTL or their auth_date expiry, whichever
+# comes first. The cache and the HMAC secret key are rebuilt whenever BOT_TOKEN changes.
+_telegram_secret = (None, None) # (BOT_TOKEN, secret key derived from it)
+_telegram_cache = OrderedDict() # sha256(initData) -> (user_id, expires_at), least recently used first
+_telegram_cache_lock = threading.Lock()
+
+def get_telegram_secret_key():
+    global _telegram_secret
+    token, secret_key = _telegram_secret
+    if token != BOT_TOKEN:
+        secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+        with _telegram_cache_lock:
+            _telegram_cache.clear()
+        _telegram_secret = (BOT_TOKEN, secret_key)
+    return secret_key
+
+def parse_init_data(init_data):
+    """initData query string -> {key: percent-decoded value}."""
+    # Split on the first '=' only, values such as the user JSON may contain '=' once decoded.
+    # Most values need no decoding at all, skip unquote for those.
+    params = {}
+    for pair in init_data.split('&'):
+        key, _, value = pair.partition('=')
+        params[key] = unquote(value) if '%' in value else value
+    return params
 
 def validate_telegram_data(init_data):
     # For local testing without a real Telegram bot token, you can bypass validation
@@ -264,42 +1656,163 @@ def validate_telegram_data(init_data):
         print("Warning: BOT_TOKEN is not set or is default. Skipping Telegram data validation.")
         # Return a dummy user ID for local development
         return True, "123456789" # Example dummy user ID
-    
-    params = {k: unquote(v) for k, v in [p.split('=') for p in init_data.split('&')]}
-    if 'hash' not in params:
+    if not init_data:
+        return False, None
+
+    secret_key = get_telegram_secret_key()
+    cache_key = hashlib.sha256(init_data.encode()).digest()
+    with _telegram_cache_lock:
+        cached = _telegram_cache.get(cache_key)
+        if cached is not None:
+            if cached[1] > time.time():
+                _telegram_cache.move_to_end(cache_key)
+                return True, cached[0]
+            del _telegram_cache[cache_key]
+
+    params = parse_init_data(init_data)
+    received_hash = params.pop('hash', None)
+    if received_hash is None:
         print("Validation failed: 'hash' parameter missing.")
         return False, None
 
-    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()) if k != 'hash')
-    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
     calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(calculated_hash, received_hash):
+        print(f"Validation failed: Hash mismatch. Calculated: {calculated_hash}, Received: {received_hash}")
+        return False, None
+
+    try:
+        auth_date = int(params['auth_date'])
+    except (KeyError, ValueError):
+        print("Validation failed: 'auth_date' missing or invalid.")
+        return False, None
+    now = time.time()
+    if now - auth_date > TELEGRAM_AUTH_MAX_AGE:
+        print("Validation failed: initData has expired.")
+        return False, None
+
+    user_data = json.loads(params.get('user', '{}'))
+    user_id = str(user_data.get('id'))
+    with _telegram_cache_lock:
+        _telegram_cache[cache_key] = (user_id, min(now + TELEGRAM_CACHE_TTL, auth_date + TELEGRAM_AUTH_MAX_AGE))
+        if len(_telegram_cache) > TELEGRAM_CACHE_SIZE:
+            _telegram_cache.popitem(last=False)
+    return True, user_id
+
+# --- Transactions ---
+# Connections run in autocommit mode; multi-statement writes go through transaction(), which takes
+# SQLite's write lock up front (BEGIN IMMEDIATE) so two read-modify-write requests can't interleave.
+TRANSACTION_RETRIES = 5
+TRANSACTION_RETRY_DELAY = 0.02 # seconds, doubled on every retry
+
+class ConcurrentUpdateError(Exception):
+    """A compare-and-swap write found the row changed since it was read."""
+
+@contextmanager
+def transaction(db_conn):
+    """BEGIN IMMEDIATE ... COMMIT, joining the enclosing transaction if there already is one."""
+    if db_conn.in_transaction:
+        yield db_conn
+        return
+    db_conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield db_conn
+    except BaseException:
+        db_conn.rollback()
+        raise
+    with timed_stage('commit'):
+        db_conn.commit()
+
+def _is_contention(error):
+    return isinstance(error, ConcurrentUpdateError) or (
+        isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+    )
+
+def retry_on_contention(fn):
+    """Re-run a whole transaction when it loses a race for the write lock or a version check."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(TRANSACTION_RETRIES):
+            try:
+                return fn(*args, **kwargs)
+            except (ConcurrentUpdateError, sqlite3.OperationalError) as e:
+                if not _is_contention(e) or attempt == TRANSACTION_RETRIES - 1:
+                    raise
+                time.sleep(TRANSACTION_RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+    return wrapper
+
+CURRENCY_COLUMNS = ('star_night_crystals', 'lumen_orbs', 'halo_orbs', 'auric_crescents', 'orbital_jewels')
 
-    if calculated_hash == params['hash']:
-        user_data = json.loads(params.get('user', '{}'))
-        user_id = str(user_data.get('id'))
-        return True, user_id
-    
-    print(f"Validation failed: Hash mismatch. Calculated: {calculated_hash}, Received: {params['hash']}")
-    return False, None
+def debit_currency(db_conn, user_id, user, currency, amount):
+    """Subtract amount from a balance, in the database and in user, only if it covers it.
+    Returns False when it doesn't."""
+    if currency not in CURRENCY_COLUMNS:
+        raise ValueError(f'Unknown currency: {currency}')
+    if USER_CACHE is not None and USER_CACHE.write_behind:
+        # The cached state is authoritative and the player's entry is held, check it in place
+        if user[currency] < amount:
+            return False
+    else:
+        cursor = db_conn.execute(
+            f"UPDATE user_data SET {currency} = {currency} - ? WHERE user_id = ? AND {currency} >= ?",
+            (amount, user_id, amount)
+        )
+        if cursor.rowcount == 0:
+            return False
+    user[currency] -= amount
+    return True
 
 # --- User Management (Database-backed) ---
+# The two statements every request runs. sqlite3 keeps prepared statements per connection,
+# so with pooled connections these are compiled once per connection instead of per request.
+USER_SELECT_SQL = "SELECT * FROM user_data WHERE user_id = ?"
+USER_SAVE_SQL = '''
+    UPDATE user_data SET
+        star_night_crystals = ?,
+        lumen_orbs = ?,
+        halo_orbs = ?,
+        auric_crescents = ?,
+        orbital_jewels = ?,
+        pity_counters = ?,
+        rng_seed = ?,
+        rng_counter = ?,
+        version = version + 1
+    WHERE user_id = ? AND version = ?
+'''
+
 def get_user_data_from_db(user_id):
-    db_conn = get_db()
+    with timed_stage('load'):
+        if USER_CACHE is not None:
+            return USER_CACHE.get(user_id)
+        return read_user_data(user_id)
+
+def read_user_data(user_id):
+    db_conn = get_shard_db(user_id)
     cursor = db_conn.cursor()
-    cursor.execute("SELECT * FROM user_data WHERE user_id = ?", (user_id,))
+    cursor.execute(USER_SELECT_SQL, (user_id,))
     user_row = cursor.fetchone()
 
     if user_row:
         # Convert JSON strings back to Python objects
         user_data = dict(user_row)
-        user_data['inventory'] = json.loads(user_data['inventory'])
+        legacy_inventory = user_data.pop('inventory')
+        if legacy_inventory and legacy_inventory != '[]':
+            # Rows written before the inventory table existed, move them over on first read
+            ensure_item_catalog(get_db())
+            with transaction(db_conn):
+                migrate_inventory_blob(db_conn, user_id, legacy_inventory)
+        legacy_exchanges = user_data.pop('monthly_exchanges')
+        if legacy_exchanges and legacy_exchanges != '{}':
+            # Same for counts from before the exchange_limits table
+            with transaction(db_conn):
+                migrate_exchange_blob(db_conn, user_id, legacy_exchanges)
         user_data['pity_counters'] = json.loads(user_data['pity_counters'])
-        user_data['monthly_exchanges'] = json.loads(user_data['monthly_exchanges'])
         return user_data
     else:
         # Create new user data in DB if not found
-        new_user_data = DEFAULT_USER_DATA.copy()
+        new_user_data = copy.deepcopy(DEFAULT_USER_DATA) # pity dicts must not be shared
         new_user_data['user_id'] = user_id # Add user_id to the data
+        new_user_data['rng_seed'] = new_pull_seed()
         
         # Ensure pity counters are initialized for all banners for new users
         for banner in GACHA_RATES.keys():
@@ -307,8 +1820,9 @@ def get_user_data_from_db(user_id):
                 new_user_data['pity_counters'][banner] = {"4_star": 0, "5_star": 0}
 
         cursor.execute('''
-            INSERT INTO user_data (user_id, star_night_crystals, lumen_orbs, halo_orbs, auric_crescents, orbital_jewels, inventory, pity_counters, monthly_exchanges)
+            INSERT INTO user_data (user_id, star_night_crystals, lumen_orbs, halo_orbs, auric_crescents, orbital_jewels, inventory, pity_counters, rng_seed)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO NOTHING
         ''', (
             user_id,
             new_user_data['star_night_crystals'],
@@ -318,232 +1832,1410 @@ def get_user_data_from_db(user_id):
             new_user_data['orbital_jewels'],
             json.dumps(new_user_data['inventory']),
             json.dumps(new_user_data['pity_counters']),
-            json.dumps(new_user_data['monthly_exchanges'])
+            new_user_data['rng_seed']
         ))
-        db_conn.commit()
+        if cursor.rowcount == 0:
+            # Another request created this user first
+            return read_user_data(user_id)
+        del new_user_data['inventory'] # inventory lives in its own table, see get_inventory_page
+        new_user_data['version'] = 0
         return new_user_data
 
 def save_user_data_to_db(user_id, data):
-    db_conn = get_db()
+    # Compare-and-swap on the version read in get_user_data_from_db, so a save can never
+    # silently overwrite a change it didn't see
+    if USER_CACHE is not None and USER_CACHE.write_behind:
+        USER_CACHE.stage_save(user_id, data)
+        data['version'] += 1
+        return
+    db_conn = get_shard_db(user_id)
     cursor = db_conn.cursor()
-    cursor.execute('''
-        UPDATE user_data SET 
-            star_night_crystals = ?, 
-            lumen_orbs = ?, 
-            halo_orbs = ?, 
-            auric_crescents = ?, 
-            orbital_jewels = ?,
-            inventory = ?, 
-            pity_counters = ?, 
-            monthly_exchanges = ?
-        WHERE user_id = ?
-    ''', (
+    cursor.execute(USER_SAVE_SQL, (
         data['star_night_crystals'],
         data['lumen_orbs'],
         data['halo_orbs'],
         data['auric_crescents'],
         data['orbital_jewels'],
-        json.dumps(data['inventory']),
         json.dumps(data['pity_counters']),
-        json.dumps(data['monthly_exchanges']),
-        user_id
+        data['rng_seed'],
+        data['rng_counter'],
+        user_id,
+        data['version']
     ))
-    db_conn.commit()
+    if cursor.rowcount == 0:
+        raise ConcurrentUpdateError(f'user_data for {user_id} changed since it was read')
+    if USER_CACHE is not None:
+        USER_CACHE.stage_save(user_id, data)
+    data['version'] += 1
 
-# --- Authentication Routes ---
-@app.route('/login')
-def login_page():
-    return render_template('login.html')
+# --- Inventory (Database-backed) ---
+# Pulled items are appended to the inventory table instead of rewriting a JSON blob, so a pull
+# costs the same no matter how many items a player already has. inventory_counts keeps the number
+# of copies per item for duplicate detection without scanning the inventory.
+ITEM_IDS = None      # item name -> items.id
+ITEMS_BY_ID = None   # items.id -> item dict, as returned to clients
+_CATALOG_BANNERS = None # COMPILED_BANNERS the cache was built from, reloaded when banners change
+INVENTORY_PAGE_SIZE = 100
+INVENTORY_PAGE_SIZE_MAX = 1000
 
-@app.route('/login', methods=['POST'])
-def login():
-    username = request.form['username']
-    password = request.form['password']
+def _item_from_row(row):
+    item = {"name": row['name'], "rarity": row['rarity'], "type": row['type'], "image": row['image']}
+    if row['is_limited']:
+        item["is_limited"] = True
+    return item
 
-    db_conn = get_db()
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-    user_row = cursor.fetchone()
+def ensure_item_catalog(db_conn):
+    """Register every GACHA_POOL item in the items table and cache the name <-> id mapping.
 
-    if user_row and check_password_hash(user_row['password'], password):
-        session['user_id'] = user_row['id']
-        session['username'] = user_row['username']
-        session['role'] = user_row['role']
-        
-        if user_row['role'] == 'admin':
-            return redirect(url_for('admin_dashboard'))
-        else:
-            return redirect(url_for('serve_index_html')) # Redirect to home for players
-    else:
-        return render_template('login.html', error='Invalid username or password')
+    Must run outside a write transaction: ids are only cached once their rows are committed,
+    otherwise a rolled back pull could leave the cache pointing at ids that don't exist.
+    """
+    global ITEM_IDS, ITEMS_BY_ID, _CATALOG_BANNERS
+    if _CATALOG_BANNERS is COMPILED_BANNERS:
+        return
+    banners = COMPILED_BANNERS
+    pool_items = {}
+    for pool in GACHA_POOL.values():
+        for item in pool:
+            pool_items.setdefault(item['name'], item)
+    with transaction(db_conn):
+        db_conn.executemany(
+            "INSERT INTO items (name, rarity, type, is_limited, image) VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO NOTHING",
+            [(item['name'], item['rarity'], item['type'], int(item.get('is_limited', False)), item.get('image'))
+             for item in pool_items.values()]
+        )
 
-@app.route('/logout')
-def logout():
-    session.pop('user_id', None)
-    session.pop('username', None)
-    session.pop('role', None)
-    return redirect(url_for('login_page'))
+    item_ids, items_by_id = {}, {}
+    for row in db_conn.execute("SELECT * FROM items"):
+        item_ids[row['name']] = row['id']
+        items_by_id[row['id']] = pool_items.get(row['name']) or _item_from_row(row)
+    ITEM_IDS, ITEMS_BY_ID, _CATALOG_BANNERS = item_ids, items_by_id, banners
 
-# --- Admin Dashboard (Placeholder for now) ---
-@app.route('/admin')
-def admin_dashboard():
-    if 'role' not in session or session['role'] != 'admin':
-        return "Access Denied: Admins only!", 403
-    return render_template('admin.html', username=session['username'])
+def get_item_id(db_conn, item):
+    item_id = ITEM_IDS.get(item['name'])
+    if item_id is None:
+        # Not in any current banner (retired item or an old inventory entry). Add it to the
+        # catalog without caching, the surrounding transaction may still roll back. The catalog
+        # is in DATABASE; with several shards db_conn may be another file's.
+        catalog_conn = db_conn if SHARD_COUNT == 1 else get_db()
+        catalog_conn.execute(
+            "INSERT INTO items (name, rarity, type, is_limited, image) VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) DO NOTHING",
+            (item['name'], item.get('rarity', 0), item.get('type', ''), int(item.get('is_limited', False)), item.get('image'))
+        )
+        item_id = catalog_conn.execute("SELECT id FROM items WHERE name = ?", (item['name'],)).fetchone()[0]
+    return item_id
 
+def _get_catalog_item(db_conn, item_id):
+    item = ITEMS_BY_ID.get(item_id)
+    if item is None:
+        item = _item_from_row(db_conn.execute("SELECT * FROM items WHERE id = ?", (item_id,)).fetchone())
+    return item
 
-# --- Flask Routes (Updated to use DB functions) ---
-@app.route('/')
-def serve_index_html():
-    # If not logged in, redirect to login page
-    if 'user_id' not in session:
-        return redirect(url_for('login_page'))
-    return render_template('index.html')
+def get_owned_counts(user_id):
+    """Returns {item_id: copies owned} for a user."""
+    db_conn = get_shard_db(user_id)
+    if USER_CACHE is not None:
+        return USER_CACHE.owned_counts(db_conn, user_id)
+    rows = db_conn.execute("SELECT item_id, count FROM inventory_counts WHERE user_id = ?", (user_id,))
+    return {item_id: count for item_id, count in rows}
 
-@app.route('/game')
-def serve_game_html():
-    if 'user_id' not in session:
-        return redirect(url_for('login_page'))
-    return render_template('game.html')
+INVENTORY_INSERT_SQL = "INSERT INTO inventory (user_id, item_id, version) VALUES (?, ?, ?)"
+INVENTORY_COUNT_SQL = '''
+    INSERT INTO inventory_counts (user_id, item_id, count) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, item_id) DO UPDATE SET count = count + excluded.count
+'''
 
-@app.route('/shop')
-def serve_shop_html():
-    if 'user_id' not in session:
-        return redirect(url_for('login_page'))
-    return render_template('shop.html')
+def inventory_writes(user_id, item_ids, version):
+    """The (sql, params) statements that append item_ids to a user's inventory."""
+    counts = {}
+    for item_id in item_ids:
+        counts[item_id] = counts.get(item_id, 0) + 1
+    return ([(INVENTORY_INSERT_SQL, (user_id, item_id, version)) for item_id in item_ids] +
+            [(INVENTORY_COUNT_SQL, (user_id, item_id, count)) for item_id, count in counts.items()])
 
-@app.route('/get_user_data', methods=['GET'])
-def get_user_data():
-    # For Telegram WebApp, we still validate init_data
-    init_data = request.headers.get('X-Telegram-Init-Data')
-    is_valid, telegram_user_id = validate_telegram_data(init_data)
+def insert_inventory(db_conn, user_id, item_ids, version):
+    """Write inventory rows straight to the database. Does not commit."""
+    db_conn.executemany(INVENTORY_INSERT_SQL, [(user_id, item_id, version) for item_id in item_ids])
+    counts = {}
+    for item_id in item_ids:
+        counts[item_id] = counts.get(item_id, 0) + 1
+    db_conn.executemany(INVENTORY_COUNT_SQL, [(user_id, item_id, count) for item_id, count in counts.items()])
 
-    user_id_to_fetch = None
-    if is_valid:
-        user_id_to_fetch = telegram_user_id
-    elif 'user_id' in session:
-        user_id_to_fetch = str(session['user_id'])
-    
-    if not user_id_to_fetch:
-        return jsonify({'status': 'error', 'message': 'Not authenticated.'}), 401
+def add_to_inventory(db_conn, user_id, items, version):
+    """Append pulled items to a user's inventory, stamped with the state version that adds them.
+    Does not commit."""
+    item_ids = [get_item_id(db_conn, item) for item in items]
+    if USER_CACHE is not None:
+        USER_CACHE.stage_inventory(db_conn, user_id, item_ids, version)
+    if USER_CACHE is None or not USER_CACHE.write_behind:
+        insert_inventory(db_conn, user_id, item_ids, version)
 
-    user = get_user_data_from_db(user_id_to_fetch)
-    return jsonify({
-        'status': 'success',
-        'user_id': user_id_to_fetch, # Return the ID that was actually used
-        'star_night_crystals': user['star_night_crystals'],
-        'lumen_orbs': user['lumen_orbs'],
-        'halo_orbs': user['halo_orbs'],
-        'auric_crescents': user['auric_crescents'],
-        'orbital_jewels': user['orbital_jewels'], # Include new currency
-        'pity_counters': user['pity_counters'],
-        'inventory': user['inventory']
-    })
+def get_inventory_page(user_id, cursor=0, limit=INVENTORY_PAGE_SIZE, since_version=None):
+    """One page of a user's items in pull order, optionally only those added after since_version.
+    Returns (items, next_cursor); next_cursor is None on the last page."""
+    catalog_conn = get_db()
+    ensure_item_catalog(catalog_conn)
+    if USER_CACHE is not None and USER_CACHE.write_behind:
+        USER_CACHE.flush() # inventory is read from the table, write out pending pulls first
+    db_conn = get_shard_db(user_id)
+    query = "SELECT id, item_id FROM inventory WHERE user_id = ? AND id > ?"
+    params = [user_id, cursor]
+    if since_version is not None:
+        query += " AND version > ?"
+        params.append(since_version)
+    rows = db_conn.execute(query + " ORDER BY id LIMIT ?", params + [limit + 1]).fetchall()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [_get_catalog_item(catalog_conn, item_id) for _, item_id in rows[:limit]], next_cursor
 
-@app.route('/pull_gacha', methods=['POST'])
-def pull_gacha():
-    init_data = request.headers.get('X-Telegram-Init-Data')
-    is_valid, telegram_user_id = validate_telegram_data(init_data)
-    
-    user_id_to_process = None
-    if is_valid:
-        user_id_to_process = telegram_user_id
-    elif 'user_id' in session:
-        user_id_to_process = str(session['user_id'])
-    
-    if not user_id_to_process:
-        return jsonify({'status': 'error', 'message': 'Not authenticated.'}), 401
+def migrate_inventory_blob(db_conn, user_id, blob):
+    """Move a legacy user_data.inventory JSON list into the inventory tables. Does not commit.
 
-    data = request.get_json()
-    pull_type = data.get('pull_type')
-    banner_type = data.get('banner_type')
+    blob may have been read outside the transaction: it is only moved if it is still the row's,
+    so two requests migrating the same player at once don't both insert it. Returns whether it was.
+    """
+    cursor = db_conn.execute("UPDATE user_data SET inventory = '[]' WHERE user_id = ? AND inventory = ?", (user_id, blob))
+    if cursor.rowcount != 1:
+        return False # someone else got there first
+    version = db_conn.execute("SELECT version FROM user_data WHERE user_id = ?", (user_id,)).fetchone()[0]
+    insert_inventory(db_conn, user_id, [get_item_id(db_conn, item) for item in json.loads(blob)], version)
+    return True
 
-    if banner_type not in GACHA_POOL:
-        return jsonify({'status': 'error', 'message': f'Invalid banner type: {banner_type}.'}), 400
+@app.cli.command('migrate-inventory')
+@click.option('--batch-size', default=500, show_default=True, help='Users migrated per transaction.')
+def migrate_inventory_command(batch_size):
+    """Move every legacy inventory JSON blob into the inventory tables."""
+    ensure_item_catalog(get_db())
+    migrated = items = 0
+    for shard in range(SHARD_COUNT):
+        db_conn = shard_connection(get_db(), shard)
+        last_rowid = 0
+        while True:
+            rows = db_conn.execute('''
+                SELECT rowid, user_id, inventory FROM user_data
+                WHERE rowid > ? AND inventory IS NOT NULL AND inventory != '[]'
+                ORDER BY rowid LIMIT ?
+            ''', (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            with transaction(db_conn):
+                for row in rows:
+                    if migrate_inventory_blob(db_conn, row['user_id'], row['inventory']):
+                        migrated += 1
+                        items += len(json.loads(row['inventory']))
+            last_rowid = rows[-1]['rowid']
+            click.echo(f"Migrated {migrated} users ({items} items)...")
+    click.echo(f"Done: {migrated} users, {items} items moved to the inventory table.")
 
-    user = get_user_data_from_db(user_id_to_process)
-    
-    num_pulls = 10 if pull_type == 'multi' else 1
-    
-    # Determine cost based on banner type and number of pulls
-    cost_snc_per_pull = COST_MAP[banner_type]['snc']
-    cost_orb_per_pull = 1 # 1 orb per pull
-
-    cost_snc_total = cost_snc_per_pull * num_pulls
-    cost_orb_total = cost_orb_per_pull * num_pulls
-    
-    # Apply 10-pull discount for SNC if specified in COST_MAP (e.g., 595 for standard, 900 for limited)
-    if num_pulls == 10:
-        if 'standard' in banner_type:
-            cost_snc_total = 595 # Fixed discount for 10-pull standard
-        elif 'limited' in banner_type:
-            cost_snc_total = 900 # Fixed discount for 10-pull limited
-            
-    orb_currency_type = COST_MAP[banner_type]['orb']
-
-    # Check and deduct currency
-    if user[orb_currency_type] >= cost_orb_total:
-        user[orb_currency_type] -= cost_orb_total
-        currency_spent_type = orb_currency_type
-    elif user['star_night_crystals'] >= cost_snc_total:
-        user['star_night_crystals'] -= cost_snc_total
-        currency_spent_type = 'star_night_crystals'
-    else:
-        return jsonify({'status': 'error', 'message': 'Insufficient currency for this pull.'}), 400
 
-    pulled_items = []
-    pity_4 = user['pity_counters'].get(banner_type, {}).get('4_star', 0)
-    pity_5 = user['pity_counters'].get(banner_type, {}).get('5_star', 0)
+# --- Exchange Limits ---
+# Limited shop items (a 'limit' in COST_MAP) are counted per (user, item, period) in exchange_limits,
+# the period being the UTC month. A new month is just a new key, so limits start over on their own
+# with no reset job touching every player; rows of past periods are dead weight that
+# purge-exchange-limits deletes in batches through the period index.
+EXCHANGE_PERIOD_FORMAT = '%Y-%m' # one period per UTC month
+EXCHANGE_PERIODS_KEPT = 3 # periods purge-exchange-limits keeps by default, the current one included
+EXCHANGE_PURGE_BATCH = 5000 # rows deleted per transaction
 
-    for _ in range(num_pulls):
-        pity_4 += 1
-        pity_5 += 1
+EXCHANGE_COUNT_SQL = "SELECT count FROM exchange_limits WHERE user_id = ? AND item = ? AND period = ?"
+EXCHANGE_RECORD_SQL = '''
+    INSERT INTO exchange_limits (user_id, item, period, count) VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, item, period) DO UPDATE SET count = count + excluded.count
+'''
 
-        result = get_pull_result(banner_type, pity_4, pity_5)
-        pulled_items.append(result)
-        user['inventory'].append(result)
-
-        # Award Orbital Jewels (OJ) based on rarity
-        if result['rarity'] == 3:
-            user['orbital_jewels'] += 25
-        elif result['rarity'] == 4:
-            user['orbital_jewels'] += 50
-            # Award Auric Crescents (AC) for 4-star
-            user['auric_crescents'] += 10
-        elif result['rarity'] == 5:
-            user['orbital_jewels'] += 100
-            # Award Auric Crescents (AC) for 5-star
-            user['auric_crescents'] += 20
-
-        # Reset pity counters
-        if result['rarity'] == 4:
-            pity_4 = 0
-        if result['rarity'] == 5:
-            pity_5 = 0
-            pity_4 = 0 # 5-star resets 4-star pity too
-
-        # Check for Spectra (duplicate characters) for Auric Crescents
-        # This is a simplified check. In a real game, you'd track character ownership
-        # and check if the pulled character is already owned.
-        # For now, we'll assume any 4-star or 5-star character pull *could* be a duplicate
-        # and award AC for Spectra if it's a character.
-        if result['type'] == 'Character' and (result['rarity'] == 4 or result['rarity'] == 5):
-            # This is a placeholder logic. You'd need a system to track owned characters
-            # and detect actual duplicates to award 50 AC per Spectra.
-            # For now, I'll add 50 AC if it's a character of 4* or 5* as a placeholder for "Spectra".
-            user['auric_crescents'] += 50 # Add 50 AC for potential Spectra (duplicate character)
-
-    # Ensure the banner_type key exists in pity_counters before assigning
-    if banner_type not in user['pity_counters']:
-        user['pity_counters'][banner_type] = {}
-    user['pity_counters'][banner_type]['4_star'] = pity_4
-    user['pity_counters'][banner_type]['5_star'] = pity_5
-
-    save_user_data_to_db(user_id_to_process, user)
-
-    return jsonify({
-        'status': 'success',
-        'pulled_items': pulled_items,
+def exchange_period(timestamp=None):
+    """The limit period a timestamp (default: now) falls in."""
+    return time.strftime(EXCHANGE_PERIOD_FORMAT, time.gmtime(timestamp))
+
+def months_before(period, months):
+    """The monthly period that many months before period."""
+    year, month = map(int, period.split('-'))
+    index = year * 12 + month - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def get_exchange_count(db_conn, user_id, item, period):
+    """How many times a user exchanged item in period."""
+    if USER_CACHE is not None:
+        return USER_CACHE.exchange_count(db_conn, user_id, item, period)
+    row = db_conn.execute(EXCHANGE_COUNT_SQL, (user_id, item, period)).fetchone()
+    return row[0] if row else 0
+
+def record_exchange(db_conn, user_id, item, period):
+    """Count one exchange of item in period. Does not commit."""
+    if USER_CACHE is not None:
+        USER_CACHE.stage_exchange(db_conn, user_id, item, period)
+    if USER_CACHE is None or not USER_CACHE.write_behind:
+        db_conn.execute(EXCHANGE_RECORD_SQL, (user_id, item, period, 1))
+
+def migrate_exchange_blob(db_conn, user_id, blob):
+    """Move a legacy user_data.monthly_exchanges JSON object into exchange_limits. Does not commit.
+
+    The blob was never reset, so its counts are carried into the current period: nobody gets
+    more exchanges this month than they had left, and the next month starts from zero. As with
+    migrate_inventory_blob, blob is only moved if it is still the row's. Returns whether it was.
+    """
+    cursor = db_conn.execute("UPDATE user_data SET monthly_exchanges = '{}' WHERE user_id = ? AND monthly_exchanges = ?",
+                             (user_id, blob))
+    if cursor.rowcount != 1:
+        return False # someone else got there first
+    period = exchange_period()
+    db_conn.executemany(EXCHANGE_RECORD_SQL, [(user_id, item, period, count)
+                                             for item, count in json.loads(blob).items() if count])
+    return True
+
+def purge_exchange_limits(db_conn, before_period, batch_size=EXCHANGE_PURGE_BATCH):
+    """Delete the counts of every period before before_period, one short transaction per batch so
+    requests aren't locked out meanwhile. Returns the number of rows deleted."""
+    deleted = 0
+    while True:
+        with transaction(db_conn):
+            cursor = db_conn.execute('''
+                DELETE FROM exchange_limits WHERE (user_id, item, period) IN (
+                    SELECT user_id, item, period FROM exchange_limits WHERE period < ? LIMIT ?
+                )
+            ''', (before_period, batch_size))
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch_size:
+            return deleted
+
+@app.cli.command('purge-exchange-limits')
+@click.option('--keep', default=EXCHANGE_PERIODS_KEPT, show_default=True, help='Periods to keep, the current one included.')
+@click.option('--batch-size', default=EXCHANGE_PURGE_BATCH, show_default=True, help='Rows deleted per transaction.')
+def purge_exchange_limits_command(keep, batch_size):
+    """Delete exchange limit counts of expired periods."""
+    if keep < 1:
+        raise click.BadParameter('the current period must be kept', param_hint='--keep')
+    before = months_before(exchange_period(), keep - 1)
+    deleted = sum(purge_exchange_limits(shard_connection(get_db(), shard), before, batch_size) for shard in range(shard_count()))
+    click.echo(f"Deleted {deleted} exchange limit rows from periods before {before}.")
+
+
+# --- Event Log ---
+# Every pull and exchange appends rows to the events table, one per pulled item and one per
+# exchange, for rate audits, support tickets and analytics exports:
+#   ts                 milliseconds since the epoch (UTC)
+#   user_id, version   the player and the state version the request produced; the rows of one
+#                      request share them, and inventory rows carry the same version
+#   kind, source       'pull' and the banner, 'exchange' and the shop item, or 'admin' and the bulk
+#                      job that changed the player (see Bulk Admin Jobs)
+#   item_id, rarity    the pulled item (pulls only)
+#   pity_4, pity_5     pulls since the last 4/5-star, this one included (pulls only)
+#   is_duplicate       whether the player already owned the item (pulls only)
+#   <currency>         change of each balance: the request's cost on its first row, rewards on
+#                      the row that earned them
+#   rng_counter        the draw of the player's pull stream the pull used (pulls only)
+#   config_id          banner_configs row the pull was resolved with (pulls only)
+# The rows are written with the rest of the request, in its transaction (one executemany, no extra
+# commit) or in the user cache's next flush, so the log can't disagree with the balances.
+EVENT_COLUMNS = ('ts', 'user_id', 'version', 'kind', 'source', 'item_id', 'rarity', 'pity_4', 'pity_5', 'is_duplicate') + CURRENCY_COLUMNS + ('rng_counter', 'config_id')
+EVENT_INSERT_SQL = f"INSERT INTO events ({', '.join(EVENT_COLUMNS)}) VALUES ({', '.join('?' * len(EVENT_COLUMNS))})"
+PLAYER_EVENT_SQL = "kind IN ('pull', 'exchange')" # events the player made, not an admin job
+EVENT_EXPORT_BATCH = 50000 # rows per read, and per Parquet row group
+EVENT_HTTP_BATCH = 5000 # rows per read (and chunk) of /admin/events.csv
+
+def make_event(ts, user_id, version, kind, source, changes, item_id=None, rarity=None, pity_4=None, pity_5=None, is_duplicate=None,
+               rng_counter=None, config_id=None):
+    """An events row, in EVENT_COLUMNS order. changes is {currency: signed amount}."""
+    return (ts, user_id, version, kind, source, item_id, rarity, pity_4, pity_5, is_duplicate,
+            changes.get('star_night_crystals', 0), changes.get('lumen_orbs', 0), changes.get('halo_orbs', 0),
+            changes.get('auric_crescents', 0), changes.get('orbital_jewels', 0), rng_counter, config_id)
+
+def log_events(db_conn, user_id, rows):
+    """Append rows to the event log with the rest of the request's writes. Does not commit."""
+    start_rollup_worker()
+    if USER_CACHE is not None and USER_CACHE.write_behind:
+        USER_CACHE.stage_writes(user_id, [(EVENT_INSERT_SQL, row) for row in rows])
+    else:
+        db_conn.executemany(EVENT_INSERT_SQL, rows)
+
+def open_export_connection(shard=0):
+    """A connection for long sequential reads. Without mmap its memory use stays at the page cache
+    plus one batch, however large the table."""
+    db_conn = open_db_connection(path=shard_path(shard))
+    db_conn.execute("PRAGMA mmap_size = 0")
+    return db_conn
+
+def iter_event_batches(db_conn, after_id=0, until_id=None, user_id=None, batch_size=EVENT_EXPORT_BATCH, shard=0):
+    """Yield lists of (id,) + EVENT_COLUMNS tuples in id order, batch_size at a time.
+
+    Each batch is its own short read, so an export of any size holds neither memory nor a
+    read snapshot (which would stop WAL checkpoints) for longer than one batch. db_conn is the
+    shard's connection; after_id and until_id are its row ids, the ids yielded are event ids (see
+    User Data Shards).
+    """
+    base = shard * SHARD_EVENT_ID_STRIDE
+    query = f"SELECT id + {base}, {', '.join(EVENT_COLUMNS)} FROM events WHERE id > ?"
+    bounds = []
+    if until_id is not None:
+        query += " AND id <= ?"
+        bounds.append(until_id)
+    if user_id is not None:
+        query += " AND user_id = ?"
+        bounds.append(user_id)
+    query += " ORDER BY id LIMIT ?"
+    cursor = db_conn.cursor()
+    cursor.row_factory = None # plain tuples
+    while True:
+        rows = cursor.execute(query, [after_id] + bounds + [batch_size]).fetchall()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0] - base
+
+def shard_event_bounds(after_id, shard):
+    """The row id in a shard that an event id bound corresponds to."""
+    return min(max(after_id - shard * SHARD_EVENT_ID_STRIDE, 0), SHARD_EVENT_ID_STRIDE)
+
+def iter_all_event_batches(after_id=0, user_id=None, batch_size=EVENT_EXPORT_BATCH, shards=None):
+    """iter_event_batches over every shard in turn (or those listed), each up to the newest event it
+    had when the generator reached it. Yields (shard, until event id, rows) and closes its connections."""
+    main = open_export_connection() # the export may outlive any pooled connection
+    try:
+        for shard in (range(SHARD_COUNT) if shards is None else shards):
+            if user_id is not None and shard != shard_of(user_id):
+                continue
+            db_conn = main if shard == 0 else open_export_connection(shard)
+            try:
+                # Everything logged before the export started, however long it takes
+                until_id = db_conn.execute("SELECT max(id) FROM events").fetchone()[0] or 0
+                for rows in iter_event_batches(db_conn, shard_event_bounds(after_id, shard), until_id, user_id, batch_size, shard):
+                    yield shard, until_id + shard * SHARD_EVENT_ID_STRIDE, rows
+                yield shard, until_id + shard * SHARD_EVENT_ID_STRIDE, []
+            finally:
+                if db_conn is not main:
+                    db_conn.close()
+    finally:
+        main.close()
+
+def write_events_csv(file, batches):
+    """Write event batches to a text file as CSV with a header. Returns the rows written."""
+    writer = csv.writer(file)
+    writer.writerow(('id',) + EVENT_COLUMNS)
+    written = 0
+    for rows in batches:
+        writer.writerows(rows)
+        written += len(rows)
+    return written
+
+def write_events_parquet(path, batches):
+    """Write event batches to a Parquet file, one row group per batch. Returns the rows written."""
+    import pyarrow as pa # export-only dependency
+    import pyarrow.parquet as pq
+
+    types = {'id': pa.int64(), 'ts': pa.timestamp('ms', tz='UTC'), 'user_id': pa.string(), 'version': pa.int64(),
+             'kind': pa.dictionary(pa.int8(), pa.string()), 'source': pa.dictionary(pa.int16(), pa.string()),
+             'item_id': pa.int32(), 'rarity': pa.int8(), 'pity_4': pa.int16(), 'pity_5': pa.int16(), 'is_duplicate': pa.int8(),
+             'config_id': pa.int32()}
+    schema = pa.schema([(column, types.get(column, pa.int64())) for column in ('id',) + EVENT_COLUMNS])
+    written = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for rows in batches:
+            columns = [pa.array(values, type=field.type) if not pa.types.is_dictionary(field.type)
+                       else pa.array(values, type=pa.string()).dictionary_encode().cast(field.type)
+                       for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            written += len(rows)
+    return written
+
+@app.cli.command('export-events')
+@click.argument('output')
+@click.option('--format', 'export_format', type=click.Choice(['csv', 'parquet']), help='Default: from the file extension.')
+@click.option('--after-id', default=0, show_default=True, help='Only events after this id, for incremental exports.')
+@click.option('--user-id', default=None, help='Only this player\'s events.')
+@click.option('--shard', type=int, default=None, help='Only this shard\'s events. Default: every shard, one after the other.')
+@click.option('--batch-size', default=EVENT_EXPORT_BATCH, show_default=True, help='Rows per read.')
+def export_events_command(output, export_format, after_id, user_id, shard, batch_size):
+    """Stream the event log to OUTPUT (a file, or - for CSV on stdout).
+
+    With several shards event ids only grow within a shard, so incremental exports are per shard:
+    pass --shard with --after-id."""
+    export_format = export_format or ('parquet' if output.endswith('.parquet') else 'csv')
+    if shard is not None and not 0 <= shard < shard_count():
+        raise click.BadParameter(f'there are {SHARD_COUNT} shards', param_hint='--shard')
+    shards = None if shard is None else [shard]
+    until_ids = {}
+
+    def batches():
+        for batch_shard, until_id, rows in iter_all_event_batches(after_id, user_id, batch_size, shards):
+            until_ids[batch_shard] = until_id
+            if rows:
+                yield rows
+    if export_format == 'parquet':
+        try:
+            written = write_events_parquet(output, batches())
+        except ImportError:
+            raise click.ClickException("pyarrow is required for Parquet exports: pip install pyarrow")
+    elif output == '-':
+        written = write_events_csv(click.get_text_stream('stdout'), batches())
+    else:
+        with open(output, 'w', newline='') as f:
+            written = write_events_csv(f, batches())
+    if SHARD_COUNT == 1:
+        click.echo(f"Exported {written} events ({after_id} < id <= {until_ids[0]}). Next incremental export: --after-id {until_ids[0]}", err=True)
+    else:
+        click.echo(f"Exported {written} events. Next incremental exports: "
+                   f"{', '.join(f'--shard {s} --after-id {until_id}' for s, until_id in sorted(until_ids.items()))}", err=True)
+
+
+# --- Analytics Rollups ---
+# The admin dashboard reads small summary tables instead of scanning the event log:
+#   rollup_hourly          per (UTC hour, kind, source): events, items pulled per rarity, duplicates,
+#                          and each currency's amount spent and earned
+#   rollup_active_counts   distinct players per hour and per day with a pull or exchange (admin job
+#                          events don't make anyone active); rollup_active holds the players
+#                          already counted for recent buckets, so each one is counted once
+#   rollup_state           id of the last event folded in, per shard (see User Data Shards)
+# update_rollups() folds in the events logged since, ROLLUP_BATCH at a time. Each batch is one
+# short write transaction that reads only the new rows (by primary key) and adds to the counters,
+# so its cost doesn't grow with the log. A background thread per process runs it every
+# ROLLUP_INTERVAL seconds and /admin/stats catches up before answering. The rollups are in
+# DATABASE for every shard; another shard's batch is copied into a temporary table first, so that
+# shard is only read, never write-locked.
+ROLLUP_BATCH = 2000 # events folded in per transaction (about 20ms of write lock)
+ROLLUP_BATCH_PAUSE = 0.02 # seconds the background thread leaves the write lock free between batches
+ROLLUP_INTERVAL = float(os.environ.get('NOVAFLARE_ROLLUP_INTERVAL', 10)) # seconds, 0 disables the background thread
+ROLLUP_STATS_CATCH_UP = 50 # batches /admin/stats folds in before answering, the rest is left to the thread
+ROLLUP_ACTIVE_SCOPES = {'hour': 3600 * 1000, 'day': 24 * 3600 * 1000} # bucket width in ms
+ROLLUP_ACTIVE_KEPT = {'hour': 3, 'day': 2} # buckets of rollup_active kept behind the newest event
+ROLLUP_STATS_MAX_HOURS = 24 * 31
+
+ROLLUP_FLOW_COLUMNS = tuple(f"{currency}_{flow}" for currency in CURRENCY_COLUMNS for flow in ('spent', 'earned'))
+ROLLUP_COUNTER_COLUMNS = ('events', 'rarity_3', 'rarity_4', 'rarity_5', 'duplicates') + ROLLUP_FLOW_COLUMNS
+ROLLUP_HOURLY_SQL = f'''
+    INSERT INTO rollup_hourly (hour, kind, source, {', '.join(ROLLUP_COUNTER_COLUMNS)})
+    SELECT ts / {ROLLUP_ACTIVE_SCOPES['hour']}, kind, source, count(*),
+           count(*) FILTER (WHERE rarity = 3), count(*) FILTER (WHERE rarity = 4), count(*) FILTER (WHERE rarity = 5),
+           count(*) FILTER (WHERE is_duplicate),
+           {', '.join(f"sum(max(-{currency}, 0)), sum(max({currency}, 0))" for currency in CURRENCY_COLUMNS)}
+    FROM {{events}} WHERE id > ? AND id <= ?
+    GROUP BY 1, 2, 3
+    ON CONFLICT (hour, kind, source) DO UPDATE SET
+        {', '.join(f"{column} = {column} + excluded.{column}" for column in ROLLUP_COUNTER_COLUMNS)}
+'''
+# Count the players not yet in rollup_active for their bucket, then add them
+ROLLUP_ACTIVE_COUNT_SQL = f'''
+    INSERT INTO rollup_active_counts (scope, bucket, users)
+    SELECT :scope, bucket, count(*)
+    FROM (SELECT DISTINCT ts / :width AS bucket, user_id FROM {{events}} WHERE id > :after AND id <= :until AND {PLAYER_EVENT_SQL}) AS seen
+    WHERE NOT EXISTS (SELECT 1 FROM rollup_active AS a WHERE a.scope = :scope AND a.bucket = seen.bucket AND a.user_id = seen.user_id)
+    GROUP BY bucket
+    ON CONFLICT (scope, bucket) DO UPDATE SET users = users + excluded.users
+'''
+ROLLUP_ACTIVE_SQL = f'''
+    INSERT OR IGNORE INTO rollup_active (scope, bucket, user_id)
+    SELECT DISTINCT :scope, ts / :width, user_id FROM {{events}} WHERE id > :after AND id <= :until AND {PLAYER_EVENT_SQL}
+'''
+# A batch of another shard's events, with the columns the statements above read
+ROLLUP_BATCH_COLUMNS = ('id', 'ts', 'user_id', 'kind', 'source', 'rarity', 'is_duplicate') + CURRENCY_COLUMNS
+ROLLUP_BATCH_TABLE_SQL = f"CREATE TEMP TABLE IF NOT EXISTS rollup_batch ({', '.join(ROLLUP_BATCH_COLUMNS)})"
+
+_rollup_lock = threading.Lock()
+_rollup_pid = None # process the background thread was started in
+_expected_rates = (None, {}) # (COMPILED_BANNERS, banner_type -> expected_rarity_rates())
+
+def rollup_state_name(shard):
+    # rollup_state row of a shard's cursor
+    return 'events' if shard == 0 else f'events.shard{shard}'
+
+@retry_on_contention
+def update_rollups(db_conn, batch_size=ROLLUP_BATCH, shard=0):
+    """Fold up to batch_size new events of a shard into the rollup tables, in one transaction.
+    Returns the number folded in. db_conn is a DATABASE connection."""
+    name = rollup_state_name(shard)
+    with transaction(db_conn):
+        row = db_conn.execute("SELECT last_event_id FROM rollup_state WHERE name = ?", (name,)).fetchone()
+        after_id = row[0] if row else 0
+        events = 'events'
+        if shard != 0:
+            cursor = shard_connection(db_conn, shard).cursor()
+            cursor.row_factory = None # plain tuples
+            rows = cursor.execute(f"SELECT {', '.join(ROLLUP_BATCH_COLUMNS)} FROM events WHERE id > ? ORDER BY id LIMIT ?",
+                                  (after_id, batch_size)).fetchall()
+            db_conn.execute(ROLLUP_BATCH_TABLE_SQL)
+            db_conn.execute("DELETE FROM rollup_batch")
+            db_conn.executemany(f"INSERT INTO rollup_batch VALUES ({', '.join('?' * len(ROLLUP_BATCH_COLUMNS))})", rows)
+            events = 'rollup_batch'
+        until_id, count, newest_ts = db_conn.execute(
+            f"SELECT max(id), count(*), max(ts) FROM (SELECT id, ts FROM {events} WHERE id > ? ORDER BY id LIMIT ?)",
+            (after_id, batch_size)
+        ).fetchone()
+        if not count:
+            return 0
+        db_conn.execute(ROLLUP_HOURLY_SQL.format(events=events), (after_id, until_id))
+        for scope, width in ROLLUP_ACTIVE_SCOPES.items():
+            params = {'scope': scope, 'width': width, 'after': after_id, 'until': until_id}
+            db_conn.execute(ROLLUP_ACTIVE_COUNT_SQL.format(events=events), params)
+            db_conn.execute(ROLLUP_ACTIVE_SQL.format(events=events), params)
+            # Events arrive in (nearly) time order, older buckets won't see new players again
+            db_conn.execute("DELETE FROM rollup_active WHERE scope = ? AND bucket < ?",
+                            (scope, newest_ts // width - ROLLUP_ACTIVE_KEPT[scope]))
+        db_conn.execute(
+            "INSERT INTO rollup_state (name, last_event_id) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET last_event_id = excluded.last_event_id",
+            (name, until_id)
+        )
+    return count
+
+def catch_up_rollups(db_conn, max_batches=None, batch_size=ROLLUP_BATCH, pause=0):
+    """Run update_rollups until the log is folded in (or max_batches ran). Returns the events folded in.
+
+    With a backlog (a bulk admin job logs an event per player) back-to-back batches would keep the
+    write lock from requests polling for it; pause gives them a turn between batches.
+    """
+    total = batches = 0
+    for shard in range(SHARD_COUNT):
+        while max_batches is None or batches < max_batches:
+            start = time.perf_counter()
+            count = update_rollups(db_conn, batch_size, shard)
+            total += count
+            batches += 1
+            if count < batch_size:
+                break
+            if pause:
+                time.sleep(max(pause, time.perf_counter() - start)) # at most half the time holding the lock
+    return total
+
+def start_rollup_worker():
+    global _rollup_pid
+    if ROLLUP_INTERVAL <= 0 or _rollup_pid == os.getpid():
+        return
+    with _rollup_lock:
+        if _rollup_pid != os.getpid():
+            # Like the user cache flusher, each forked worker starts its own; their batches serialize on the write lock
+            _rollup_pid = os.getpid()
+            threading.Thread(target=_rollup_loop, name='rollup-updater', daemon=True).start()
+
+def _rollup_loop():
+    db_conn = open_db_connection()
+    while True:
+        time.sleep(ROLLUP_INTERVAL)
+        try:
+            catch_up_rollups(db_conn, pause=ROLLUP_BATCH_PAUSE)
+        except Exception as e:
+            print(f"Warning: rollup update failed, retrying: {e}")
+
+def expected_rarity_rates(banner):
+    """Long-run share of pulls landing on each rarity, soft and hard pity included.
+
+    This is the stationary distribution of the (pity_4, pity_5) chain that _perform_pull walks with
+    its stream draws, so it is what the observed rates in the event log should converge to, unlike
+    the base rates in GACHA_RATES.
+    """
+    hard_4, hard_5 = banner.hard_pity_4, banner.hard_pity_5
+    low_rarities = Counter(item['rarity'] for item in banner.low)
+    states = hard_4 * hard_5 # pity_4 * hard_5 + pity_5, the counters before a pull
+    transitions = np.zeros((states, states))
+    produced = np.zeros((states, 6)) # state -> probability of each rarity on the next pull
+    for pity_4 in range(hard_4):
+        for pity_5 in range(hard_5):
+            state = pity_4 * hard_5 + pity_5
+            next_4, next_5 = pity_4 + 1, pity_5 + 1
+            if next_5 >= hard_5 - 1:
+                outcomes = [(1.0, 5)]
+            elif next_4 >= hard_4 - 1:
+                outcomes = [(1.0, 4)]
+            else:
+                rate_5, rate_4_5 = banner.rate_5[next_5], banner.rate_4_5[next_5]
+                outcomes = [(rate_5, 5), (rate_4_5 - rate_5, 4)]
+                outcomes += [((1 - rate_4_5) * count / len(banner.low), rarity) for rarity, count in low_rarities.items()]
+            for probability, rarity in outcomes:
+                if rarity == 5:
+                    after = 0
+                elif rarity == 4:
+                    after = next_5
+                else:
+                    after = next_4 * hard_5 + next_5
+                transitions[state, after] += probability
+                produced[state, rarity] += probability
+    # Solve pi = pi P with sum(pi) = 1
+    system = transitions.T - np.eye(states)
+    system[-1] = 1.0
+    target = np.zeros(states)
+    target[-1] = 1.0
+    stationary = np.linalg.solve(system, target)
+    rates = stationary @ produced
+    return {rarity: float(rates[rarity]) for rarity in (3, 4, 5)}
+
+def get_expected_rates(banner_type, banners=None):
+    """expected_rarity_rates of a banner of COMPILED_BANNERS (or of banners), cached per mapping."""
+    global _expected_rates
+    banners = COMPILED_BANNERS if banners is None else banners
+    cached_banners, rates = _expected_rates
+    if cached_banners is not banners:
+        rates = {}
+        _expected_rates = (banners, rates)
+    if banner_type not in rates and banner_type in banners:
+        rates[banner_type] = expected_rarity_rates(banners[banner_type])
+    return rates.get(banner_type)
+
+def wilson_interval(successes, trials, z=1.96):
+    """95% confidence interval for a rate observed as successes out of trials."""
+    if not trials:
+        return None
+    rate = successes / trials
+    denominator = 1 + z * z / trials
+    center = (rate + z * z / (2 * trials)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / trials + z * z / (4 * trials * trials)) / denominator
+    return [max(center - margin, 0.0), min(center + margin, 1.0)]
+
+def rollup_stats(db_conn, hours):
+    """Dashboard numbers for the last `hours` UTC hours (the current one included), from the rollup tables."""
+    hour_width, day_width = ROLLUP_ACTIVE_SCOPES['hour'], ROLLUP_ACTIVE_SCOPES['day']
+    last_hour = int(time.time() * 1000) // hour_width
+    first_hour = last_hour - hours + 1
+    hour_labels = [time.strftime('%Y-%m-%dT%H:00Z', time.gmtime(hour * hour_width // 1000))
+                   for hour in range(first_hour, last_hour + 1)]
+
+    pulls_per_hour = {}
+    exchanges_per_hour = [0] * hours
+    admin_events_per_hour = [0] * hours # players changed by bulk admin jobs
+    banners = {}
+    flows = {currency: {'spent': {}, 'earned': {}} for currency in CURRENCY_COLUMNS}
+    rows = db_conn.execute(f"SELECT hour, kind, source, {', '.join(ROLLUP_COUNTER_COLUMNS)} FROM rollup_hourly "
+                           "WHERE hour >= ? AND hour <= ?", (first_hour, last_hour))
+    for row in rows:
+        slot = row['hour'] - first_hour
+        if row['kind'] == 'pull':
+            pulls_per_hour.setdefault(row['source'], [0] * hours)[slot] += row['events']
+            totals = banners.setdefault(row['source'], Counter())
+            for column in ('events', 'rarity_3', 'rarity_4', 'rarity_5', 'duplicates'):
+                totals[column] += row[column]
+        elif row['kind'] == 'exchange':
+            exchanges_per_hour[slot] += row['events']
+        elif row['kind'] == 'admin':
+            admin_events_per_hour[slot] += row['events']
+        for currency in CURRENCY_COLUMNS:
+            for flow in ('spent', 'earned'):
+                amount = row[f"{currency}_{flow}"]
+                if amount:
+                    key = f"{row['kind']}:{row['source']}"
+                    flows[currency][flow][key] = flows[currency][flow].get(key, 0) + amount
+
+    banner_stats = {}
+    for banner_type, totals in sorted(banners.items()):
+        pulls = totals['events']
+        expected = get_expected_rates(banner_type)
+        banner_stats[banner_type] = {
+            'pulls': pulls,
+            'rarity_counts': {rarity: totals[f'rarity_{rarity}'] for rarity in (3, 4, 5)},
+            'duplicates': totals['duplicates'],
+            'five_star_rate': totals['rarity_5'] / pulls if pulls else None,
+            'five_star_rate_ci95': wilson_interval(totals['rarity_5'], pulls),
+            'expected_five_star_rate': expected[5] if expected else None, # with pity, what the observed rate converges to
+            'base_five_star_rate': GACHA_RATES[banner_type][5]['base_rate'] if banner_type in GACHA_RATES else None,
+        }
+    for currency, flow in flows.items():
+        flow['net'] = sum(flow['earned'].values()) - sum(flow['spent'].values())
+
+    active = {(row['scope'], row['bucket']): row['users'] for row in db_conn.execute(
+        "SELECT scope, bucket, users FROM rollup_active_counts WHERE (scope = 'hour' AND bucket >= ?) OR (scope = 'day' AND bucket >= ?)",
+        (first_hour, first_hour * hour_width // day_width))}
+    days = range(first_hour * hour_width // day_width, last_hour * hour_width // day_width + 1)
+
+    pending = 0
+    for shard in range(SHARD_COUNT):
+        row = db_conn.execute("SELECT last_event_id FROM rollup_state WHERE name = ?", (rollup_state_name(shard),)).fetchone()
+        newest = shard_connection(db_conn, shard).execute("SELECT max(id) FROM events").fetchone()[0] or 0
+        pending += newest - (row[0] if row else 0)
+    return {
+        'hours': hour_labels,
+        'pulls_per_hour': pulls_per_hour,
+        'exchanges_per_hour': exchanges_per_hour,
+        'admin_events_per_hour': admin_events_per_hour,
+        'active_users_per_hour': [active.get(('hour', hour), 0) for hour in range(first_hour, last_hour + 1)],
+        'active_users_per_day': [{'day': time.strftime('%Y-%m-%d', time.gmtime(day * day_width // 1000)),
+                                  'users': active.get(('day', day), 0)} for day in days],
+        'banners': banner_stats,
+        'currencies': flows,
+        'events_pending': pending,
+    }
+
+@app.cli.command('update-rollups')
+@click.option('--batch-size', default=ROLLUP_BATCH, show_default=True, help='Events folded in per transaction.')
+def update_rollups_command(batch_size):
+    """Fold every event logged so far into the dashboard rollups (e.g. from cron with NOVAFLARE_ROLLUP_INTERVAL=0)."""
+    db_conn = open_db_connection()
+    try:
+        start = time.perf_counter()
+        count = catch_up_rollups(db_conn, batch_size=batch_size)
+    finally:
+        db_conn.close()
+    click.echo(f"Folded {count} events into the rollups in {time.perf_counter() - start:.2f}s")
+
+
+# --- Pull Verification ---
+# Replays pull histories from the players' stream seeds (see Pull Streams) and checks them against
+# what is stored:
+#   item      every streamed pull resolves, from its draw, banner config and logged pity, to the
+#             logged item and rarity
+#   counter   a player's pulls used draws 0, 1, 2, ... in order, up to user_data.rng_counter; a
+#             draw used without a logged pull would be a reroll
+#   pity      each pull's logged pity follows from the pull before it on that banner (or a
+#             reset_pity job), and the last one matches the stored pity_counters
+# Pulls from before pull streams have no draw to check, but still count for pity.
+PULL_VERIFY_BATCH = 2000 # players replayed together
+PULL_VERIFY_SHOWN = 20 # mismatches listed in a report
+
+def _verify_players(db_conn, user_ids, batch_size):
+    # Batches of (user_id, rng_seed, rng_counter, pity_counters), in user_id order
+    columns = "user_id, rng_seed, rng_counter, pity_counters"
+    if user_ids is not None:
+        for start in range(0, len(user_ids), batch_size):
+            yield db_conn.execute(f"SELECT {columns} FROM user_data WHERE user_id IN (SELECT value FROM json_each(?)) "
+                                  "ORDER BY user_id", (json.dumps(user_ids[start:start + batch_size]),)).fetchall()
+        return
+    after = ''
+    while True:
+        players = db_conn.execute(f"SELECT {columns} FROM user_data WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                                  (after, batch_size)).fetchall()
+        if not players:
+            return
+        yield players
+        after = players[-1][0]
+
+def _verify_config(db_conn, configs, item_ids, config_id):
+    # banner_type -> (compiled banner, item index -> items.id), per banner_configs row
+    if config_id not in configs:
+        row = db_conn.execute("SELECT config FROM banner_configs WHERE id = ?", (config_id,)).fetchone()
+        banners = banners_from_config(json.loads(row[0])) if row else {}
+        configs[config_id] = {banner_type: (banner, np.array([item_ids.get(item['name'], -1) for item in banner.items]))
+                              for banner_type, banner in banners.items()}
+    return configs[config_id]
+
+def _reset_banners(db_conn, jobs, source):
+    # Banners a reset_pity job reset, from its source 'reset_pity#<job id>'
+    job_id = int(source.partition('#')[2])
+    if job_id not in jobs:
+        row = db_conn.execute("SELECT params FROM admin_jobs WHERE id = ?", (job_id,)).fetchone()
+        jobs[job_id] = json.loads(row[0])['banners'] if row else []
+    return jobs[job_id]
+
+def _verify_batch(db_conn, shard_conn, shard, players, item_ids, configs, jobs, report):
+    def mismatch(check, user, event_ids):
+        report['mismatches'][check] += len(event_ids)
+        for event_id in event_ids[:PULL_VERIFY_SHOWN - len(report['examples'])]:
+            report['examples'].append({'check': check, 'user_id': players[user][0],
+                                       'event_id': None if event_id is None else event_id + shard * SHARD_EVENT_ID_STRIDE})
+
+    report['players'] += len(players)
+    player_index = {row[0]: i for i, row in enumerate(players)}
+    cursor = shard_conn.cursor()
+    cursor.row_factory = None # plain tuples
+    rows = cursor.execute(
+        "SELECT id, user_id, kind, source, item_id, rarity, pity_4, pity_5, rng_counter, config_id FROM events "
+        "WHERE user_id IN (SELECT value FROM json_each(?)) AND kind IN ('pull', 'admin') ORDER BY user_id, id",
+        (json.dumps(list(player_index)),)
+    ).fetchall()
+    pulls = [row for row in rows if row[2] == 'pull']
+    resets = [(row[0], row[1], banner) for row in rows if row[2] == 'admin' and row[3].startswith('reset_pity#')
+              for banner in _reset_banners(db_conn, jobs, row[3])]
+    report['pulls'] += len(pulls)
+    if not pulls:
+        return
+    banner_codes = {}
+    for row in pulls:
+        banner_codes.setdefault(row[3], len(banner_codes))
+    for _, _, banner in resets:
+        banner_codes.setdefault(banner, len(banner_codes))
+
+    def column(values):
+        return np.array([-1 if value is None else value for value in values], dtype=np.int64)
+    event_id = column(row[0] for row in pulls)
+    user = column(player_index[row[1]] for row in pulls)
+    banner = column(banner_codes[row[3]] for row in pulls)
+    item_id, rarity, pity_4, pity_5, counter, config = (column(row[i] for row in pulls) for i in range(4, 10))
+
+    # counter: streamed pulls use draws 0, 1, 2, ... in order (events are sorted by player, then id)
+    streamed = np.flatnonzero(counter >= 0)
+    draws_used = column(row[2] for row in players)
+    s_user = user[streamed]
+    position = np.arange(streamed.size) - np.searchsorted(s_user, s_user)
+    in_range = counter[streamed] < draws_used[s_user]
+    bad = streamed[(counter[streamed] != position) | ~in_range]
+    for u in np.unique(user[bad]).tolist():
+        mismatch('counter', u, event_id[bad][user[bad] == u].tolist())
+    logged = np.bincount(s_user, minlength=len(players))
+    for u in np.flatnonzero(logged != draws_used).tolist():
+        if not np.any(user[bad] == u): # a draw used without its pull being logged
+            mismatch('counter', u, [None])
+
+    # item: recompute every streamed pull from its draw
+    replay = streamed[in_range]
+    if replay.size:
+        offsets = np.concatenate(([0], np.cumsum(draws_used)))
+        draw_index = offsets[user[replay]] + counter[replay]
+        rolls, picks = np.empty(offsets[-1]), np.empty(offsets[-1])
+        for u in np.unique(user[replay]).tolist():
+            rolls[offsets[u]:offsets[u + 1]], picks[offsets[u]:offsets[u + 1]] = pull_draws(players[u][1], 0, int(draws_used[u]))
+        banner_names = list(banner_codes)
+        for config_id, code in set(zip(config[replay].tolist(), banner[replay].tolist())):
+            group = (config[replay] == config_id) & (banner[replay] == code)
+            events = replay[group]
+            compiled = _verify_config(db_conn, configs, item_ids, config_id).get(banner_names[code])
+            if compiled is None:
+                for u in np.unique(user[events]).tolist():
+                    mismatch('item', u, event_id[events][user[events] == u].tolist())
+                continue
+            banner_table, item_map = compiled
+            got_rarity, got_index = resolve_pulls(banner_table, pity_4[events], pity_5[events],
+                                                  rolls[draw_index[group]], picks[draw_index[group]])
+            wrong = events[(got_rarity != rarity[events]) | (item_map[got_index] != item_id[events])]
+            for u in np.unique(user[wrong]).tolist():
+                mismatch('item', u, event_id[wrong][user[wrong] == u].tolist())
+        report['replayed'] += int(replay.size)
+
+    # pity: chain each (player, banner)'s pulls, a reset counting as a pull that resets both
+    if resets:
+        event_id = np.concatenate((event_id, column(row[0] for row in resets)))
+        user = np.concatenate((user, column(player_index[row[1]] for row in resets)))
+        banner = np.concatenate((banner, column(banner_codes[row[2]] for row in resets)))
+        rarity = np.concatenate((rarity, np.full(len(resets), 5)))
+        pity_4 = np.concatenate((pity_4, np.zeros(len(resets), dtype=np.int64)))
+        pity_5 = np.concatenate((pity_5, np.zeros(len(resets), dtype=np.int64)))
+    is_pull = np.arange(event_id.size) < len(pulls)
+    group = user * len(banner_codes) + banner
+    order = np.lexsort((event_id, group))
+    event_id, user, banner, group, rarity, pity_4, pity_5, is_pull = (
+        array[order] for array in (event_id, user, banner, group, rarity, pity_4, pity_5, is_pull))
+    after_5 = np.where(rarity == 5, 0, pity_5) # stored pity after each row
+    after_4 = np.where(rarity >= 4, 0, pity_4)
+    follows = np.flatnonzero((group[1:] == group[:-1]) & is_pull[1:]) + 1
+    wrong = follows[(pity_5[follows] - 1 != after_5[follows - 1]) | (pity_4[follows] - 1 != after_4[follows - 1])]
+    for u in np.unique(user[wrong]).tolist():
+        mismatch('pity', u, event_id[wrong][user[wrong] == u].tolist())
+    banner_names = list(banner_codes)
+    last = np.flatnonzero(np.append(group[1:] != group[:-1], True))
+    for i in last.tolist():
+        stored = json.loads(players[user[i]][3] or '{}').get(banner_names[banner[i]], {})
+        if (stored.get('4_star', 0), stored.get('5_star', 0)) != (after_4[i], after_5[i]):
+            mismatch('stored pity', int(user[i]), [int(event_id[i])])
+
+def verify_pulls(db_conn, user_ids=None, batch_size=PULL_VERIFY_BATCH):
+    """Replay the pull histories of user_ids (default: every player) against the event log.
+    db_conn is a DATABASE connection, the players' shards are read through shard_connection.
+
+    Returns {'players', 'pulls', 'replayed', 'mismatches': {check: count}, 'examples': [...]},
+    where examples lists the first mismatches as {'check', 'user_id', 'event_id'}.
+    """
+    report = {'players': 0, 'pulls': 0, 'replayed': 0, 'mismatches': Counter(), 'examples': []}
+    item_ids = {name: item_id for item_id, name in db_conn.execute("SELECT id, name FROM items")}
+    configs, jobs = {}, {}
+    for shard in range(SHARD_COUNT):
+        shard_conn = shard_connection(db_conn, shard)
+        shard_user_ids = None if user_ids is None else [user_id for user_id in user_ids if shard_of(user_id) == shard]
+        for players in _verify_players(shard_conn, shard_user_ids, batch_size):
+            _verify_batch(db_conn, shard_conn, shard, players, item_ids, configs, jobs, report)
+    report['mismatches'] = dict(report['mismatches'])
+    return report
+
+def replay_pull(db_conn, event_id):
+    """Recompute one logged pull from the player's seed, its draw, banner config and pity.
+
+    Returns {'event', 'replayed', 'match'}, or None if event_id isn't a pull made with a stream.
+    """
+    shard, row_id = divmod(event_id, SHARD_EVENT_ID_STRIDE)
+    if shard >= SHARD_COUNT:
+        return None
+    row = shard_connection(db_conn, shard).execute(
+        "SELECT e.id, e.user_id, e.source, e.item_id, e.rarity, e.pity_4, e.pity_5, e.rng_counter, e.config_id, u.rng_seed "
+        "FROM events AS e JOIN user_data AS u ON u.user_id = e.user_id WHERE e.id = ? AND e.kind = 'pull'",
+        (row_id,)
+    ).fetchone()
+    if row is None or row['rng_counter'] is None:
+        return None
+    config = db_conn.execute("SELECT config FROM banner_configs WHERE id = ?", (row['config_id'],)).fetchone()
+    banner = banners_from_config(json.loads(config[0]))[row['source']]
+    rolls, picks = pull_draws(row['rng_seed'], row['rng_counter'], 1)
+    rarity, index = _resolve_one(banner, row['pity_4'], row['pity_5'], float(rolls[0]), float(picks[0]))
+    item = banner.items[index]
+    item_id = db_conn.execute("SELECT id FROM items WHERE name = ?", (item['name'],)).fetchone()
+    event = {'id': event_id, **{key: row[key] for key in ('user_id', 'source', 'item_id', 'rarity', 'pity_4', 'pity_5', 'rng_counter', 'config_id')}}
+    replayed = {'item_id': item_id[0] if item_id else None, 'name': item['name'], 'rarity': rarity,
+                'roll': float(rolls[0]), 'pick': float(picks[0])}
+    return {'event': event, 'replayed': replayed,
+            'match': (replayed['item_id'], replayed['rarity']) == (event['item_id'], event['rarity'])}
+
+@app.cli.command('verify-pulls')
+@click.option('--user-id', 'user_ids', multiple=True, help='Repeatable. Default: every player.')
+@click.option('--batch-size', default=PULL_VERIFY_BATCH, show_default=True, help='Players replayed together.')
+def verify_pulls_command(user_ids, batch_size):
+    """Replay pull histories from the players' stream seeds and check them against the event log."""
+    start = time.perf_counter()
+    report = verify_pulls(get_db(), list(user_ids) or None, batch_size)
+    elapsed = time.perf_counter() - start
+    click.echo(f"{report['players']} players, {report['pulls']} pulls, {report['replayed']} replayed from their streams "
+               f"in {elapsed:.1f}s ({report['pulls'] / max(elapsed, 1e-9):,.0f} pulls/s).")
+    if report['mismatches']:
+        for example in report['examples']:
+            click.echo(f"  {example['check']}: user {example['user_id']} event {example['event_id']}")
+        raise click.ClickException(f"mismatches: {report['mismatches']}")
+    click.echo("Everything matches.")
+
+# --- User State Cache (write-behind) ---
+# Optional, set NOVAFLARE_USER_CACHE to turn it on. Hot players stay resident (LRU) so requests
+# don't re-read and re-decode their row, and pulls/exchanges are applied to the cached copy:
+#   sync     - reads come from the cache, every write still commits before the response
+#   group    - writes from many requests are batched into one transaction (per shard) every few ms, each
+#              request waits for the commit that includes it (durable, far fewer commits)
+#   interval - writes are flushed on a fixed USER_CACHE_FLUSH_INTERVAL schedule; a crash loses at
+#              most 2 intervals of acknowledged requests (when flushes fall that far behind, requests
+#              wait for the next one as in group mode), and always whole requests (user row and
+#              inventory rows together)
+# The cache lives in one process, so with the write-behind modes every request for a player must
+# reach the same process (a single worker, or workers sharded by user id).
+USER_CACHE_MODE = os.environ.get('NOVAFLARE_USER_CACHE', 'off')
+USER_CACHE_CAPACITY = int(os.environ.get('NOVAFLARE_USER_CACHE_SIZE', 10000)) # resident players
+USER_CACHE_FLUSH_INTERVAL = float(os.environ.get('NOVAFLARE_USER_CACHE_FLUSH_INTERVAL', 1.0)) # seconds, interval mode
+USER_CACHE_GROUP_COMMIT_WINDOW = 0.005 # seconds a group commit waits for more writes to join it
+USER_CACHE_FLUSH_TIMEOUT = 30.0 # seconds a group-mode request waits for its commit
+USER_JSON_FIELDS = ('pity_counters',)
+
+class CachedUser:
+    __slots__ = ('lock', 'data', 'owned_counts', 'exchange_counts', 'dirty_fields', 'pending', 'staged', 'in_use', 'generation')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = None          # last committed state, replaced (never mutated) on every save
+        self.owned_counts = None  # {item_id: copies}, loaded on first use
+        self.exchange_counts = {} # {(item, period): exchanges}, each loaded on first use
+        self.dirty_fields = set() # user_data columns changed since the last flush (under the cache's lock)
+        self.pending = []         # (sql, params) inventory writes waiting for the next flush (ditto)
+        self.staged = None        # changes of the user_transaction in progress
+        self.in_use = 0
+        self.generation = 0       # flush generation that will include this user's changes
+
+class UserStateCache:
+    def __init__(self, mode, capacity=USER_CACHE_CAPACITY, flush_interval=USER_CACHE_FLUSH_INTERVAL):
+        if mode not in ('sync', 'group', 'interval'):
+            raise ValueError(f'Unknown user cache mode: {mode}')
+        self.mode = mode
+        self.write_behind = mode != 'sync'
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.entries = OrderedDict() # user_id -> CachedUser, least recently used first
+        self.dirty = {}              # user_id -> CachedUser with unflushed changes
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.generation = 1          # generation currently collecting changes
+        self.flushed_generation = 0
+        self.unflushed_since = None  # monotonic time of the oldest change not in a flush yet
+        self.flushing_since = None   # same for the flush being written
+        self.flush_lock = threading.RLock() # held by external_update across its own flush
+        self.wake = threading.Event()
+        self.flusher = None
+        self.pid = os.getpid()
+
+    @contextmanager
+    def locked(self, user_id):
+        """Hold a player's entry (loading it if needed) so nothing else changes it meanwhile."""
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                entry = self.entries[user_id] = CachedUser()
+            self.entries.move_to_end(user_id)
+            entry.in_use += 1
+        try:
+            with entry.lock:
+                if entry.data is None:
+                    entry.data = read_user_data(user_id)
+                yield entry
+        finally:
+            with self.lock:
+                entry.in_use -= 1
+                self._evict()
+
+    def _evict(self):
+        # Only clean, idle players are dropped; dirty ones stay until they are flushed
+        excess = len(self.entries) - self.capacity
+        for user_id in list(self.entries):
+            if excess <= 0:
+                break
+            entry = self.entries[user_id]
+            if entry.in_use == 0 and user_id not in self.dirty:
+                del self.entries[user_id]
+                excess -= 1
+
+    def get(self, user_id):
+        with self.locked(user_id) as entry:
+            data = entry.staged['data'] if entry.staged and entry.staged['data'] else entry.data
+            return copy.deepcopy(data)
+
+    def owned_counts(self, db_conn, user_id):
+        with self.locked(user_id) as entry:
+            return dict(self._owned_counts(db_conn, user_id, entry))
+
+    def _owned_counts(self, db_conn, user_id, entry):
+        if entry.owned_counts is None:
+            rows = db_conn.execute("SELECT item_id, count FROM inventory_counts WHERE user_id = ?", (user_id,))
+            entry.owned_counts = {item_id: count for item_id, count in rows}
+        if entry.staged:
+            counts = dict(entry.owned_counts)
+            for item_id, count in entry.staged['counts'].items():
+                counts[item_id] = counts.get(item_id, 0) + count
+            return counts
+        return entry.owned_counts
+
+    def exchange_count(self, db_conn, user_id, item, period):
+        with self.locked(user_id) as entry:
+            key = (item, period)
+            if key not in entry.exchange_counts:
+                row = db_conn.execute(EXCHANGE_COUNT_SQL, (user_id, item, period)).fetchone()
+                entry.exchange_counts = {k: v for k, v in entry.exchange_counts.items() if k[1] == period} # drop past periods
+                entry.exchange_counts[key] = row[0] if row else 0
+            return entry.exchange_counts[key] + (entry.staged['exchanges'].get(key, 0) if entry.staged else 0)
+
+    # A user_transaction stages its changes on the entry and applies them all at the end, so a
+    # request that fails half way leaves the cache exactly as it was.
+    def begin(self, entry):
+        entry.staged = {'data': None, 'fields': set(), 'writes': [], 'counts': {}, 'exchanges': {}}
+
+    def discard(self, entry):
+        entry.staged = None
+
+    def commit(self, user_id, entry):
+        """Apply the staged changes. Returns the flush generation to wait for, or None."""
+        staged, entry.staged = entry.staged, None
+        if staged['data'] is None and not staged['writes']:
+            return None
+        if entry.owned_counts is not None:
+            for item_id, count in staged['counts'].items():
+                entry.owned_counts[item_id] = entry.owned_counts.get(item_id, 0) + count
+        for key, count in staged['exchanges'].items():
+            entry.exchange_counts[key] += count
+        if not self.write_behind:
+            if staged['data'] is not None:
+                entry.data = staged['data']
+            return None
+        with self.lock:
+            # State and writes change together under self.lock, so flush() snapshots whole requests
+            # without waiting for entry locks (which busy players hand straight back to themselves)
+            if staged['data'] is not None:
+                entry.data = staged['data']
+            entry.dirty_fields |= staged['fields']
+            entry.pending.extend(staged['writes'])
+            self.dirty[user_id] = entry
+            entry.generation = self.generation
+            if self.unflushed_since is None:
+                self.unflushed_since = time.monotonic()
+        self._start_flusher()
+        if self.mode == 'group':
+            self.wake.set()
+        return entry.generation
+
+    def stage_save(self, user_id, data):
+        with self.locked(user_id) as entry:
+            current = entry.staged['data'] if entry.staged and entry.staged['data'] else entry.data
+            if data['version'] != current['version']:
+                raise ConcurrentUpdateError(f'user_data for {user_id} changed since it was read')
+            standalone = entry.staged is None
+            if standalone:
+                self.begin(entry)
+            saved = copy.deepcopy(data)
+            saved['version'] += 1
+            entry.staged['fields'].update(field for field in saved if field != 'version' and saved[field] != current.get(field))
+            entry.staged['data'] = saved
+            if standalone:
+                generation = self.commit(user_id, entry)
+        if standalone and generation is not None and self.must_wait():
+            self.wait_flushed(generation)
+
+    def stage_inventory(self, db_conn, user_id, item_ids, version):
+        with self.locked(user_id) as entry:
+            standalone = entry.staged is None
+            if standalone:
+                self.begin(entry)
+            self._owned_counts(db_conn, user_id, entry) # counts must be loaded before they move
+            counts = entry.staged['counts']
+            for item_id in item_ids:
+                counts[item_id] = counts.get(item_id, 0) + 1
+            if self.write_behind:
+                entry.staged['writes'].extend(inventory_writes(user_id, item_ids, version))
+            if standalone:
+                generation = self.commit(user_id, entry)
+        if standalone and generation is not None and self.must_wait():
+            self.wait_flushed(generation)
+
+    def stage_exchange(self, db_conn, user_id, item, period):
+        with self.locked(user_id) as entry:
+            standalone = entry.staged is None
+            if standalone:
+                self.begin(entry)
+            self.exchange_count(db_conn, user_id, item, period) # the count must be loaded before it moves
+            exchanges = entry.staged['exchanges']
+            exchanges[(item, period)] = exchanges.get((item, period), 0) + 1
+            if self.write_behind:
+                entry.staged['writes'].append((EXCHANGE_RECORD_SQL, (user_id, item, period, 1)))
+            if standalone:
+                generation = self.commit(user_id, entry)
+        if standalone and generation is not None and self.must_wait():
+            self.wait_flushed(generation)
+
+    def stage_writes(self, user_id, writes):
+        """Queue (sql, params) writes to go out with the player's next flush."""
+        with self.locked(user_id) as entry:
+            standalone = entry.staged is None
+            if standalone:
+                self.begin(entry)
+            entry.staged['writes'].extend(writes)
+            if standalone:
+                generation = self.commit(user_id, entry)
+        if standalone and generation is not None and self.must_wait():
+            self.wait_flushed(generation)
+
+    @contextmanager
+    def external_update(self, db_conn, user_ids):
+        """Hold these players' entries while their rows are changed outside the cache (bulk admin
+        jobs), then drop the cached copies so the next request re-reads them. Anything unflushed
+        is written first, so a later flush can't overwrite the change with older values."""
+        with self.lock:
+            entries = []
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry is None:
+                    entry = self.entries[user_id] = CachedUser()
+                entry.in_use += 1
+                entries.append(entry)
+        held = []
+        # flush_lock before entry locks: requests hold an entry lock, never wait for flush_lock
+        self.flush_lock.acquire()
+        try:
+            for entry in entries:
+                entry.lock.acquire()
+                held.append(entry)
+            if self.write_behind:
+                self.flush(db_conn)
+            yield
+            for entry in entries:
+                entry.data = None
+        finally:
+            for entry in held:
+                entry.lock.release()
+            self.flush_lock.release()
+            with self.lock:
+                for entry in entries:
+                    entry.in_use -= 1
+                self._evict()
+
+    def must_wait(self):
+        """Whether a request must wait for the flush of what it just committed: always in group mode,
+        and in interval mode once the oldest unwritten change is over 2 intervals old."""
+        if self.mode == 'group':
+            return True
+        if self.mode != 'interval':
+            return False
+        with self.lock:
+            oldest = self.flushing_since or self.unflushed_since
+        return oldest is not None and time.monotonic() - oldest > 2 * self.flush_interval
+
+    def wait_flushed(self, generation):
+        with self.flushed:
+            if not self.flushed.wait_for(lambda: self.flushed_generation >= generation, USER_CACHE_FLUSH_TIMEOUT):
+                raise sqlite3.OperationalError('database is locked (timed out waiting for group commit)')
+
+    def _start_flusher(self):
+        if self.flusher is None or self.pid != os.getpid():
+            with self.lock:
+                if self.flusher is None or self.pid != os.getpid():
+                    # A flusher thread doesn't survive fork(), each worker starts its own
+                    self.pid = os.getpid()
+                    self.flusher = threading.Thread(target=self._flush_loop, name='user-cache-flusher', daemon=True)
+                    self.flusher.start()
+
+    def _flush_loop(self):
+        db_conn = open_db_connection()
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            if self.mode == 'group':
+                self.wake.wait()
+                time.sleep(USER_CACHE_GROUP_COMMIT_WINDOW)
+                self.wake.clear()
+            else:
+                # On a fixed schedule, so a slow flush delays the next one less rather than pushing
+                # every later one back; one that overran its slot is followed straight away
+                time.sleep(max(0.0, next_flush - time.monotonic()))
+                next_flush = max(next_flush + self.flush_interval, time.monotonic())
+            try:
+                self.flush(db_conn)
+            except Exception as e:
+                print(f"Warning: user cache flush failed, retrying: {e}")
+                time.sleep(TRANSACTION_RETRY_DELAY)
+                self.wake.set()
+
+    def flush(self, db_conn=None):
+        """Write every dirty player, in one transaction per shard. Returns the number of players written.
+        db_conn is a DATABASE connection, default the request's."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.dirty = self.dirty, {}
+                generation = self.generation
+                self.generation += 1
+                self.flushing_since, self.unflushed_since = self.unflushed_since, None
+                snapshots = []
+                for user_id, entry in batch.items():
+                    snapshots.append((user_id, entry, sorted(entry.dirty_fields), entry.pending, entry.data))
+                    entry.dirty_fields, entry.pending = set(), []
+            if snapshots:
+                db_conn = db_conn or get_db()
+                shards = {}
+                for snapshot in snapshots:
+                    shards.setdefault(shard_of(snapshot[0]), []).append(snapshot)
+                unwritten = sorted(shards.items())
+                while unwritten:
+                    try:
+                        self._write(shard_connection(db_conn, unwritten[0][0]), unwritten[0][1])
+                    except BaseException:
+                        self._requeue([snapshot for _, shard_snapshots in unwritten for snapshot in shard_snapshots])
+                        raise
+                    unwritten.pop(0)
+            with self.flushed:
+                self.flushed_generation = generation
+                self.flushing_since = None
+                self.flushed.notify_all()
+            return len(snapshots)
+
+    def _write(self, db_conn, snapshots):
+        # Coalesce: one executemany per distinct set of changed columns and per inventory statement
+        user_updates, writes = {}, {}
+        for user_id, _, fields, pending, data in snapshots:
+            row = [json.dumps(data[f]) if f in USER_JSON_FIELDS else data[f] for f in fields]
+            user_updates.setdefault(tuple(fields), []).append(row + [data['version'], user_id])
+            for sql, params in pending:
+                writes.setdefault(sql, []).append(params)
+        with transaction(db_conn):
+            for fields, rows in user_updates.items():
+                assignments = ''.join(f"{field} = ?, " for field in fields)
+                db_conn.executemany(f"UPDATE user_data SET {assignments}version = ? WHERE user_id = ?", rows)
+            for sql, rows in writes.items():
+                db_conn.executemany(sql, rows)
+
+    def _requeue(self, snapshots):
+        # Put a failed batch back so the next flush retries it, ahead of anything newer
+        with self.lock:
+            for user_id, entry, fields, pending, _ in snapshots:
+                entry.dirty_fields.update(fields)
+                entry.pending[:0] = pending
+                self.dirty[user_id] = entry
+            self.unflushed_since, self.flushing_since = self.flushing_since, None
+
+USER_CACHE = UserStateCache(USER_CACHE_MODE) if USER_CACHE_MODE != 'off' else None
+
+@atexit.register
+def flush_user_cache():
+    """Write out everything the write-behind cache still holds (clean shutdown, before backups...)."""
+    if USER_CACHE is not None and USER_CACHE.write_behind:
+        db_conn = open_db_connection()
+        try:
+            USER_CACHE.flush(db_conn)
+        finally:
+            db_conn.close()
+
+@contextmanager
+def user_transaction(db_conn, user_id):
+    """Read-modify-write scope for one player: yields their state, save it with save_user_data_to_db.
+
+    Without the user cache this is a BEGIN IMMEDIATE transaction. With it, the player's cache entry
+    is held for the whole scope and the changes are applied (and, in group mode, committed) at the end.
+    """
+    if USER_CACHE is None:
+        with transaction(db_conn):
+            yield get_user_data_from_db(user_id)
+        return
+    generation = None
+    with USER_CACHE.locked(user_id) as entry:
+        USER_CACHE.begin(entry)
+        try:
+            if USER_CACHE.write_behind:
+                yield USER_CACHE.get(user_id)
+            else:
+                with transaction(db_conn):
+                    yield USER_CACHE.get(user_id)
+        except BaseException:
+            USER_CACHE.discard(entry)
+            raise
+        generation = USER_CACHE.commit(user_id, entry)
+    if generation is not None and USER_CACHE.must_wait():
+        USER_CACHE.wait_flushed(generation)
+
+# --- Pull and Exchange Transactions ---
+# Each pull or exchange is one user_transaction (a BEGIN IMMEDIATE transaction, or the player's held
+# cache entry with the user cache on): read the user, debit with a conditional UPDATE, apply the
+# changes and save with a version check. Concurrent requests for the same user (other threads or
+# other worker processes) queue on SQLite's write lock instead of overwriting each other's
+# balances, and a request that loses a race is retried from the start.
+def perform_pull(user_id, banner_type, num_pulls):
+    """Pull num_pulls times on a banner for a user. Returns (response payload, HTTP status)."""
+    catalog_conn = get_db()
+    ensure_item_catalog(catalog_conn) # outside the transaction, see ensure_item_catalog
+    banners, config_id = current_banner_config(catalog_conn) # same
+    return _perform_pull(get_shard_db(user_id), user_id, banners[banner_type], banner_type, config_id, num_pulls)
+
+@retry_on_contention
+def _perform_pull(db_conn, user_id, banner, banner_type, config_id, num_pulls):
+    with user_transaction(db_conn, user_id) as user:
+        cost_snc_total, cost_orb_total = get_pull_cost(banner_type, num_pulls)
+        orb_currency_type = COST_MAP[banner_type]['orb']
+
+        # Check and deduct currency, orbs first
+        if debit_currency(db_conn, user_id, user, orb_currency_type, cost_orb_total):
+            cost = {orb_currency_type: -cost_orb_total}
+        elif debit_currency(db_conn, user_id, user, 'star_night_crystals', cost_snc_total):
+            cost = {'star_night_crystals': -cost_snc_total}
+        else:
+            return {'status': 'error', 'message': 'Insufficient currency for this pull.'}, 400
+
+        pulled_items = []
+        events = []
+        ts = int(time.time() * 1000)
+        owned_counts = get_owned_counts(user_id)
+        pity_4 = user['pity_counters'].get(banner_type, {}).get('4_star', 0)
+        pity_5 = user['pity_counters'].get(banner_type, {}).get('5_star', 0)
+
+        with timed_stage('pulls'):
+            # The next draws of the player's stream; a retried transaction re-reads the counter and
+            # gets the same ones, so retries can't reroll
+            if not user['rng_seed']:
+                user['rng_seed'] = new_pull_seed() # players from before pull streams
+            counter = user['rng_counter']
+            rolls, picks = pull_draws(user['rng_seed'], counter, num_pulls)
+            user['rng_counter'] = counter + num_pulls
+            for i, (roll, pick) in enumerate(zip(rolls.tolist(), picks.tolist())):
+                pity_4 += 1
+                pity_5 += 1
+
+                _, index = _resolve_one(banner, pity_4, pity_5, roll, pick)
+                result = banner.items[index]
+                pulled_items.append(result)
+
+                item_id = get_item_id(db_conn, result)
+                is_duplicate = owned_counts.get(item_id, 0) > 0
+                changes = award_pull_rewards(user, result, is_duplicate)
+                owned_counts[item_id] = owned_counts.get(item_id, 0) + 1
+                if i == 0:
+                    for currency, amount in cost.items():
+                        changes[currency] = changes.get(currency, 0) + amount
+                events.append(make_event(ts, user_id, user['version'] + 1, 'pull', banner_type, changes,
+                                         item_id, result['rarity'], pity_4, pity_5, int(is_duplicate), counter + i, config_id))
+
+                # Reset pity counters
+                if result['rarity'] == 4:
+                    pity_4 = 0
+                if result['rarity'] == 5:
+                    pity_5 = 0
+                    pity_4 = 0 # 5-star resets 4-star pity too
+
+        # Ensure the banner_type key exists in pity_counters before assigning
+        if banner_type not in user['pity_counters']:
+            user['pity_counters'][banner_type] = {}
+        user['pity_counters'][banner_type]['4_star'] = pity_4
+        user['pity_counters'][banner_type]['5_star'] = pity_5
+
+        with timed_stage('save'):
+            add_to_inventory(db_conn, user_id, pulled_items, user['version'] + 1)
+            log_events(db_conn, user_id, events)
+            save_user_data_to_db(user_id, user)
+
+    return {
+        'status': 'success',
+        'pulled_items': pulled_items,
         'star_night_crystals': user['star_night_crystals'],
         'lumen_orbs': user['lumen_orbs'],
         'halo_orbs': user['halo_orbs'],
@@ -551,61 +3243,1661 @@ def pull_gacha():
         'orbital_jewels': user['orbital_jewels'],
         'pity_4_star': pity_4,
         'pity_5_star': pity_5
-    })
-
-@app.route('/exchange_shop', methods=['POST'])
-def exchange_shop():
-    init_data = request.headers.get('X-Telegram-Init-Data')
-    is_valid, telegram_user_id = validate_telegram_data(init_data)
-    
-    user_id_to_process = None
-    if is_valid:
-        user_id_to_process = telegram_user_id
-    elif 'user_id' in session:
-        user_id_to_process = str(session['user_id'])
-    
-    if not user_id_to_process:
-        return jsonify({'status': 'error', 'message': 'Not authenticated.'}), 401
-
-    data = request.get_json()
-    exchange_type = data.get('exchange_type')
+    }, 200
 
-    user = get_user_data_from_db(user_id_to_process)
+def perform_exchange(user_id, exchange_type):
+    """Buy a shop item for a user. Returns (response payload, HTTP status)."""
+    get_catalog()
     exchange_info = COST_MAP.get(exchange_type)
-    
-    if not exchange_info:
-        return jsonify({'status': 'error', 'message': 'Invalid exchange item.'}), 400
+    if not exchange_info or 'cost_type' not in exchange_info:
+        return {'status': 'error', 'message': 'Invalid exchange item.'}, 400
+    return _perform_exchange(get_shard_db(user_id), user_id, exchange_type, exchange_info)
 
+@retry_on_contention
+def _perform_exchange(db_conn, user_id, exchange_type, exchange_info):
     cost_type = exchange_info['cost_type']
     cost_amount = exchange_info['cost_amount']
     reward_type = exchange_info['reward_type']
     reward_amount = exchange_info['reward_amount']
     limit = exchange_info.get('limit')
 
-    if limit is not None:
-        if user['monthly_exchanges'].get(exchange_type, 0) >= limit:
-            return jsonify({'status': 'error', 'message': f'Monthly limit of {limit} reached for this item.'}), 400
+    period = exchange_period()
+    with user_transaction(db_conn, user_id) as user:
+        if limit is not None:
+            if get_exchange_count(db_conn, user_id, exchange_type, period) >= limit:
+                return {'status': 'error', 'message': f'Monthly limit of {limit} reached for this item.'}, 400
 
-    if user.get(cost_type, 0) >= cost_amount:
-        user[cost_type] -= cost_amount
+        if not debit_currency(db_conn, user_id, user, cost_type, cost_amount):
+            return {'status': 'error', 'message': f'Insufficient {cost_type.replace("_", " ").title()} to make this purchase.'}, 400
         user[reward_type] += reward_amount
-        
-        if limit is not None:
-            user['monthly_exchanges'][exchange_type] = user['monthly_exchanges'].get(exchange_type, 0) + 1
-
-        save_user_data_to_db(user_id_to_process, user)
-        return jsonify({
-            'status': 'success',
-            'message': f'Successfully purchased {reward_amount} {reward_type}.',
-            'star_night_crystals': user['star_night_crystals'],
-            'lumen_orbs': user['lumen_orbs'],
-            'halo_orbs': user['halo_orbs'],
-            'auric_crescents': user['auric_crescents'],
-            'orbital_jewels': user['orbital_jewels'] # Include new currency
+
+        with timed_stage('save'):
+            if limit is not None:
+                record_exchange(db_conn, user_id, exchange_type, period)
+            changes = {cost_type: -cost_amount}
+            changes[reward_type] = changes.get(reward_type, 0) + reward_amount
+            log_events(db_conn, user_id, [make_event(int(time.time() * 1000), user_id, user['version'] + 1,
+                                                     'exchange', exchange_type, changes)])
+            save_user_data_to_db(user_id, user)
+
+    return {
+        'status': 'success',
+        'message': f'Successfully purchased {reward_amount} {reward_type}.',
+        'star_night_crystals': user['star_night_crystals'],
+        'lumen_orbs': user['lumen_orbs'],
+        'halo_orbs': user['halo_orbs'],
+        'auric_crescents': user['auric_crescents'],
+        'orbital_jewels': user['orbital_jewels'] # Include new currency
+    }, 200
+
+# --- Rate Limits and Idempotency ---
+# Pulls and exchanges go through guarded_call(): a token bucket per (route, player) so tapping
+# faster than RATE_LIMITS allows gets 429 instead of another write transaction, and an optional
+# Idempotency-Key header so a client retrying after a dropped response gets the first response
+# back instead of pulling again. A duplicate arriving while the first is still running waits for it.
+#
+# The default 'memory' backend is per process. With several workers on one host use 'shared', a
+# small SQLite file of its own (never the game database, whose write lock this is protecting).
+RATE_LIMIT_BACKEND = os.environ.get('NOVAFLARE_RATE_LIMIT_BACKEND', 'memory') # 'memory' or 'shared'
+RATE_LIMIT_DATABASE = os.environ.get('NOVAFLARE_RATE_LIMIT_DATABASE') # shared backend file, default next to DATABASE
+# route -> (requests per second, burst); override with e.g. NOVAFLARE_RATE_LIMITS="/pull_gacha=1:5,/exchange_shop=0"
+DEFAULT_RATE_LIMITS = {'/pull_gacha': (2.0, 10), '/exchange_shop': (2.0, 10)}
+IDEMPOTENCY_TTL = 24 * 3600 # seconds a response is kept for replays
+IDEMPOTENCY_WAIT = 30.0 # seconds a duplicate waits for the original; an older in-flight claim is taken over
+IDEMPOTENCY_KEY_MAX = 128 # characters
+IDEMPOTENCY_MEMORY_MAX = 100000 # responses kept by the memory backend
+RATE_LIMIT_MEMORY_MAX = 100000 # buckets kept by the memory backend before full ones are dropped
+SHARED_LIMITS_PRUNE_INTERVAL = 60.0 # seconds between sweeps of expired rows, per process
+
+def parse_rate_limits(spec):
+    """Merge a NOVAFLARE_RATE_LIMITS spec ("/route=rate:burst,...", rate 0 to disable) into the defaults."""
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for part in filter(None, (part.strip() for part in (spec or '').split(','))):
+        route, _, value = part.partition('=')
+        rate, _, burst = value.partition(':')
+        if float(rate) <= 0:
+            limits.pop(route, None)
+        else:
+            limits[route] = (float(rate), int(burst or max(1, math.ceil(float(rate)))))
+    return limits
+
+RATE_LIMITS = parse_rate_limits(os.environ.get('NOVAFLARE_RATE_LIMITS'))
+
+RATE_LIMITED = {'status': 'error', 'message': 'Too many requests, slow down.'}
+IDEMPOTENCY_KEY_INVALID = {'status': 'error', 'message': f'Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX} characters.'}
+IDEMPOTENCY_KEY_REUSED = {'status': 'error', 'message': 'Idempotency-Key was already used for a different request.'}
+IDEMPOTENCY_IN_PROGRESS = {'status': 'error', 'message': 'The original request is still being processed, retry shortly.'}
+
+class MemoryLimits:
+    """Token buckets and stored responses in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {} # (route, user_id) -> (tokens, monotonic time)
+        self.responses = OrderedDict() # (route, user_id, key) -> [fingerprint, (payload, status) or None, done Event, expires]
+
+    def take_token(self, route, user_id, rate, burst):
+        """Spend a token. Returns 0, or the seconds until one is available."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get((route, user_id), (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[(route, user_id)] = (tokens, now)
+                return (1 - tokens) / rate
+            self.buckets[(route, user_id)] = (tokens - 1, now)
+            if len(self.buckets) > RATE_LIMIT_MEMORY_MAX:
+                self._drop_full_buckets(now)
+            return 0
+
+    def _drop_full_buckets(self, now):
+        # A bucket that has refilled is the same as no bucket
+        for key, (tokens, last) in list(self.buckets.items()):
+            rate, burst = RATE_LIMITS.get(key[0], (1.0, 1))
+            if tokens + (now - last) * rate >= burst:
+                del self.buckets[key]
+
+    def claim(self, route, user_id, key, fingerprint):
+        """('run', None) if this request should do the work, else ('replay', (payload, status)),
+        ('conflict', None) for a key reused with another body or ('busy', None) after waiting too long."""
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.responses and next(iter(self.responses.values()))[3] < now:
+                    self.responses.popitem(last=False)
+                record = self.responses.get((route, user_id, key))
+                if record is None:
+                    self.responses[(route, user_id, key)] = [fingerprint, None, threading.Event(), now + IDEMPOTENCY_TTL]
+                    while len(self.responses) > IDEMPOTENCY_MEMORY_MAX:
+                        self.responses.popitem(last=False)
+                    return 'run', None
+            if record[0] != fingerprint:
+                return 'conflict', None
+            if record[1] is not None:
+                return 'replay', record[1]
+            if not record[2].wait(deadline - time.monotonic()):
+                return 'busy', None
+            # Finished or released; look again
+
+    def finish(self, route, user_id, key, result):
+        with self.lock:
+            record = self.responses.get((route, user_id, key))
+            if record is not None:
+                record[1] = result
+        if record is not None:
+            record[2].set()
+
+    def release(self, route, user_id, key):
+        with self.lock:
+            record = self.responses.pop((route, user_id, key), None)
+        if record is not None:
+            record[2].set()
+
+class SharedLimits:
+    """Token buckets and stored responses in a SQLite file shared by the workers on one host."""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            route TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (route, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS idempotency (
+            route TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status INTEGER, -- NULL while the first request is running
+            body TEXT,
+            created REAL NOT NULL,
+            PRIMARY KEY (route, user_id, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency (created);
+    '''
+    # One statement, so concurrent workers can't both spend the last token
+    TAKE_TOKEN_SQL = '''
+        INSERT INTO rate_buckets (route, user_id, tokens, updated) VALUES (:route, :user_id, :burst - 1, :now)
+        ON CONFLICT (route, user_id) DO UPDATE SET
+            tokens = min(:burst, tokens + (:now - updated) * :rate) - 1, updated = :now
+        WHERE min(:burst, tokens + (:now - updated) * :rate) >= 1
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.pruned = 0.0
+
+    def connection(self):
+        # One per thread, and never one inherited through fork()
+        if getattr(self.local, 'pid', None) != os.getpid():
+            db_conn = sqlite3.connect(self.path, isolation_level=None, timeout=DB_BUSY_TIMEOUT)
+            # Throwaway state: losing the last moments of it on a crash is harmless
+            db_conn.execute("PRAGMA journal_mode = WAL")
+            db_conn.execute("PRAGMA synchronous = OFF")
+            db_conn.executescript(self.SCHEMA)
+            self.local.db_conn, self.local.pid = db_conn, os.getpid()
+        return self.local.db_conn
+
+    def take_token(self, route, user_id, rate, burst):
+        db_conn = self.connection()
+        now = time.time()
+        params = {'route': route, 'user_id': user_id, 'rate': rate, 'burst': burst, 'now': now}
+        if db_conn.execute(self.TAKE_TOKEN_SQL, params).rowcount:
+            self._prune(db_conn, now)
+            return 0
+        tokens, updated = db_conn.execute("SELECT tokens, updated FROM rate_buckets WHERE route = ? AND user_id = ?",
+                                          (route, user_id)).fetchone()
+        return max(0.0, (1 - tokens - (now - updated) * rate) / rate)
+
+    def _prune(self, db_conn, now):
+        if now - self.pruned < SHARED_LIMITS_PRUNE_INTERVAL:
+            return
+        self.pruned = now
+        db_conn.execute("DELETE FROM idempotency WHERE created < ?", (now - IDEMPOTENCY_TTL,))
+        for route, (rate, burst) in RATE_LIMITS.items():
+            db_conn.execute("DELETE FROM rate_buckets WHERE route = ? AND tokens + (? - updated) * ? >= ?",
+                            (route, now, rate, burst))
+
+    def claim(self, route, user_id, key, fingerprint):
+        db_conn = self.connection()
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        delay = 0.01
+        while True:
+            now = time.time()
+            inserted = db_conn.execute(
+                "INSERT OR IGNORE INTO idempotency (route, user_id, key, fingerprint, created) VALUES (?, ?, ?, ?, ?)",
+                (route, user_id, key, fingerprint, now)
+            ).rowcount
+            if inserted:
+                return 'run', None
+            row = db_conn.execute("SELECT fingerprint, status, body, created FROM idempotency WHERE route = ? AND user_id = ? AND key = ?",
+                                  (route, user_id, key)).fetchone()
+            if row is None:
+                continue # released meanwhile
+            if row[0] != fingerprint:
+                return 'conflict', None
+            if row[1] is not None:
+                return 'replay', (json.loads(row[2]), row[1])
+            if now - row[3] > IDEMPOTENCY_WAIT:
+                # The worker that claimed it died; take over if nobody else has
+                if db_conn.execute("UPDATE idempotency SET created = ? WHERE route = ? AND user_id = ? AND key = ? "
+                                   "AND status IS NULL AND created = ?", (now, route, user_id, key, row[3])).rowcount:
+                    return 'run', None
+                continue
+            if time.monotonic() >= deadline:
+                return 'busy', None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    def finish(self, route, user_id, key, result):
+        payload, status = result
+        self.connection().execute("UPDATE idempotency SET status = ?, body = ? WHERE route = ? AND user_id = ? AND key = ?",
+                                  (status, json.dumps(payload), route, user_id, key))
+
+    def release(self, route, user_id, key):
+        self.connection().execute("DELETE FROM idempotency WHERE route = ? AND user_id = ? AND key = ? AND status IS NULL",
+                                  (route, user_id, key))
+
+_limits = None
+_limits_lock = threading.Lock()
+
+def get_limits():
+    global _limits
+    if _limits is None:
+        with _limits_lock:
+            if _limits is None:
+                if RATE_LIMIT_BACKEND == 'shared':
+                    _limits = SharedLimits(RATE_LIMIT_DATABASE or os.path.splitext(DATABASE)[0] + '-limits.db')
+                elif RATE_LIMIT_BACKEND == 'memory':
+                    _limits = MemoryLimits()
+                else:
+                    raise ValueError(f'Unknown rate limit backend: {RATE_LIMIT_BACKEND}')
+    return _limits
+
+def request_fingerprint(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def guarded_call(route, user_id, idempotency_key, data, fn, *args):
+    """Run fn(*args) -> (payload, status) for a player under route's rate limit and the request's
+    Idempotency-Key (None if it sent none). data is the request body, a retry must repeat it.
+
+    Returns (payload, status, headers). Responses other than 429 and 5xx are kept for replays; for
+    those the key is released so a retry runs again.
+    """
+    limits = get_limits()
+    if idempotency_key is not None:
+        if not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX:
+            return IDEMPOTENCY_KEY_INVALID, 400, ()
+        outcome, result = limits.claim(route, user_id, idempotency_key, request_fingerprint(data))
+        if outcome == 'replay':
+            return result[0], result[1], (('Idempotent-Replayed', 'true'),)
+        if outcome == 'conflict':
+            return IDEMPOTENCY_KEY_REUSED, 422, ()
+        if outcome == 'busy':
+            return IDEMPOTENCY_IN_PROGRESS, 409, (('Retry-After', '1'),)
+
+    result, headers = None, ()
+    try:
+        limit = RATE_LIMITS.get(route)
+        retry_after = limits.take_token(route, user_id, *limit) if limit else 0
+        if retry_after:
+            result, headers = (RATE_LIMITED, 429), (('Retry-After', str(math.ceil(retry_after))),)
+        else:
+            result = fn(*args)
+    finally:
+        if idempotency_key is not None:
+            if result is not None and result[1] != 429 and result[1] < 500:
+                limits.finish(route, user_id, idempotency_key, result)
+            else:
+                limits.release(route, user_id, idempotency_key)
+    return result[0], result[1], headers
+
+# --- Bulk Admin Jobs ---
+# Grants, revokes and pity resets for every player, or those matching a filter, e.g. maintenance
+# compensation. A job is a row in admin_jobs; it runs in chunks of ADMIN_JOB_CHUNK players taken in
+# user_id order, one shard after the other (see User Data Shards). Each chunk is a few set-based
+# statements in one short write transaction on the shard that also advances the job's cursor there
+# (admin_job_progress), so a crash or restart resumes right after the last committed chunk without
+# applying anything twice; admin_jobs only shows the totals. The runner sleeps ADMIN_JOB_PAUSE
+# between chunks so live pulls get the write lock in between.
+# Currency changes are logged to the event log (kind 'admin', source '<kind>#<job id>') like any
+# other balance change. With the user cache on, chunks go through UserStateCache.external_update, so
+# jobs must run in the serving process (the runner thread does), not from the CLI.
+ADMIN_JOB_KINDS = ('grant', 'revoke', 'reset_pity')
+ADMIN_JOB_CHUNK = 2000 # players per transaction (~10-20ms of write lock)
+ADMIN_JOB_PAUSE = 0.02 # seconds between chunks
+ADMIN_JOB_POLL_INTERVAL = 5.0 # seconds the runner waits before looking for resumable jobs again
+ADMIN_JOB_USER_IDS_MAX = 100000 # explicit user_id filter size
+
+_admin_job_lock = threading.Lock()
+_admin_job_pid = None # process the runner thread was started in
+_admin_job_wake = threading.Event()
+
+def validate_admin_job(kind, params, filters):
+    """Check and normalize a job request. Returns (params, filters), raises ValueError."""
+    if kind not in ADMIN_JOB_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(ADMIN_JOB_KINDS)}")
+    if not isinstance(params, dict) or not isinstance(filters, dict):
+        raise ValueError("params and filters must be objects")
+    if kind in ('grant', 'revoke'):
+        amounts = params.get('currencies') or {}
+        if not isinstance(amounts, dict) or not amounts or any(currency not in CURRENCY_COLUMNS for currency in amounts):
+            raise ValueError(f"currencies must map some of {', '.join(CURRENCY_COLUMNS)} to amounts")
+        if any(not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0 for amount in amounts.values()):
+            raise ValueError("amounts must be positive integers")
+        params = {'currencies': {currency: amounts[currency] for currency in CURRENCY_COLUMNS if currency in amounts}}
+    else:
+        banners = params.get('banners') or list(GACHA_RATES)
+        if not isinstance(banners, list) or any(banner not in GACHA_RATES for banner in banners):
+            raise ValueError("banners must be a list of known banners")
+        params = {'banners': banners}
+
+    normalized = {}
+    if filters.get('user_ids'):
+        if not isinstance(filters['user_ids'], list):
+            raise ValueError("user_ids must be a list")
+        user_ids = sorted({str(user_id) for user_id in filters['user_ids']})
+        if len(user_ids) > ADMIN_JOB_USER_IDS_MAX:
+            raise ValueError(f"at most {ADMIN_JOB_USER_IDS_MAX} user_ids, use active_since or no filter instead")
+        normalized['user_ids'] = user_ids
+    if filters.get('active_since') is not None:
+        normalized['active_since'] = int(filters['active_since']) # epoch seconds
+    return params, normalized
+
+def _job_filter_sql(filters, active_since_id):
+    """WHERE conditions on user_data for a job's filters, and their parameters. active_since_id is
+    the shard's first event at or after filters['active_since'] (-1 if there is none)."""
+    conditions, params = [], []
+    if 'user_ids' in filters:
+        conditions.append("user_id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(filters['user_ids']))
+    if 'active_since' in filters:
+        # Players with a pull or exchange since then (an earlier job's events don't count). Event ids
+        # grow with time (except for rows a reshard moved, hence the ts check), so this is an index
+        # seek on idx_events_user per player instead of reading their whole history
+        if active_since_id < 0:
+            conditions.append("0") # nobody was active
+        else:
+            conditions.append("EXISTS (SELECT 1 FROM events WHERE events.user_id = user_data.user_id AND events.id >= ? "
+                              f"AND events.ts >= ? AND {PLAYER_EVENT_SQL})")
+            params += [active_since_id, filters['active_since'] * 1000]
+    return conditions, params
+
+def create_admin_job(db_conn, kind, params, filters, created_by=None):
+    """Queue a job and wake the runner. Returns its id."""
+    params, filters = validate_admin_job(kind, params, filters)
+    now = int(time.time())
+    with transaction(db_conn):
+        cursor = db_conn.execute(
+            "INSERT INTO admin_jobs (kind, params, filters, created_by, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, json.dumps(params), json.dumps(filters), created_by, now, now)
+        )
+    _admin_job_wake.set()
+    return cursor.lastrowid
+
+def _job_statements(job_id, kind, params, where):
+    """(sql, uses_ts) statements that apply a job to the players matching where."""
+    source = f"{kind}#{job_id}"
+    if kind == 'reset_pity':
+        # Logged too, so verify_pulls can follow pity across the reset
+        log = (f"INSERT INTO events (ts, user_id, version, kind, source) "
+               f"SELECT ?, user_id, version + 1, 'admin', '{source}' FROM user_data WHERE {where}")
+        paths = ', '.join(f"'$.\"{banner}\"', json('{{\"4_star\": 0, \"5_star\": 0}}')" for banner in params['banners'])
+        return [(log, True), (f"UPDATE user_data SET pity_counters = json_set(pity_counters, {paths}), version = version + 1 WHERE {where}", False)]
+    amounts = params['currencies']
+    if kind == 'grant':
+        deltas = [str(amounts[c]) if c in amounts else '0' for c in CURRENCY_COLUMNS]
+        assignments = [f"{c} = {c} + {amounts[c]}" for c in amounts]
+    else: # revoke, never below zero
+        deltas = [f"-min({c}, {amounts[c]})" if c in amounts else '0' for c in CURRENCY_COLUMNS]
+        assignments = [f"{c} = max({c} - {amounts[c]}, 0)" for c in amounts]
+    # Log first, from the balances before the change (amounts are validated ints, safe to inline)
+    log = (f"INSERT INTO events (ts, user_id, version, kind, source, {', '.join(CURRENCY_COLUMNS)}) "
+           f"SELECT ?, user_id, version + 1, 'admin', '{source}', {', '.join(deltas)} FROM user_data WHERE {where}")
+    update = f"UPDATE user_data SET {', '.join(assignments)}, version = version + 1 WHERE {where}"
+    return [(log, True), (update, False)]
+
+@retry_on_contention
+def run_admin_job_chunk(db_conn, job_id, chunk_size=ADMIN_JOB_CHUNK):
+    """Apply the next chunk of a job. Returns False once the job is finished (or cancelled).
+    db_conn is a DATABASE connection, shards are reached through shard_connection."""
+    job = db_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None or job['status'] not in ('pending', 'running'):
+        return False
+    filters = json.loads(job['filters'])
+    # Walk the listed players by primary key, or everyone; the other filters apply per chunk
+    walk, walk_params = "user_id > ?", []
+    if 'user_ids' in filters:
+        walk += " AND user_id IN (SELECT value FROM json_each(?))"
+        walk_params.append(json.dumps(filters['user_ids']))
+    if job['total'] is None:
+        total = sum(shard_connection(db_conn, shard).execute(f"SELECT count(*) FROM user_data WHERE {walk}", [''] + walk_params).fetchone()[0]
+                    for shard in range(SHARD_COUNT))
+        with transaction(db_conn):
+            db_conn.execute("UPDATE admin_jobs SET total = ? WHERE id = ?", (total, job_id))
+
+    # The first shard the job hasn't finished
+    for shard in range(SHARD_COUNT):
+        shard_conn = shard_connection(db_conn, shard)
+        progress = shard_conn.execute("SELECT cursor, active_since_id, done FROM admin_job_progress WHERE job_id = ?", (job_id,)).fetchone()
+        if progress is None or not progress['done']:
+            break
+    else:
+        _update_job_totals(db_conn, job_id, "'done'")
+        return False
+    job_cursor = progress['cursor'] if progress else ''
+    active_since_id = progress['active_since_id'] if progress else None
+    if 'active_since' in filters and active_since_id is None:
+        active_since_id = shard_conn.execute("SELECT min(id) FROM events WHERE ts >= ?", (filters['active_since'] * 1000,)).fetchone()[0]
+        active_since_id = active_since_id if active_since_id is not None else -1
+    conditions, filter_params = _job_filter_sql(filters, active_since_id)
+    user_ids = [row[0] for row in shard_conn.execute(
+        f"SELECT user_id FROM user_data WHERE {walk} ORDER BY user_id LIMIT ?", [job_cursor] + walk_params + [chunk_size])]
+
+    # The user cache's locks are taken before SQLite's write lock, the order its flusher uses
+    with (USER_CACHE.external_update(db_conn, user_ids) if USER_CACHE is not None else nullcontext()), transaction(shard_conn):
+        current = shard_conn.execute("SELECT cursor FROM admin_job_progress WHERE job_id = ?", (job_id,)).fetchone()
+        if (current['cursor'] if current else '') != job_cursor:
+            return True # another runner took this chunk; carry on from where it left off
+        if db_conn.execute("SELECT status FROM admin_jobs WHERE id = ?", (job_id,)).fetchone()['status'] not in ('pending', 'running'):
+            return False
+        affected = 0
+        if user_ids:
+            where = ' AND '.join(["user_id > ?", "user_id <= ?"] + conditions)
+            bounds = [job_cursor, user_ids[-1]] + filter_params
+            for sql, uses_ts in _job_statements(job_id, job['kind'], json.loads(job['params']), where):
+                cursor = shard_conn.execute(sql, ([int(time.time() * 1000)] if uses_ts else []) + bounds)
+                affected = cursor.rowcount # the last statement is the UPDATE
+        shard_conn.execute(
+            "INSERT INTO admin_job_progress (job_id, cursor, scanned, affected, active_since_id, done) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (job_id) DO UPDATE SET cursor = excluded.cursor, scanned = scanned + excluded.scanned, "
+            "affected = affected + excluded.affected, active_since_id = excluded.active_since_id, done = excluded.done",
+            (job_id, user_ids[-1] if user_ids else job_cursor, len(user_ids), affected, active_since_id, int(not user_ids))
+        )
+    _update_job_totals(db_conn, job_id, "'running'", user_ids[-1] if user_ids else None)
+    return True
+
+def _update_job_totals(db_conn, job_id, status, cursor=None):
+    # Copy the shards' progress into admin_jobs. A crash just before leaves the totals behind until
+    # the next chunk; the progress rows are what the job resumes from
+    scanned = affected = 0
+    for shard in range(SHARD_COUNT):
+        row = shard_connection(db_conn, shard).execute("SELECT scanned, affected FROM admin_job_progress WHERE job_id = ?",
+                                                       (job_id,)).fetchone()
+        if row:
+            scanned, affected = scanned + row['scanned'], affected + row['affected']
+    with transaction(db_conn):
+        db_conn.execute(f"UPDATE admin_jobs SET status = {status}, cursor = coalesce(?, cursor), scanned = ?, affected = ?, "
+                        "updated_at = ? WHERE id = ? AND status IN ('pending', 'running')",
+                        (cursor, scanned, affected, int(time.time()), job_id))
+
+def run_admin_job(db_conn, job_id, chunk_size=ADMIN_JOB_CHUNK, pause=ADMIN_JOB_PAUSE):
+    """Run a job to the end (or until it is cancelled), pausing between chunks."""
+    try:
+        while run_admin_job_chunk(db_conn, job_id, chunk_size):
+            time.sleep(pause)
+    except Exception as e:
+        with transaction(db_conn):
+            db_conn.execute("UPDATE admin_jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                            (str(e), int(time.time()), job_id))
+        raise
+
+def next_admin_job(db_conn):
+    row = db_conn.execute("SELECT id FROM admin_jobs WHERE status IN ('pending', 'running') ORDER BY id LIMIT 1").fetchone()
+    return row[0] if row else None
+
+def start_admin_job_runner():
+    global _admin_job_pid
+    if _admin_job_pid == os.getpid():
+        return
+    with _admin_job_lock:
+        if _admin_job_pid != os.getpid():
+            _admin_job_pid = os.getpid()
+            threading.Thread(target=_admin_job_loop, name='admin-job-runner', daemon=True).start()
+
+def _admin_job_loop():
+    # Also picks up jobs left 'running' by a process that died. Runners in several processes are
+    # safe: each chunk re-reads the cursor under the write lock.
+    db_conn = open_db_connection()
+    while True:
+        job_id = None
+        try:
+            job_id = next_admin_job(db_conn)
+            if job_id is not None:
+                run_admin_job(db_conn, job_id)
+                continue
+        except Exception as e:
+            print(f"Warning: admin job {job_id} failed: {e}")
+        _admin_job_wake.wait(ADMIN_JOB_POLL_INTERVAL)
+        _admin_job_wake.clear()
+
+def admin_job_status(row):
+    job = dict(row)
+    job['params'], job['filters'] = json.loads(job['params']), json.loads(job['filters'])
+    job['filters'].pop('active_since_id', None)
+    job['progress'] = 1.0 if job['status'] == 'done' else min(job['scanned'] / job['total'], 1.0) if job['total'] else 0.0
+    return job
+
+@app.cli.command('admin-job')
+@click.argument('kind', type=click.Choice(ADMIN_JOB_KINDS))
+@click.option('--currency', 'currencies', multiple=True, metavar='NAME=AMOUNT', help='For grant/revoke, repeatable.')
+@click.option('--banner', 'banners', multiple=True, help='For reset_pity, repeatable. Default: every banner.')
+@click.option('--user-id', 'user_ids', multiple=True, help='Only these players, repeatable. Default: everyone.')
+@click.option('--active-days', type=int, default=None, help='Only players with an event in the last N days.')
+@click.option('--chunk-size', default=ADMIN_JOB_CHUNK, show_default=True)
+def admin_job_command(kind, currencies, banners, user_ids, active_days, chunk_size):
+    """Create a bulk job and run it here, e.g. admin-job grant --currency halo_orbs=10."""
+    if USER_CACHE_MODE != 'off':
+        raise click.ClickException("With NOVAFLARE_USER_CACHE on, create jobs through /admin/jobs so the server runs them.")
+    params = {'banners': list(banners)} if kind == 'reset_pity' else {
+        'currencies': {name: int(amount) for name, amount in (currency.split('=', 1) for currency in currencies)}}
+    filters = {'user_ids': list(user_ids)}
+    if active_days is not None:
+        filters['active_since'] = int(time.time()) - active_days * 24 * 3600
+    db_conn = open_db_connection()
+    try:
+        try:
+            job_id = create_admin_job(db_conn, kind, params, filters, created_by='cli')
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        start = time.perf_counter()
+        run_admin_job(db_conn, job_id, chunk_size)
+        job = admin_job_status(db_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (job_id,)).fetchone())
+    finally:
+        db_conn.close()
+    click.echo(f"Job {job_id} {job['status']}: {job['affected']} of {job['scanned']} players changed in {time.perf_counter() - start:.1f}s")
+
+@app.cli.command('run-admin-jobs')
+def run_admin_jobs_command():
+    """Finish every pending or interrupted bulk job (without the user cache)."""
+    if USER_CACHE_MODE != 'off':
+        raise click.ClickException("With NOVAFLARE_USER_CACHE on, jobs resume in the server process.")
+    db_conn = open_db_connection()
+    try:
+        while (job_id := next_admin_job(db_conn)) is not None:
+            run_admin_job(db_conn, job_id)
+            click.echo(f"Job {job_id} finished")
+    finally:
+        db_conn.close()
+
+# --- Static Assets ---
+# `flask build-assets` turns static/ into static/dist/: images are re-encoded as AVIF and WebP (plus a
+# PNG, or JPEG when fully opaque, for old clients) at the widths they are shown at, text files get
+# .gz/.br copies, and every output file is named after a hash of its content. The manifest maps
+# source names to outputs; templates go through asset_url()/asset_picture()/asset_background(),
+# and /assets/ serves the outputs as immutable. Without a build the helpers fall back to /static/,
+# so a fresh checkout still works. Rendered pages are compressed once and kept (they only change
+# on deploy) and revalidated by ETag, so the HTML that references the assets stays fresh.
+ASSET_SOURCE_DIR = os.path.join(app.root_path, 'static')
+ASSET_BUILD_DIR = os.path.join(ASSET_SOURCE_DIR, 'dist')
+ASSET_MANIFEST = os.path.join(ASSET_BUILD_DIR, 'manifest.json')
+ASSET_MAX_AGE = 365 * 24 * 3600 # seconds, fingerprinted files never change
+ASSET_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+ASSET_TEXT_EXTENSIONS = ('.css', '.js', '.html', '.svg', '.json', '.txt')
+ASSET_IMAGE_FORMATS = ('avif', 'webp') # modern formats, in order of preference
+ASSET_ICON_WIDTHS = (48, 96, 160) # *_icon images are shown at 18-50 CSS px, on screens up to 3x
+ASSET_HASH_LENGTH = 12
+ASSET_ENCODE_OPTIONS = {
+    'avif': {'quality': 60, 'speed': 4},
+    'webp': {'quality': 80, 'method': 6},
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+    'png': {'optimize': True},
+}
+ASSET_EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg', 'png': 'png'}
+PAGE_COMPRESS_MIN_BYTES = 1024
+PAGE_CACHE_SIZE = 64 # compressed renderings kept per process
+
+def _write_fingerprinted(build_dir, relative_stem, extension, data):
+    """Write data as <stem>.<hash>.<ext> under build_dir and return that path relative to it."""
+    digest = hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]
+    name = f"{relative_stem}.{digest}.{extension}"
+    path = os.path.join(build_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not os.path.exists(path): # same name, same content
+        with open(path, 'wb') as f:
+            f.write(data)
+    return name.replace(os.sep, '/')
+
+def _precompress(path, data):
+    """Write .gz (and .br, with brotli installed) next to path when they are smaller. Returns the encodings."""
+    encodings = []
+    compressed = [('gzip', '.gz', lambda: gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        compressed.insert(0, ('br', '.br', lambda: brotli.compress(data, quality=11)))
+    for encoding, suffix, compress in compressed:
+        packed = compress()
+        if len(packed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(packed)
+            encodings.append(encoding)
+    return encodings
+
+def build_image(source_path, relative_stem, build_dir):
+    """Manifest entry for one image: every format at every width."""
+    from PIL import Image # build-time only
+
+    with Image.open(source_path) as image:
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    # Opaque images drop the alpha channel, which also lets the fallback be a JPEG
+    if image.mode == 'RGBA' and image.getchannel('A').getextrema()[0] == 255:
+        image = image.convert('RGB')
+    fallback = 'png' if image.mode == 'RGBA' else 'jpeg'
+
+    icon = os.path.basename(relative_stem).endswith('_icon')
+    widths = sorted({min(width, image.width) for width in ASSET_ICON_WIDTHS} if icon else {image.width})
+    variants = {fmt: {} for fmt in ASSET_IMAGE_FORMATS + (fallback,)}
+    for width in widths:
+        height = round(image.height * width / image.width)
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        for fmt in variants:
+            buffer = io.BytesIO()
+            resized.save(buffer, format=fmt.upper(), **ASSET_ENCODE_OPTIONS[fmt])
+            variants[fmt][str(width)] = _write_fingerprinted(build_dir, f"{relative_stem}-{width}", ASSET_EXTENSIONS[fmt], buffer.getvalue())
+    return {'width': image.width, 'height': image.height, 'fallback': fallback, 'variants': variants}
+
+def build_assets(source_dir=ASSET_SOURCE_DIR, build_dir=ASSET_BUILD_DIR):
+    """Build every file under source_dir into build_dir and write the manifest. Returns the manifest."""
+    manifest = {'images': {}, 'files': {}}
+    for directory, subdirectories, filenames in os.walk(source_dir):
+        if os.path.abspath(directory) == os.path.abspath(source_dir):
+            subdirectories[:] = [d for d in subdirectories if os.path.join(directory, d) != build_dir]
+        for filename in sorted(filenames):
+            source_path = os.path.join(directory, filename)
+            relative = os.path.relpath(source_path, source_dir)
+            key = relative.replace(os.sep, '/')
+            stem, extension = os.path.splitext(relative)
+            extension = extension.lower()
+            if extension in ASSET_IMAGE_EXTENSIONS:
+                manifest['images'][key] = build_image(source_path, stem, build_dir)
+                continue
+            with open(source_path, 'rb') as f:
+                data = f.read()
+            name = _write_fingerprinted(build_dir, stem, extension.lstrip('.'), data)
+            encodings = _precompress(os.path.join(build_dir, name), data) if extension in ASSET_TEXT_EXTENSIONS else []
+            manifest['files'][key] = {'file': name, 'encodings': encodings}
+
+    temporary = os.path.join(build_dir, 'manifest.json.tmp')
+    with open(temporary, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temporary, os.path.join(build_dir, 'manifest.json')) # running servers never see half a manifest
+    return manifest
+
+@app.cli.command('build-assets')
+@click.option('--clean', is_flag=True, help='Delete earlier builds first (pages cached by clients may still reference them).')
+def build_assets_command(clean):
+    """Build fingerprinted, resized and precompressed assets into static/dist."""
+    try:
+        import PIL # noqa: F401
+    except ImportError:
+        raise click.ClickException("Pillow is required to build assets: pip install Pillow")
+    if brotli is None:
+        click.echo("Warning: brotli is not installed, only gzip copies will be written.")
+    if clean and os.path.isdir(ASSET_BUILD_DIR):
+        shutil.rmtree(ASSET_BUILD_DIR)
+    os.makedirs(ASSET_BUILD_DIR, exist_ok=True)
+
+    manifest = build_assets()
+    for name, entry in manifest['images'].items():
+        source_size = os.path.getsize(os.path.join(ASSET_SOURCE_DIR, name))
+        largest = str(max(int(width) for width in entry['variants'][entry['fallback']]))
+        sizes = ", ".join(f"{fmt} {os.path.getsize(os.path.join(ASSET_BUILD_DIR, widths[largest])) / 1024:.0f} KB"
+                          for fmt, widths in entry['variants'].items())
+        click.echo(f"{name}: {source_size / 1024:.0f} KB -> {sizes} (at {largest}px)")
+    for name, entry in manifest['files'].items():
+        click.echo(f"{name}: {entry['file']} {' '.join(entry['encodings'])}")
+
+_asset_manifest = None # loaded on first use
+
+def get_asset_manifest():
+    global _asset_manifest
+    if _asset_manifest is None:
+        try:
+            with open(ASSET_MANIFEST) as f:
+                _asset_manifest = json.load(f)
+        except FileNotFoundError:
+            print("Warning: static/dist/manifest.json not found, serving unoptimized static files. Run `flask build-assets`.")
+            _asset_manifest = {'images': {}, 'files': {}}
+    return _asset_manifest
+
+def _pick_width(widths, width):
+    """The smallest built width covering width, else the largest one."""
+    available = sorted(widths, key=int)
+    if width is not None:
+        for candidate in available:
+            if int(candidate) >= width:
+                return candidate
+    return available[-1]
+
+def _srcset(widths):
+    return ", ".join(f"{url_for('assets', filename=name)} {width}w" for width, name in sorted(widths.items(), key=lambda item: int(item[0])))
+
+@app.template_global()
+def asset_url(filename, width=None, format=None):
+    """URL of a static file: the fingerprinted build when there is one, else /static/.
+
+    For images, width picks the smallest variant at least that wide and format one of
+    avif/webp (default: the PNG/JPEG fallback).
+    """
+    manifest = get_asset_manifest()
+    image = manifest['images'].get(filename)
+    if image is not None:
+        widths = image['variants'].get(format) or image['variants'][image['fallback']]
+        return url_for('assets', filename=widths[_pick_width(widths, width)])
+    entry = manifest['files'].get(filename)
+    if entry is not None:
+        return url_for('assets', filename=entry['file'])
+    return url_for('static', filename=filename)
+
+@app.template_global()
+def asset_picture(filename, alt, sizes, **attributes):
+    """<picture> offering AVIF, WebP and the fallback at every built width; sizes is the CSS display width."""
+    attributes = "".join(f' {name.rstrip("_")}="{escape(value)}"' for name, value in attributes.items()) # class_=... -> class
+    image = get_asset_manifest()['images'].get(filename)
+    if image is None:
+        return Markup(f'<img src="{escape(url_for("static", filename=filename))}" alt="{escape(alt)}"{attributes}>')
+    sources = "".join(f'<source type="image/{fmt}" srcset="{escape(_srcset(image["variants"][fmt]))}" sizes="{escape(sizes)}">'
+                      for fmt in ASSET_IMAGE_FORMATS)
+    fallback = image['variants'][image['fallback']]
+    return Markup(f'<picture>{sources}<img src="{escape(asset_url(filename))}" srcset="{escape(_srcset(fallback))}" '
+                  f'sizes="{escape(sizes)}" width="{image["width"]}" height="{image["height"]}" alt="{escape(alt)}"{attributes}></picture>')
+
+@app.template_global()
+def asset_background(filename):
+    """CSS background-image declarations: the fallback for every browser, then image-set() for those
+    that pick a format by type."""
+    fallback = asset_url(filename)
+    image = get_asset_manifest()['images'].get(filename)
+    if image is None:
+        return Markup(f"background-image: url('{fallback}');")
+    options = [f"url('{asset_url(filename, format=fmt)}') type('image/{fmt}')" for fmt in ASSET_IMAGE_FORMATS]
+    options.append(f"url('{fallback}') type('image/{image['fallback']}')")
+    return Markup(f"background-image: url('{fallback}');\n            background-image: image-set({', '.join(options)});")
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    entry_encodings = _asset_encodings().get(filename, ())
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in entry_encodings and accepted[encoding]:
+            response = send_from_directory(ASSET_BUILD_DIR, filename + suffix, max_age=ASSET_MAX_AGE,
+                                           mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(ASSET_BUILD_DIR, filename, max_age=ASSET_MAX_AGE)
+    if entry_encodings:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+_asset_encodings_by_file = None
+
+def _asset_encodings():
+    """Built file name -> encodings it has precompressed copies in."""
+    global _asset_encodings_by_file
+    if _asset_encodings_by_file is None:
+        _asset_encodings_by_file = {entry['file']: entry['encodings'] for entry in get_asset_manifest()['files'].values()}
+    return _asset_encodings_by_file
+
+_compressed_pages = OrderedDict() # (sha1 of the page, encoding) -> compressed bytes, LRU
+_compressed_pages_lock = threading.Lock()
+
+@app.after_request
+def compress_page(response):
+    """Compress rendered HTML and let clients revalidate it by ETag."""
+    if response.mimetype != 'text/html' or response.status_code != 200 or response.direct_passthrough:
+        return response
+    body = response.get_data()
+    digest = hashlib.sha1(body).hexdigest()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept-Encoding')
+
+    accepted = request.accept_encodings
+    encoding = 'br' if brotli is not None and accepted['br'] else 'gzip' if accepted['gzip'] else None
+    if encoding is not None and len(body) >= PAGE_COMPRESS_MIN_BYTES:
+        key = (digest, encoding)
+        with _compressed_pages_lock:
+            compressed = _compressed_pages.get(key)
+            if compressed is not None:
+                _compressed_pages.move_to_end(key)
+        if compressed is None:
+            compressed = brotli.compress(body, quality=11) if encoding == 'br' else gzip.compress(body, compresslevel=9, mtime=0)
+            with _compressed_pages_lock:
+                _compressed_pages[key] = compressed
+                while len(_compressed_pages) > PAGE_CACHE_SIZE:
+                    _compressed_pages.popitem(last=False)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        digest = f"{digest}-{encoding}" # each encoding is a different representation
+    response.set_etag(digest)
+    return response.make_conditional(request)
+
+# --- Catalog ---
+# /catalog is the one place clients get banners (items, rates, costs) and shop offers from, instead
+# of copies hard-coded in the templates. The payload is serialized and compressed once per config
+# version and kept in memory; pages link to /catalog?v=<version>, which never changes and is cached
+# for a year, while plain /catalog revalidates by ETag.
+#
+# The config is the module constants below unless CATALOG_FILE exists (`flask export-catalog` writes
+# the current one out as a starting point). Every process checks the file's mtime at most every
+# CATALOG_CHECK_INTERVAL seconds and reloads it in place, banners included, so a config change needs
+# no restart. A file that doesn't validate is reported and the previous config stays in use.
+CATALOG_FILE = os.environ.get('NOVAFLARE_CATALOG', os.path.join(app.root_path, 'catalog.json'))
+CATALOG_CHECK_INTERVAL = 2.0 # seconds between mtime checks, per process
+CATALOG_MAX_AGE = 60 # seconds an unversioned /catalog may be reused without revalidating
+
+# Display names and art, keyed like GACHA_POOL
+BANNER_DISPLAY = {
+    'limited_character_1': {'name': 'Limited Character 1', 'image': '/static/banner_limited_char_1.png'},
+    'limited_character_2': {'name': 'Limited Character 2', 'image': '/static/banner_limited_char_2.png'},
+    'standard_character': {'name': 'Standard Character', 'image': '/static/banner_standard_char.png'},
+    'limited_weapon_1': {'name': 'Limited Weapon 1', 'image': '/static/banner_limited_weapon_1.png'},
+    'limited_weapon_2': {'name': 'Limited Weapon 2', 'image': '/static/banner_limited_weapon_2.png'},
+    'standard_weapon': {'name': 'Standard Weapon', 'image': '/static/banner_standard_weapon.png'},
+}
+
+# Shop layout; prices and rewards come from COST_MAP
+SHOP_SECTIONS = [
+    {'id': 'orb_exchange', 'offers': [
+        {'id': 'buy_lumen_1', 'name': 'Lumen Orb x1', 'description': 'Standard pull'},
+        {'id': 'buy_lumen_10', 'name': 'Lumen Orb x10', 'description': 'Save 10%'},
+        {'id': 'buy_halo_1', 'name': 'Halo Orb x1', 'description': 'Limited pull'},
+        {'id': 'buy_halo_10', 'name': 'Halo Orb x10', 'description': 'Save 10%'},
+    ]},
+    {'id': 'auric_exchange', 'offers': [
+        {'id': 'exchange_lumen', 'name': 'Lumen Orb x1', 'description': ''},
+        {'id': 'exchange_halo', 'name': 'Halo Orb x1', 'description': ''},
+    ]},
+    {'id': 'jewel_exchange', 'offers': [
+        {'id': 'exchange_snc_with_oj', 'name': 'Star Night Crystals x1000', 'description': 'Exchange 100 Orbital Jewels.'},
+    ]},
+]
+
+CatalogPayload = namedtuple('CatalogPayload', ['version', 'body', 'encoded', 'mtime']) # encoded: {'gzip': ..., 'br': ...}
+
+_catalog = None
+_catalog_checked = 0.0 # time.monotonic() of the last mtime check
+_catalog_lock = threading.Lock()
+
+def _catalog_mtime():
+    try:
+        return os.stat(CATALOG_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def read_catalog_file(path):
+    """The config in a catalog file as (gacha_pool, gacha_rates, cost_map, banner_display, shop_sections),
+    falling back to the built-in value of anything it leaves out. Raises ValueError if it isn't valid."""
+    with open(path) as f:
+        config = json.load(f)
+    gacha_pool = config.get('gacha_pool', GACHA_POOL)
+    gacha_rates = config.get('gacha_rates', GACHA_RATES)
+    # JSON object keys are strings, rarities are ints everywhere else
+    gacha_rates = {banner: {int(rarity): rate for rarity, rate in rates.items()} for banner, rates in gacha_rates.items()}
+    cost_map = config.get('cost_map', COST_MAP)
+    banner_display = config.get('banners', BANNER_DISPLAY)
+    shop_sections = config.get('shop', SHOP_SECTIONS)
+
+    for banner_type, pool in gacha_pool.items():
+        rates = gacha_rates.get(banner_type)
+        if not rates or 5 not in rates or 4 not in rates:
+            raise ValueError(f"{banner_type}: gacha_rates needs 5 and 4-star rates")
+        if not {'base_rate', 'pity_start', 'hard_pity'} <= rates[5].keys() or not {'base_rate', 'hard_pity'} <= rates[4].keys():
+            raise ValueError(f"{banner_type}: 5-star rates need base_rate, pity_start, hard_pity; 4-star base_rate, hard_pity")
+        costs = cost_map.get(banner_type, {})
+        if not {'orb', 'snc', 'snc_multi'} <= costs.keys():
+            raise ValueError(f"{banner_type}: cost_map needs its orb currency, SNC price and 10-pull SNC price (snc_multi)")
+        for key in ('snc', 'snc_multi'):
+            if not isinstance(costs[key], int) or isinstance(costs[key], bool) or costs[key] <= 0:
+                raise ValueError(f"{banner_type}: cost_map {key} must be a positive integer")
+        if costs['snc_multi'] > 10 * costs['snc']:
+            raise ValueError(f"{banner_type}: cost_map snc_multi costs more than 10 single pulls")
+        for item in pool:
+            if not {'name', 'rarity', 'type'} <= item.keys():
+                raise ValueError(f"{banner_type}: every item needs a name, rarity and type")
+    for section in shop_sections:
+        for offer in section['offers']:
+            if 'cost_type' not in cost_map.get(offer['id'], {}):
+                raise ValueError(f"shop offer {offer['id']} has no cost_map entry")
+    return gacha_pool, gacha_rates, cost_map, banner_display, shop_sections
+
+def build_catalog_body(banners, gacha_rates, cost_map, banner_display, shop_sections):
+    """The /catalog JSON document for a config, minus its version. Reads nothing but its arguments,
+    so a new config can be checked before anything is swapped in."""
+    banner_list = []
+    for banner_type, banner in banners.items():
+        display = banner_display.get(banner_type, {})
+        costs = cost_map[banner_type]
+        expected = get_expected_rates(banner_type, banners)
+        banner_list.append({
+            'id': banner_type,
+            'name': display.get('name', banner_type),
+            'image': display.get('image'),
+            'currency': costs['orb'],
+            'cost': {'orbs_single': get_pull_cost(banner_type, 1, cost_map)[1], 'snc_single': costs['snc'],
+                     'orbs_multi': get_pull_cost(banner_type, 10, cost_map)[1], 'snc_multi': costs['snc_multi']},
+            'hard_pity_4': banner.hard_pity_4,
+            'hard_pity_5': banner.hard_pity_5,
+            'soft_pity_start': banner.soft_pity_start,
+            'base_rates': {rarity: banner_rates['base_rate'] for rarity, banner_rates in sorted(gacha_rates[banner_type].items())}
+                          if banner_type in gacha_rates else {},
+            'consolidated_rates': {rarity: round(rate, 6) for rarity, rate in expected.items() if rate}, # pity included
+            'items': [{key: item[key] for key in ('name', 'rarity', 'type', 'image', 'is_limited') if key in item}
+                      for item in banner.five_star + banner.four_star + tuple(item for item in banner.low if item['rarity'] == 3)],
         })
+    shop = [{'id': section['id'], 'offers': [dict(offer, **cost_map[offer['id']]) for offer in section['offers']]}
+            for section in shop_sections]
+    return {'banners': banner_list, 'shop': shop, 'pull_rewards': PULL_REWARDS, 'spectra_ac_reward': SPECTRA_AC_REWARD}
+
+def _load_catalog(mtime):
+    global GACHA_POOL, GACHA_RATES, COST_MAP, COMPILED_BANNERS, BANNER_DISPLAY, SHOP_SECTIONS, _catalog
+    if mtime is None:
+        _catalog = _serialize_catalog(mtime, COMPILED_BANNERS, GACHA_RATES, COST_MAP, BANNER_DISPLAY, SHOP_SECTIONS)
+        return
+    try:
+        # Everything is built from the file before anything is swapped in
+        gacha_pool, gacha_rates, cost_map, banner_display, shop_sections = read_catalog_file(CATALOG_FILE)
+        banners = compile_banners(gacha_pool, gacha_rates)
+        payload = _serialize_catalog(mtime, banners, gacha_rates, cost_map, banner_display, shop_sections)
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Warning: not loading {CATALOG_FILE}, keeping the current catalog: {e}")
+        # Remember the mtime anyway so the same broken file isn't retried until it changes
+        current = _catalog or _serialize_catalog(None, COMPILED_BANNERS, GACHA_RATES, COST_MAP, BANNER_DISPLAY, SHOP_SECTIONS)
+        _catalog = current._replace(mtime=mtime)
+        return
+    # Costs first, so a banner that just appeared is never pulled without a price
+    COST_MAP, COMPILED_BANNERS, GACHA_RATES, GACHA_POOL = cost_map, banners, gacha_rates, gacha_pool
+    BANNER_DISPLAY, SHOP_SECTIONS = banner_display, shop_sections
+    if _catalog is not None:
+        print(f"Reloaded catalog from {CATALOG_FILE}")
+    _catalog = payload
+
+def _serialize_catalog(mtime, banners, gacha_rates, cost_map, banner_display, shop_sections):
+    body = build_catalog_body(banners, gacha_rates, cost_map, banner_display, shop_sections)
+    version = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:ASSET_HASH_LENGTH]
+    data = json.dumps({'version': version, **body}, separators=(',', ':')).encode()
+    encoded = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(data, quality=11)
+    return CatalogPayload(version, data, encoded, mtime)
+
+def get_catalog():
+    """The current CatalogPayload, reloading CATALOG_FILE first if it changed."""
+    global _catalog_checked
+    now = time.monotonic()
+    if _catalog is not None and now - _catalog_checked < CATALOG_CHECK_INTERVAL:
+        return _catalog
+    with _catalog_lock:
+        if _catalog is None or now - _catalog_checked >= CATALOG_CHECK_INTERVAL:
+            _catalog_checked = now
+            mtime = _catalog_mtime()
+            if _catalog is None or mtime != _catalog.mtime:
+                _load_catalog(mtime)
+    return _catalog
+
+@app.template_global()
+def catalog_url():
+    """Versioned /catalog URL, cacheable for as long as the page that links it."""
+    return url_for('catalog', v=get_catalog().version)
+
+@app.route('/catalog')
+def catalog():
+    current = get_catalog()
+    accepted = request.accept_encodings
+    encoding = 'br' if 'br' in current.encoded and accepted['br'] else 'gzip' if accepted['gzip'] else None
+    response = app.response_class(current.encoded[encoding] if encoding else current.body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{current.version}-{encoding}" if encoding else current.version)
+    if request.args.get('v') == current.version:
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    elif 'v' in request.args:
+        # A page from before a reload: answer with the current catalog, but don't let it be cached as the old version
+        response.headers['Cache-Control'] = 'no-cache'
     else:
-        return jsonify({'status': 'error', 'message': f'Insufficient {cost_type.replace("_", " ").title()} to make this purchase.'}), 400
+        response.headers['Cache-Control'] = f'public, max-age={CATALOG_MAX_AGE}'
+    return response.make_conditional(request)
+
+@app.cli.command('export-catalog')
+@click.argument('output', default=CATALOG_FILE)
+def export_catalog_command(output):
+    """Write the catalog config in use to OUTPUT (default: the file the server reloads from)."""
+    get_catalog()
+    config = {'gacha_pool': GACHA_POOL, 'gacha_rates': GACHA_RATES, 'cost_map': COST_MAP,
+              'banners': BANNER_DISPLAY, 'shop': SHOP_SECTIONS}
+    with open(output, 'w') as f:
+        json.dump(config, f, indent=2)
+        f.write('\n')
+    click.echo(f"Wrote {output}")
+
+# --- Login Sessions ---
+# /login sessions are kept server-side: the cookie carries a random token and the session itself
+# sits in a small SQLite file shared by the workers on one host (put NOVAFLARE_SESSION_DATABASE on
+# /dev/shm for a shared-memory store that lasts until reboot). Sessions therefore work on every
+# worker and survive restarts and deploys, instead of sending everyone back through
+# check_password_hash, the most expensive request we serve. The store is keyed by a hash of the
+# token, so reading the file doesn't hand out logins.
+#
+# A session expires SESSION_LIFETIME after it was last used (its expiry is pushed back at most once
+# per SESSION_REFRESH_INTERVAL) and expired rows are pruned in passing. Each process remembers the
+# sessions it has looked up for SESSION_CACHE_TTL seconds, so most requests never touch the store;
+# the price is that a logout on one worker takes up to that long to reach the others.
+#
+# Backends: 'sqlite' (default), 'memory' (this process only, for a single worker) and 'cookie'
+# (Flask's signed cookie). The secret key is NOVAFLARE_SECRET_KEY, or one generated on first start
+# into NOVAFLARE_SECRET_KEY_FILE, so signed cookies stay valid across restarts as well.
+SESSION_BACKEND = os.environ.get('NOVAFLARE_SESSION_BACKEND', 'sqlite') # 'sqlite', 'memory' or 'cookie'
+SESSION_DATABASE = os.environ.get('NOVAFLARE_SESSION_DATABASE') # sqlite backend file, default next to DATABASE
+SECRET_KEY_FILE = os.environ.get('NOVAFLARE_SECRET_KEY_FILE') # default next to DATABASE
+SESSION_LIFETIME = app.permanent_session_lifetime # idle time before a session expires
+SESSION_CACHE_TTL = float(os.environ.get('NOVAFLARE_SESSION_CACHE_TTL', 10.0)) # seconds, 0 to always ask the store
+SESSION_CACHE_SIZE = 10000 # sessions remembered per process
+SESSION_REFRESH_INTERVAL = 3600.0 # seconds between expiry updates of a session in use
+SESSION_PRUNE_INTERVAL = 600.0 # seconds between sweeps of expired sessions, per process
+SESSION_TOKEN_BYTES = 32
+SESSION_TOKEN_MAX = 64 # characters; longer cookies aren't ours and aren't looked up
+SESSION_NOT_CACHED = object() # session_user_id(..., load=False) on a session it would have to read from the store
+SECRET_KEY_BYTES = 32
+
+def load_secret_key(path):
+    """The key in path, generated (readable by its owner only) by whichever process comes first."""
+    if not os.path.exists(path):
+        key = secrets.token_bytes(SECRET_KEY_BYTES)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        try:
+            os.link(temp_path, path) # atomic, and never replaces a key another worker wrote first
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) < SECRET_KEY_BYTES:
+        raise RuntimeError(f"{path} holds {len(key)} bytes, a secret key needs at least {SECRET_KEY_BYTES}")
+    return key
+
+app.secret_key = os.environ.get('NOVAFLARE_SECRET_KEY') or load_secret_key(SECRET_KEY_FILE or os.path.splitext(DATABASE)[0] + '.secret')
+
+class ServerSession(SecureCookieSession):
+    """A session held by a session store. token is its cookie value, None until first saved."""
+
+    def __init__(self, initial=None, token=None, expires=0.0):
+        super().__init__(initial)
+        self.token = token
+        self.expires = expires
+        self.loaded_user_id = self.get('user_id')
+
+class MemorySessionStore:
+    """Sessions in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {} # key -> (data, expires)
+        self.pruned = 0.0
+
+    def load(self, key, now):
+        found = self.sessions.get(key)
+        return found if found is not None and found[1] > now else None
+
+    def save(self, key, data, expires):
+        now = time.time()
+        with self.lock:
+            self.sessions[key] = (data, expires)
+            if now - self.pruned >= SESSION_PRUNE_INTERVAL:
+                self.pruned = now
+                for expired in [key for key, (_, expires) in self.sessions.items() if expires <= now]:
+                    del self.sessions[expired]
+
+    def touch(self, key, expires):
+        with self.lock:
+            found = self.sessions.get(key)
+            if found is not None:
+                self.sessions[key] = (found[0], expires)
+
+    def delete(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+
+class SQLiteSessionStore:
+    """Sessions in a SQLite file shared by the workers on one host."""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            key TEXT PRIMARY KEY, -- sha256 of the cookie's token
+            data TEXT NOT NULL,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.pruned = 0.0
+
+    def connection(self):
+        # One per thread, and never one inherited through fork()
+        if getattr(self.local, 'pid', None) != os.getpid():
+            db_conn = sqlite3.connect(self.path, isolation_level=None, timeout=DB_BUSY_TIMEOUT)
+            db_conn.execute("PRAGMA journal_mode = WAL")
+            db_conn.execute("PRAGMA synchronous = NORMAL")
+            db_conn.executescript(self.SCHEMA)
+            self.local.db_conn, self.local.pid = db_conn, os.getpid()
+        return self.local.db_conn
+
+    def load(self, key, now):
+        row = self.connection().execute("SELECT data, expires FROM sessions WHERE key = ? AND expires > ?", (key, now)).fetchone()
+        return (json.loads(row[0]), row[1]) if row is not None else None
+
+    def save(self, key, data, expires):
+        db_conn = self.connection()
+        db_conn.execute("INSERT INTO sessions (key, data, expires) VALUES (?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+                        (key, json.dumps(data), expires))
+        now = time.time()
+        if now - self.pruned >= SESSION_PRUNE_INTERVAL:
+            self.pruned = now
+            db_conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def touch(self, key, expires):
+        self.connection().execute("UPDATE sessions SET expires = ? WHERE key = ?", (expires, key))
+
+    def delete(self, key):
+        self.connection().execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+class ServerSessionInterface(SessionInterface):
+    """Flask sessions kept in a session store, with this process's recent lookups cached."""
+    session_class = ServerSession
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.cache = OrderedDict() # key -> (data, expires, monotonic time it was looked up)
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def lookup(self, token, load=True):
+        """(data, expires) of the live session behind a cookie token, or None. With load=False only
+        the cache is consulted, and a miss returns SESSION_NOT_CACHED instead of reading the store."""
+        if not token or len(token) > SESSION_TOKEN_MAX:
+            return None
+        key = self.key(token)
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[1] > now and time.monotonic() - cached[2] < SESSION_CACHE_TTL:
+                self.cache.move_to_end(key)
+                return cached[:2]
+        if not load:
+            return SESSION_NOT_CACHED
+        found = self.store.load(key, now)
+        with self.lock:
+            if found is None:
+                self.cache.pop(key, None)
+            else:
+                self._remember(key, *found)
+        return found
+
+    def _remember(self, key, data, expires):
+        # Under self.lock
+        self.cache[key] = (data, expires, time.monotonic())
+        self.cache.move_to_end(key)
+        while len(self.cache) > SESSION_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def forget(self, token):
+        key = self.key(token)
+        self.store.delete(key)
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def open_session(self, app, request):
+        token = request.cookies.get(self.get_cookie_name(app))
+        found = self.lookup(token)
+        if found is None:
+            return self.session_class()
+        return self.session_class(found[0], token, found[1])
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.modified and session.token is not None: # logged out
+                self.forget(session.token)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite, httponly=httponly)
+            return
+
+        now = time.time()
+        expires = now + SESSION_LIFETIME.total_seconds()
+        if session.modified:
+            if session.token is None or session.get('user_id') != session.loaded_user_id:
+                # A new login gets a new token, so one planted in the browser beforehand is worthless
+                if session.token is not None:
+                    self.forget(session.token)
+                session.token = secrets.token_urlsafe(SESSION_TOKEN_BYTES)
+            data = dict(session)
+            key = self.key(session.token)
+            self.store.save(key, data, expires)
+            with self.lock:
+                self._remember(key, data, expires)
+        elif expires - session.expires >= SESSION_REFRESH_INTERVAL:
+            key = self.key(session.token)
+            self.store.touch(key, expires)
+            with self.lock:
+                self._remember(key, dict(session), expires)
+
+        if session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.token, expires=self.get_expiration_time(app, session), httponly=httponly,
+                                domain=domain, path=path, secure=secure, samesite=samesite)
+
+def make_session_interface(backend):
+    if backend == 'sqlite':
+        return ServerSessionInterface(SQLiteSessionStore(SESSION_DATABASE or os.path.splitext(DATABASE)[0] + '-sessions.db'))
+    if backend == 'memory':
+        return ServerSessionInterface(MemorySessionStore())
+    if backend == 'cookie':
+        return SecureCookieSessionInterface()
+    raise ValueError(f'Unknown session backend: {backend}')
+
+app.session_interface = make_session_interface(SESSION_BACKEND)
+
+def session_user_id(cookie_value, load=True):
+    """user_id of the /login session a session cookie value belongs to, or None. For servers that
+    read the cookie themselves (asgi.py); Flask routes use session.get('user_id'). With load=False
+    the session store isn't read: a session that isn't cached returns SESSION_NOT_CACHED."""
+    interface = app.session_interface
+    if isinstance(interface, ServerSessionInterface):
+        found = interface.lookup(cookie_value, load)
+        if found is SESSION_NOT_CACHED:
+            return found
+        return found[0].get('user_id') if found is not None else None
+    try:
+        data = interface.get_signing_serializer(app).loads(cookie_value, max_age=int(SESSION_LIFETIME.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('user_id')
+
+# --- Authentication Routes ---
+@app.route('/login')
+def login_page():
+    return render_template('login.html')
+
+@app.route('/login', methods=['POST'])
+def login():
+    username = request.form['username']
+    password = request.form['password']
+
+    db_conn = get_db()
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+    user_row = cursor.fetchone()
+
+    if user_row and check_password_hash(user_row['password'], password):
+        session['user_id'] = user_row['id']
+        session['username'] = user_row['username']
+        session['role'] = user_row['role']
+        
+        if user_row['role'] == 'admin':
+            return redirect(url_for('admin_dashboard'))
+        else:
+            return redirect(url_for('serve_index_html')) # Redirect to home for players
+    else:
+        return render_template('login.html', error='Invalid username or password')
+
+@app.route('/logout')
+def logout():
+    session.pop('user_id', None)
+    session.pop('username', None)
+    session.pop('role', None)
+    return redirect(url_for('login_page'))
+
+# --- Admin Dashboard (Placeholder for now) ---
+@app.route('/admin')
+def admin_dashboard():
+    if 'role' not in session or session['role'] != 'admin':
+        return "Access Denied: Admins only!", 403
+    return render_template('admin.html', username=session['username'])
+
+@app.route('/admin/simulate', methods=['POST'])
+def admin_simulate():
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Request body must be a JSON object.'}), 400
+    banner_type = data.get('banner_type')
+    try:
+        players = int(data.get('players', 100000))
+        pulls = int(data.get('pulls', 180))
+        seed = None if data.get('seed') is None else int(data['seed'])
+    except (ValueError, TypeError):
+        return jsonify({'status': 'error', 'message': 'players, pulls and seed must be integers.'}), 400
+
+    if banner_type not in COMPILED_BANNERS:
+        return jsonify({'status': 'error', 'message': f'Invalid banner type: {banner_type}.'}), 400
+    if not 0 < players <= SIMULATION_MAX_PLAYERS_HTTP or not 0 < pulls <= SIMULATION_MAX_PULLS_HTTP:
+        return jsonify({'status': 'error', 'message': f'Players must be between 1 and {SIMULATION_MAX_PLAYERS_HTTP} and pulls '
+                                                      f'between 1 and {SIMULATION_MAX_PULLS_HTTP}, '
+                                                      'use the simulate-banner command for larger runs.'}), 400
+    if seed is not None and seed < 0:
+        return jsonify({'status': 'error', 'message': 'seed must not be negative.'}), 400
+
+    # In this process: forking a pool from a threaded server (rollup, job and cache threads) isn't safe
+    report = simulate_banner(banner_type, players, pulls, workers=1, seed=seed)
+    return jsonify({'status': 'success', 'report': report, 'text': format_simulation_report(report)})
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    return jsonify({'status': 'success', 'sample_rate': METRICS_SAMPLE_RATE, 'routes': METRICS.summary()})
+
+@app.route('/admin/stats')
+def admin_stats():
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    hours = min(max(request.args.get('hours', 24, type=int), 1), ROLLUP_STATS_MAX_HOURS)
+    db_conn = get_db()
+    catch_up_rollups(db_conn, ROLLUP_STATS_CATCH_UP)
+    return jsonify({'status': 'success', **rollup_stats(db_conn, hours)})
+
+@app.route('/admin/jobs', methods=['GET', 'POST'])
+def admin_jobs():
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    db_conn = get_db()
+    start_admin_job_runner() # also resumes jobs a previous process left unfinished
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({'status': 'error', 'message': 'Request body must be a JSON object.'}), 400
+        try:
+            job_id = create_admin_job(db_conn, data.get('kind'), data.get('params') or {}, data.get('filters') or {},
+                                      created_by=session.get('username'))
+        except (ValueError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        job = db_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (job_id,)).fetchone()
+        return jsonify({'status': 'success', 'job': admin_job_status(job)}), 202
+    rows = db_conn.execute("SELECT * FROM admin_jobs ORDER BY id DESC LIMIT 50")
+    return jsonify({'status': 'success', 'jobs': [admin_job_status(row) for row in rows]})
+
+@app.route('/admin/jobs/<int:job_id>/<action>', methods=['POST'])
+def admin_job_action(job_id, action):
+    """cancel stops a job after its current chunk; resume restarts a cancelled or failed one where it stopped."""
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    transitions = {'cancel': ("'cancelled'", "('pending', 'running')"), 'resume': ("'pending'", "('cancelled', 'failed')")}
+    if action not in transitions:
+        return jsonify({'status': 'error', 'message': f'Unknown action: {action}.'}), 404
+    status, from_statuses = transitions[action]
+    db_conn = get_db()
+    with transaction(db_conn):
+        changed = db_conn.execute(f"UPDATE admin_jobs SET status = {status}, error = NULL, updated_at = ? "
+                                  f"WHERE id = ? AND status IN {from_statuses}", (int(time.time()), job_id)).rowcount
+    if action == 'resume':
+        start_admin_job_runner()
+        _admin_job_wake.set()
+    job = db_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'No such job.'}), 404
+    if not changed:
+        return jsonify({'status': 'error', 'message': f"Job is {job['status']}.", 'job': admin_job_status(job)}), 409
+    return jsonify({'status': 'success', 'job': admin_job_status(job)})
+
+@app.route('/admin/pulls/verify')
+def admin_verify_pulls():
+    """Replay one player's whole pull history (?user_id=) against the event log, for support tickets."""
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'status': 'error', 'message': 'user_id is required.'}), 400
+    report = verify_pulls(get_db(), [user_id])
+    return jsonify({'status': 'success', 'user_id': user_id, 'verified': not report['mismatches'], **report})
+
+@app.route('/admin/pulls/<int:event_id>')
+def admin_replay_pull(event_id):
+    """Recompute a single logged pull, e.g. the one a player disputes."""
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    replay = replay_pull(get_db(), event_id)
+    if replay is None:
+        return jsonify({'status': 'error', 'message': 'No pull with a stream draw has that event id.'}), 404
+    return jsonify({'status': 'success', **replay})
+
+@app.route('/admin/events.csv')
+def admin_events_csv():
+    """Stream the event log as CSV: one player's for support tickets, or everything after an id
+    (of one shard with ?shard=, see User Data Shards)."""
+    if 'role' not in session or session['role'] != 'admin':
+        return jsonify({'status': 'error', 'message': 'Access Denied: Admins only!'}), 403
+    user_id = request.args.get('user_id') or None
+    after_id = request.args.get('after_id', 0, type=int)
+    shard = request.args.get('shard', type=int)
+    if shard is not None and not 0 <= shard < shard_count():
+        return jsonify({'status': 'error', 'message': f'There are {SHARD_COUNT} shards.'}), 400
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('id',) + EVENT_COLUMNS)
+        for _, _, rows in iter_all_event_batches(after_id, user_id, EVENT_HTTP_BATCH, None if shard is None else [shard]):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    safe_user_id = ''.join(c for c in user_id or '' if c.isalnum() or c in '-_')
+    filename = f"events-{safe_user_id}.csv" if safe_user_id else "events.csv"
+    return app.response_class(generate(), mimetype='text/csv',
+                              headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# --- Wire Format ---
+# The player API (/get_user_data, /pull_gacha, /exchange_shop) answers in MessagePack when the
+# Accept header prefers application/msgpack, and takes request bodies sent as application/msgpack.
+# The structure and keys are the same as the JSON. Item names dominate the payloads, so msgpack is
+# only about a fifth smaller, but it encodes 3-4x faster, which is what lets a 1000-item inventory
+# page serve nearly twice the requests/s (python bench.py wire). JSON stays the default, and
+# without the msgpack package it is the only format.
+# Stored state stays JSON: inventory and exchange limits are tables now, and the one blob left,
+# pity_counters, is a couple of hundred bytes that reset_pity jobs edit in place with json_set.
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+API_MIMETYPES = (JSON_MIMETYPE, MSGPACK_MIMETYPE) if msgpack is not None else (JSON_MIMETYPE,)
+
+def response_mimetype(accept):
+    """The API format a MIMEAccept prefers; JSON when it has no preference."""
+    return accept.best_match(API_MIMETYPES, default=JSON_MIMETYPE)
+
+def encode_payload(payload, mimetype):
+    """Response body of an API payload, byte for byte what jsonify() sends for JSON."""
+    if mimetype == MSGPACK_MIMETYPE:
+        return msgpack.packb(payload)
+    return (app.json.dumps(payload, separators=(",", ":")) + "\n").encode()
+
+def decode_msgpack_body(body):
+    """A msgpack request body as a dict, or None if it isn't a map of JSON-compatible values."""
+    try:
+        data = msgpack.unpackb(body)
+        json.dumps(data) # bin and ext values have no JSON form, and idempotency fingerprints need one
+    except (ValueError, TypeError, msgpack.UnpackException):
+        return None
+    return data if isinstance(data, dict) else None
+
+def api_response(payload, status=200, headers=()):
+    """Flask response for an API payload in the format the request asked for."""
+    mimetype = response_mimetype(request.accept_mimetypes)
+    response = app.response_class(encode_payload(payload, mimetype), status=status, headers=headers, mimetype=mimetype)
+    if len(API_MIMETYPES) > 1:
+        response.vary.add('Accept')
+    return response
+
+def request_payload():
+    """The request body of a POST to the player API: msgpack if it says so, otherwise JSON (whatever
+    the Content-Type, like asgi.py). None if it doesn't parse, so callers answer INVALID_BODY rather
+    than Werkzeug's HTML 400/415 pages."""
+    if msgpack is not None and request.mimetype == MSGPACK_MIMETYPE:
+        return decode_msgpack_body(request.get_data())
+    return request.get_json(force=True, silent=True)
+
+NOT_AUTHENTICATED = {'status': 'error', 'message': 'Not authenticated.'}
+INVALID_BODY = {'status': 'error', 'message': 'Request body must be a JSON or msgpack object.'}
+
+# --- Flask Routes (Updated to use DB functions) ---
+@app.route('/')
+def serve_index_html():
+    # If not logged in, redirect to login page
+    if 'user_id' not in session:
+        return redirect(url_for('login_page'))
+    return render_template('index.html')
+
+@app.route('/game')
+def serve_game_html():
+    if 'user_id' not in session:
+        return redirect(url_for('login_page'))
+    return render_template('game.html')
+
+@app.route('/shop')
+def serve_shop_html():
+    if 'user_id' not in session:
+        return redirect(url_for('login_page'))
+    return render_template('shop.html')
+
+def authenticate(init_data, session_user_id):
+    """The player a request acts for: verified Telegram initData first, then the login session.
+
+    Returns None when the request carries neither.
+    """
+    with timed_stage('auth'):
+        is_valid, telegram_user_id = validate_telegram_data(init_data)
+    if is_valid:
+        return telegram_user_id
+    if session_user_id is not None:
+        return str(session_user_id)
+    return None
+
+def load_user_state(user_id, args, query_string, if_none_match, mimetype=JSON_MIMETYPE):
+    """Body of /get_user_data, shared with the ASGI server.
+
+    args is a MultiDict of the query, if_none_match a werkzeug ETags, mimetype the response format
+    (each format gets its own ETag). Returns (payload, etag), with payload None when the client's
+    copy is current (304).
+    """
+    since = args.get('since', type=int)
+    cursor = args.get('cursor', 0, type=int)
+    limit = min(max(args.get('limit', INVENTORY_PAGE_SIZE, type=int), 1), INVENTORY_PAGE_SIZE_MAX)
+    include_inventory = since is not None or args.get('inventory') == '1'
+
+    user = get_user_data_from_db(user_id)
+
+    # The version changes on every write, so it identifies the state; the query picks the view of it
+    representation = f"{user_id}:{user['version']}:{query_string}" + (f":{mimetype}" if mimetype != JSON_MIMETYPE else "")
+    etag = hashlib.sha1(representation.encode()).hexdigest()
+    if if_none_match.contains_weak(etag): # If-None-Match uses weak comparison
+        return None, etag
+
+    payload = {
+        'status': 'success',
+        'user_id': user_id, # Return the ID that was actually used
+        'version': user['version'],
+        'star_night_crystals': user['star_night_crystals'],
+        'lumen_orbs': user['lumen_orbs'],
+        'halo_orbs': user['halo_orbs'],
+        'auric_crescents': user['auric_crescents'],
+        'orbital_jewels': user['orbital_jewels'], # Include new currency
+        'pity_counters': user['pity_counters'],
+    }
+    if include_inventory:
+        items, next_cursor = get_inventory_page(user_id, cursor, limit, since)
+        payload['inventory'] = items
+        payload['next_cursor'] = next_cursor
+    return payload, etag
+
+def pull_request(user_id, data):
+    """Body of /pull_gacha, shared with the ASGI server. Returns (payload, status)."""
+    get_catalog() # picks up a changed catalog file
+    pull_type = data.get('pull_type')
+    banner_type = data.get('banner_type')
+
+    # COMPILED_BANNERS, not GACHA_POOL: a banner with an empty pool isn't compiled and can't be pulled
+    if not isinstance(banner_type, str) or banner_type not in COMPILED_BANNERS:
+        return {'status': 'error', 'message': f'Invalid banner type: {banner_type}.'}, 400
+
+    num_pulls = 10 if pull_type == 'multi' else 1
+    return perform_pull(user_id, banner_type, num_pulls)
+
+@app.route('/get_user_data', methods=['GET'])
+def get_user_data():
+    """Player state: currencies and pity by default, plus optionally the inventory.
+
+    Query parameters:
+        inventory=1       include a page of the inventory (oldest first)
+        since=<version>   only inventory items added after that state version (implies inventory)
+        cursor=<id>       continue from the next_cursor of the previous page
+        limit=<n>         page size (default 100, max 1000)
+    Responses carry an ETag derived from the state version, so unchanged state returns 304.
+    """
+    # For Telegram WebApp, we still validate init_data
+    user_id_to_fetch = authenticate(request.headers.get('X-Telegram-Init-Data'), session.get('user_id'))
+    if not user_id_to_fetch:
+        return api_response(NOT_AUTHENTICATED, 401)
+
+    mimetype = response_mimetype(request.accept_mimetypes)
+    payload, etag = load_user_state(user_id_to_fetch, request.args, request.query_string.decode(), request.if_none_match, mimetype)
+    response = app.response_class(status=304) if payload is None else api_response(payload)
+    response.set_etag(etag)
+    # Always revalidate, and never share a cached response between players
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(['Cookie', 'X-Telegram-Init-Data'] + (['Accept'] if len(API_MIMETYPES) > 1 else []))
+    return response
+
+@app.route('/pull_gacha', methods=['POST'])
+def pull_gacha():
+    user_id_to_process = authenticate(request.headers.get('X-Telegram-Init-Data'), session.get('user_id'))
+    if not user_id_to_process:
+        return api_response(NOT_AUTHENTICATED, 401)
+
+    data = request_payload()
+    if not isinstance(data, dict):
+        return api_response(INVALID_BODY, 400)
+    payload, status, headers = guarded_call('/pull_gacha', user_id_to_process, request.headers.get('Idempotency-Key'),
+                                            data, pull_request, user_id_to_process, data)
+    return api_response(payload, status, headers)
+
+@app.route('/exchange_shop', methods=['POST'])
+def exchange_shop():
+    user_id_to_process = authenticate(request.headers.get('X-Telegram-Init-Data'), session.get('user_id'))
+    if not user_id_to_process:
+        return api_response(NOT_AUTHENTICATED, 401)
+
+    data = request_payload()
+    if not isinstance(data, dict):
+        return api_response(INVALID_BODY, 400)
+    payload, status, headers = guarded_call('/exchange_shop', user_id_to_process, request.headers.get('Idempotency-Key'),
+                                            data, perform_exchange, user_id_to_process, data.get('exchange_type'))
+    return api_response(payload, status, headers)
 
 if __name__ == '__main__':
-    init_db() # Initialize database when running directly
+    init_db() # Migrate before the reloader forks, so only one process does it
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,327 @@
+"""ASGI serving mode for the player API.
+
+    python asgi.py                      # uvicorn with the NOVAFLARE_* settings below
+    uvicorn asgi:application ...        # or any ASGI server
+
+/get_user_data, /pull_gacha and /exchange_shop are served on the event loop: the Telegram
+initData check runs on the loop (it is a few microseconds once cached) and only the SQLite work
+goes to a bounded thread pool, so an idle or slow client holds a socket rather than a thread.
+Every other path (pages, login, admin, static files) is handed to the Flask app in the same pool.
+When the pool's queue is full new requests get 503 with Retry-After instead of piling up.
+Pulls and exchanges get the same rate limits and Idempotency-Key replays as under Flask (guarded_call),
+and all three answer in JSON or msgpack by the Accept header, as under Flask (see Wire Format in app.py).
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_cookie, parse_etags
+
+import app as novaflare
+
+flask_app = novaflare.app
+
+# --- Settings ---
+HOST = os.environ.get('NOVAFLARE_HOST', '0.0.0.0')
+PORT = int(os.environ.get('NOVAFLARE_PORT', 5000))
+WORKERS = int(os.environ.get('NOVAFLARE_WORKERS', os.cpu_count() or 1)) # processes
+KEEPALIVE = int(os.environ.get('NOVAFLARE_KEEPALIVE', 5)) # seconds an idle keep-alive connection stays open
+MAX_CONNECTIONS = int(os.environ.get('NOVAFLARE_MAX_CONNECTIONS', 2048)) # per worker, beyond that uvicorn answers 503
+BACKLOG = int(os.environ.get('NOVAFLARE_BACKLOG', 2048)) # listen() queue for connections not yet accepted
+DB_THREADS = int(os.environ.get('NOVAFLARE_DB_THREADS', novaflare.DB_POOL_SIZE or 16)) # per worker
+MAX_PENDING = int(os.environ.get('NOVAFLARE_MAX_PENDING', 512)) # per worker, DB jobs queued or running
+MAX_BODY = 64 * 1024 # bytes
+
+executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='novaflare-db')
+_pending = 0 # only touched from the event loop thread
+
+class Busy(Exception):
+    """The DB pool's queue is full."""
+
+def _in_app_context(fn, *args):
+    # get_db() keeps its pooled connection on the app context; popping it hands the connection back
+    with flask_app.app_context():
+        return fn(*args)
+
+async def run_db(fn, *args):
+    """Run fn(*args) on the DB pool inside an app context, carrying the request's context
+    variables (the metrics timer) into the worker thread."""
+    return await run_pooled(copy_context(), True, _in_app_context, fn, *args)
+
+async def run_pooled(context, admit, fn, *args):
+    """Run fn(*args) in context on the DB pool. With admit, raise Busy if the pool's queue is full;
+    without, always queue (the next chunk of a response already under way)."""
+    global _pending
+    if admit and _pending >= MAX_PENDING:
+        raise Busy()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, context.run, fn, *args)
+    finally:
+        _pending -= 1
+
+# --- Requests and responses ---
+class Request:
+    __slots__ = ('scope', 'headers', 'body')
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {}
+        for name, value in scope['headers']:
+            self.headers[name.decode('latin-1')] = value.decode('latin-1')
+
+    @property
+    def query_string(self):
+        return self.scope['query_string'].decode('latin-1')
+
+    async def session_user_id(self):
+        """user_id of the /login session in the request's cookie. Lookups are usually answered
+        from the session cache on the event loop; a miss reads the session store on the DB pool."""
+        value = parse_cookie(self.headers.get('cookie', '')).get(flask_app.config['SESSION_COOKIE_NAME'])
+        if not value:
+            return None
+        user_id = novaflare.session_user_id(value, load=False)
+        if user_id is novaflare.SESSION_NOT_CACHED:
+            user_id = await run_db(novaflare.session_user_id, value)
+        return user_id
+
+    def data(self):
+        """The object body, msgpack if the Content-Type says so and JSON otherwise, or None if it isn't one."""
+        if novaflare.msgpack is not None and self.headers.get('content-type', '').split(';')[0].strip() == novaflare.MSGPACK_MIMETYPE:
+            return novaflare.decode_msgpack_body(self.body)
+        try:
+            data = flask_app.json.loads(self.body)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def response_mimetype(self):
+        return novaflare.response_mimetype(parse_accept_header(self.headers.get('accept'), MIMEAccept))
+
+def json_body(payload):
+    return novaflare.encode_payload(payload, novaflare.JSON_MIMETYPE)
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_response(send, status, body=b'', headers=(), mimetype=novaflare.JSON_MIMETYPE):
+    raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    if body:
+        raw_headers.append((b'content-type', mimetype.encode('latin-1')))
+    if status != 304:
+        raw_headers.append((b'content-length', str(len(body)).encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+NOT_AUTHENTICATED = {'status': 'error', 'message': 'Not authenticated.'}
+INVALID_BODY = {'status': 'error', 'message': 'Request body must be a JSON or msgpack object.'}
+BUSY = {'status': 'error', 'message': 'Server busy, retry shortly.'}
+
+# --- API routes ---
+async def get_user_data(request):
+    user_id = novaflare.authenticate(request.headers.get('x-telegram-init-data'), await request.session_user_id())
+    if not user_id:
+        return NOT_AUTHENTICATED, 401, ()
+
+    args = MultiDict(parse_qsl(request.query_string, keep_blank_values=True))
+    if_none_match = parse_etags(request.headers.get('if-none-match'))
+    payload, etag = await run_db(novaflare.load_user_state, user_id, args, request.query_string, if_none_match,
+                                 request.response_mimetype())
+    headers = (('etag', f'"{etag}"'), ('cache-control', 'private, no-cache'), ('vary', 'Cookie, X-Telegram-Init-Data'))
+    return payload, 200 if payload is not None else 304, headers
+
+async def pull_gacha(request):
+    user_id = novaflare.authenticate(request.headers.get('x-telegram-init-data'), await request.session_user_id())
+    if not user_id:
+        return NOT_AUTHENTICATED, 401, ()
+    data = request.data()
+    if data is None:
+        return INVALID_BODY, 400, ()
+    return await run_db(novaflare.guarded_call, '/pull_gacha', user_id, request.headers.get('idempotency-key'),
+                        data, novaflare.pull_request, user_id, data)
+
+async def exchange_shop(request):
+    user_id = novaflare.authenticate(request.headers.get('x-telegram-init-data'), await request.session_user_id())
+    if not user_id:
+        return NOT_AUTHENTICATED, 401, ()
+    data = request.data()
+    if data is None:
+        return INVALID_BODY, 400, ()
+    return await run_db(novaflare.guarded_call, '/exchange_shop', user_id, request.headers.get('idempotency-key'),
+                        data, novaflare.perform_exchange, user_id, data.get('exchange_type'))
+
+API_ROUTES = {
+    ('GET', '/get_user_data'): get_user_data,
+    ('POST', '/pull_gacha'): pull_gacha,
+    ('POST', '/exchange_shop'): exchange_shop,
+}
+
+async def handle_api(handler, scope, body, send):
+    start = time.perf_counter()
+    # Each ASGI request runs in its own task, so these don't leak between requests
+    novaflare._request_start.set(start)
+    timer = novaflare.RequestTimer() if novaflare._metrics_rng.random() < novaflare.METRICS_SAMPLE_RATE else None
+    novaflare._request_timer.set(timer)
+
+    status = 500
+    response_body = b''
+    try:
+        request = Request(scope, body)
+        mimetype = request.response_mimetype()
+        try:
+            payload, status, headers = await handler(request)
+        except Busy:
+            payload, status, headers = BUSY, 503, (('retry-after', '1'),)
+        response_body = novaflare.encode_payload(payload, mimetype) if payload is not None else b''
+        if len(novaflare.API_MIMETYPES) > 1:
+            headers += (('vary', 'Accept'),)
+        seconds = time.perf_counter() - start
+        if timer is not None:
+            headers += (('server-timing', novaflare.server_timing(seconds, timer)),)
+        await send_response(send, status, response_body, headers, mimetype)
+    finally:
+        seconds = time.perf_counter() - start
+        if timer is None:
+            novaflare.METRICS.observe(scope['path'], status, seconds, None)
+        else:
+            novaflare.METRICS.observe(scope['path'], status, seconds, timer, len(body), len(response_body))
+
+# --- Everything else: the Flask app ---
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', PORT)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': WORKERS > 1,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'content-length':
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def start_wsgi(environ):
+    """Call the Flask app. Returns (status, headers, result, its first body chunk or None if it had none)."""
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+    result = flask_app.wsgi_app(environ, start_response)
+    return started[0], started[1], result, next_chunk(result)
+
+def next_chunk(result):
+    """The next non-empty body chunk of a WSGI result, or None once it is closed at the end."""
+    for chunk in result:
+        if chunk:
+            return chunk
+    close_wsgi(result)
+    return None
+
+def close_wsgi(result):
+    if hasattr(result, 'close'):
+        result.close()
+
+async def handle_wsgi(scope, body, send):
+    # Streamed responses (/admin/events.csv) are sent a chunk at a time, each pulled on the pool, so
+    # their size never matters. Every step runs in one context, so a generator relying on context
+    # variables sees them whichever pool thread resumes it.
+    context = copy_context()
+    try:
+        status, headers, result, chunk = await run_pooled(context, True, start_wsgi, wsgi_environ(scope, body))
+    except Busy:
+        await send_response(send, 503, json_body(BUSY), (('retry-after', '1'),))
+        return
+    try:
+        raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        while chunk is not None:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await run_pooled(context, False, next_chunk, result)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if chunk is not None: # the client went away mid-response
+            await run_pooled(context, False, close_wsgi, result)
+
+# --- Application ---
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            novaflare.start_admin_job_runner() # resumes bulk jobs an earlier process didn't finish
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Let running requests finish, then write out anything the user cache still holds
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
+            novaflare.flush_user_cache()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = await read_body(receive)
+    if body is None: # client went away, or the body is over MAX_BODY
+        await send_response(send, 413, json_body({'status': 'error', 'message': 'Request body too large.'}))
+        return
+    handler = API_ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        await handle_wsgi(scope, body, send)
+    else:
+        await handle_api(handler, scope, body, send)
+
+def main():
+    import uvicorn
+
+    # Once, here, rather than in every worker
+    novaflare.init_db()
+    workers = WORKERS
+    if workers > 1 and novaflare.USER_CACHE_MODE in ('group', 'interval'):
+        print(f"Warning: NOVAFLARE_USER_CACHE={novaflare.USER_CACHE_MODE} keeps player state in one process; running 1 worker.")
+        workers = 1
+    if workers > 1 and novaflare.SESSION_BACKEND == 'memory':
+        print("Warning: NOVAFLARE_SESSION_BACKEND=memory keeps login sessions in one worker; use 'sqlite' to share them.")
+    uvicorn.run('asgi:application', host=HOST, port=PORT, workers=workers, timeout_keep_alive=KEEPALIVE,
+                limit_concurrency=MAX_CONNECTIONS, backlog=BACKLOG, lifespan='on', access_log=False)
+
+if __name__ == '__main__':
+    main()
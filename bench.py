@@ -0,0 +1,1939 @@
+"""Micro-benchmarks for the NovaFlare backend.
+
+Usage:
+    python bench.py pulls [--pulls 200000]
+    python bench.py batch [--sequences 2000]
+    python bench.py inventory [--sizes 0,1000,10000,50000]
+    python bench.py concurrency [--threads 8 --requests 50]
+    python bench.py telegram [--calls 100000]
+    python bench.py http [--threads 8 --requests 200]
+    python bench.py serve [--servers flask-threads,asgi --connections 16,256,1024]
+    python bench.py metrics [--requests 500]
+    python bench.py cache-recovery [--modes sync,group,interval]
+    python bench.py bulk [--players 1000000 --threads 4]
+    python bench.py limits [--backends memory,shared --rate 2 --burst 10]
+    python bench.py streams [--players 300 --requests 20]
+    python bench.py shards [--shards 1,2,4,8 --workers 4 --threads 4]
+    python bench.py sessions [--accounts 20 --requests 2000]
+    python bench.py wire [--inventory 0,100,1000]
+    python bench.py startup [--runs 5 --servers flask-threads,asgi]
+    python bench.py load [--profile steady,launch,whales|all] [--concurrency 8] [--output results.json]
+    python bench.py compare baseline.json results.json [--threshold 0.15]
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import hmac
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import threading
+from collections import Counter
+from urllib.parse import quote, unquote, urlencode
+
+import numpy as np
+from werkzeug.security import generate_password_hash
+
+# Benchmarks run against a throwaway database, never the live novaflare.db
+os.environ.setdefault('NOVAFLARE_DATABASE', os.path.join(tempfile.mkdtemp(prefix='novaflare-bench-'), 'novaflare.db'))
+# and hammer single players on purpose, so without rate limits (`limits` sets its own)
+os.environ.setdefault('NOVAFLARE_RATE_LIMITS', '/pull_gacha=0,/exchange_shop=0')
+
+import app  # noqa: E402
+
+
+# --- Reference implementations (pre-optimization), kept for before/after comparisons ---
+def legacy_get_pull_result(banner_type, pity_4, pity_5):
+    pool = list(app.GACHA_POOL.get(banner_type, []))
+    if not pool:
+        return {"name": "Error", "rarity": 0, "type": "Error", "image": "error.png"}
+
+    if "character" in banner_type:
+        valid_rarities = [4, 5]
+    else:
+        valid_rarities = [3, 4, 5]
+
+    filtered_pool = [item for item in pool if item["rarity"] in valid_rarities]
+    rates = app.GACHA_RATES[banner_type]
+
+    if pity_5 >= rates[5]["hard_pity"] - 1:
+        return random.choice([item for item in filtered_pool if item["rarity"] == 5])
+    if pity_4 >= rates[4]["hard_pity"] - 1:
+        return random.choice([item for item in filtered_pool if item["rarity"] == 4])
+
+    roll = random.random()
+    roll_rate_5 = rates[5]["base_rate"]
+    if pity_5 >= rates[5]["pity_start"]:
+        roll_rate_5 += 0.05 * (pity_5 - rates[5]["pity_start"] + 1)
+
+    if roll < roll_rate_5 and 5 in valid_rarities:
+        return random.choice([item for item in filtered_pool if item["rarity"] == 5])
+    elif roll < (rates[4]["base_rate"] + roll_rate_5) and 4 in valid_rarities:
+        return random.choice([item for item in filtered_pool if item["rarity"] == 4])
+    elif 3 in valid_rarities:
+        return random.choice([item for item in filtered_pool if item["rarity"] == 3])
+    return random.choice(filtered_pool)
+
+
+def legacy_blob_pull(db_conn, user_id, banner_type):
+    """pull_gacha's DB work before the inventory table: decode every blob, append, rewrite everything."""
+    user = dict(db_conn.execute("SELECT * FROM user_data WHERE user_id = ?", (user_id,)).fetchone())
+    inventory = json.loads(user['inventory'])
+    pity_counters = json.loads(user['pity_counters'])
+    monthly_exchanges = json.loads(user['monthly_exchanges'])
+    for pull in range(1, 11):
+        inventory.append(app.get_pull_result(banner_type, pull, pull))
+    db_conn.execute(
+        "UPDATE user_data SET star_night_crystals = ?, inventory = ?, pity_counters = ?, monthly_exchanges = ? WHERE user_id = ?",
+        (user['star_night_crystals'], json.dumps(inventory), json.dumps(pity_counters), json.dumps(monthly_exchanges), user_id)
+    )
+    db_conn.commit()
+
+
+def table_pull(db_conn, user_id, banner_type):
+    """pull_gacha's DB work with the inventory table."""
+    with app.transaction(db_conn):
+        user = app.get_user_data_from_db(user_id)
+        owned_counts = app.get_owned_counts(user_id)
+        pulled_items = []
+        for pull in range(1, 11):
+            result = app.get_pull_result(banner_type, pull, pull)
+            item_id = app.get_item_id(db_conn, result)
+            app.award_pull_rewards(user, result, is_duplicate=owned_counts.get(item_id, 0) > 0)
+            owned_counts[item_id] = owned_counts.get(item_id, 0) + 1
+            pulled_items.append(result)
+        app.add_to_inventory(db_conn, user_id, pulled_items, user['version'] + 1)
+        app.save_user_data_to_db(user_id, user)
+
+
+def legacy_validate_telegram_data(init_data):
+    """validate_telegram_data before the key/result caching, minus the log prints."""
+    params = {k: unquote(v) for k, v in [p.split('=') for p in init_data.split('&')]}
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()) if k != 'hash')
+    secret_key = hmac.new(b"WebAppData", app.BOT_TOKEN.encode(), hashlib.sha256).digest()
+    calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if calculated_hash == params['hash']:
+        return True, str(json.loads(params.get('user', '{}')).get('id'))
+    return False, None
+
+
+# --- Helpers ---
+def run_pulls(pull_fn, banner_type, num_pulls):
+    # Same pity bookkeeping as pull_gacha, so hard/soft pity paths are exercised realistically
+    pity_4 = pity_5 = 0
+    for _ in range(num_pulls):
+        pity_4 += 1
+        pity_5 += 1
+        result = pull_fn(banner_type, pity_4, pity_5)
+        if result['rarity'] == 4:
+            pity_4 = 0
+        if result['rarity'] == 5:
+            pity_5 = 0
+            pity_4 = 0
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def chi_square_homogeneity(counts_a, counts_b):
+    """Two-sample chi-square test. Returns (statistic, degrees of freedom, p-value)."""
+    total_a, total_b = sum(counts_a.values()), sum(counts_b.values())
+    keys = set(counts_a) | set(counts_b)
+    statistic = 0.0
+    for key in keys:
+        a, b = counts_a.get(key, 0), counts_b.get(key, 0)
+        statistic += (a * math.sqrt(total_b / total_a) - b * math.sqrt(total_a / total_b)) ** 2 / (a + b)
+    dof = max(len(keys) - 1, 1)
+    # Wilson-Hilferty approximation of the chi-square survival function
+    z = ((statistic / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return statistic, dof, 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def sequential_sample(banner_type, num_pulls):
+    """pull_gacha's per-pull loop. Returns (item names, pity_5 at every 5-star, final pity)."""
+    names, five_star_pity = [], []
+    pity_4 = pity_5 = 0
+    for _ in range(num_pulls):
+        pity_4 += 1
+        pity_5 += 1
+        result = app.get_pull_result(banner_type, pity_4, pity_5)
+        names.append(result['name'])
+        if result['rarity'] == 4:
+            pity_4 = 0
+        if result['rarity'] == 5:
+            five_star_pity.append(pity_5)
+            pity_5 = 0
+            pity_4 = 0
+    return names, five_star_pity, (pity_4, pity_5)
+
+
+def batch_sample(banner_type, num_pulls, rng):
+    result = app.batch_pull(banner_type, num_pulls, rng=rng)
+    names = [item['name'] for item in result.items]
+    five_star_pity = np.diff(np.concatenate(([-1], np.flatnonzero(result.rarities == 5)))).tolist()
+    return names, five_star_pity, (result.pity_4, result.pity_5)
+
+
+def replay_draws(banner_type, num_pulls, pity_4, pity_5, seed):
+    """Resolve the same draws batch_pull makes for `seed` one pull at a time."""
+    banner = app.COMPILED_BANNERS[banner_type]
+    rng = np.random.default_rng(seed)
+    rolls, picks = rng.random(num_pulls), rng.random(num_pulls)
+    items = []
+    for roll, pick in zip(rolls.tolist(), picks.tolist()):
+        rarity, index = app._resolve_one(banner, pity_4 + 1, pity_5 + 1, roll, pick)
+        items.append(banner.items[index])
+        pity_5 = 0 if rarity == 5 else pity_5 + 1
+        pity_4 = 0 if rarity >= 4 else pity_4 + 1
+    return items, pity_4, pity_5
+
+
+def signed_init_data(user_id):
+    """Telegram initData for user_id, signed with app.BOT_TOKEN the way the Mini App client gets it."""
+    params = {'auth_date': str(int(time.time())), 'user': json.dumps({'id': user_id})}
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    secret_key = hmac.new(b"WebAppData", app.BOT_TOKEN.encode(), hashlib.sha256).digest()
+    params['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(params, quote_via=quote)
+
+
+def use_database(path, pool_size, pragmas):
+    """Point the app at a fresh database with the given connection settings."""
+    for pool in [app._db_pool] + list(app._shard_pools.values()):
+        if pool is not None:
+            pool.close()
+    app.DATABASE, app.DB_POOL_SIZE, app.SQLITE_PRAGMAS = path, pool_size, pragmas
+    app._db_pool = app._CATALOG_BANNERS = None
+    if app.USER_CACHE is not None:
+        app.USER_CACHE = app.UserStateCache(app.USER_CACHE.mode) # entries belong to the old database
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.init_db()
+
+
+# --- Benchmarks ---
+def bench_pulls(args):
+    print(f"{'banner':<22} {'legacy pulls/s':>15} {'compiled pulls/s':>17} {'speedup':>8}")
+    for banner_type in app.GACHA_POOL:
+        # Identical seeds make both implementations walk the same pity states
+        random.seed(args.seed)
+        legacy = timed(run_pulls, legacy_get_pull_result, banner_type, args.pulls)
+        random.seed(args.seed)
+        compiled = timed(run_pulls, app.get_pull_result, banner_type, args.pulls)
+        print(f"{banner_type:<22} {args.pulls / legacy:>15,.0f} {args.pulls / compiled:>17,.0f} "
+              f"{legacy / compiled:>7.2f}x")
+
+    # Sanity check: with the same seed both implementations must produce the same items
+    for banner_type in app.GACHA_POOL:
+        random.seed(args.seed)
+        expected = [legacy_get_pull_result(banner_type, p % 10, p % 90) for p in range(1, 2000)]
+        random.seed(args.seed)
+        actual = [app.get_pull_result(banner_type, p % 10, p % 90) for p in range(1, 2000)]
+        assert expected == actual, f"compiled tables diverge from legacy logic on {banner_type}"
+
+
+def bench_batch(args):
+    print(f"{'banner':<22} {'pulls':>7} {'loop ms':>9} {'batch ms':>9} {'speedup':>8}")
+    rng = np.random.default_rng(args.seed)
+    for banner_type in ('standard_character', 'standard_weapon'):
+        for num_pulls in (10, 100, 1000, 10000, 100000):
+            loop = timed(sequential_sample, banner_type, num_pulls)
+            batch = timed(app.batch_pull, banner_type, num_pulls, 0, 0, rng)
+            print(f"{banner_type:<22} {num_pulls:>7} {loop * 1e3:>9.2f} {batch * 1e3:>9.2f} {loop / batch:>7.2f}x")
+
+    # The bulk resolver must agree pull-for-pull with a one-at-a-time replay of the same draws
+    for banner_type in app.GACHA_POOL:
+        for seed in range(200):
+            pity_4, pity_5 = seed % 9, (seed * 7) % 89
+            result = app.batch_pull(banner_type, 500, pity_4, pity_5, np.random.default_rng(seed))
+            expected = replay_draws(banner_type, 500, pity_4, pity_5, seed)
+            assert (result.items, result.pity_4, result.pity_5) == expected, f"{banner_type} seed {seed}"
+
+    # Statistical equivalence: item mix, pity at which 5-stars land and the final pity state
+    print(f"\n{'banner':<22} {'check':<16} {'chi2':>9} {'dof':>4} {'p-value':>8}")
+    failures = 0
+    for banner_type in app.GACHA_POOL:
+        sequential = [Counter(), Counter(), Counter()]
+        batched = [Counter(), Counter(), Counter()]
+        random.seed(args.seed)
+        for _ in range(args.sequences):
+            for counter, values in zip(sequential, sequential_sample(banner_type, args.length)):
+                counter.update([values] if isinstance(values, tuple) else values)
+            for counter, values in zip(batched, batch_sample(banner_type, args.length, rng)):
+                counter.update([values] if isinstance(values, tuple) else values)
+        for check, counts_a, counts_b in zip(('items', '5-star pity', 'final pity'), sequential, batched):
+            statistic, dof, p_value = chi_square_homogeneity(counts_a, counts_b)
+            flag = '' if p_value > args.alpha else '  <-- distributions differ'
+            failures += bool(flag)
+            print(f"{banner_type:<22} {check:<16} {statistic:>9.1f} {dof:>4} {p_value:>8.3f}{flag}")
+    if failures:
+        raise SystemExit(f"{failures} equivalence check(s) failed at alpha={args.alpha}")
+
+
+def bench_inventory(args):
+    banner_type = 'standard_weapon'
+    pool = app.GACHA_POOL[banner_type]
+    print(f"{'inventory size':>14} {'blob ms/10-pull':>16} {'table ms/10-pull':>17}")
+    with app.app.app_context():
+        db_conn = app.get_db()
+        app.ensure_item_catalog(db_conn)
+        for size in (int(size) for size in args.sizes.split(',')):
+            items = [random.choice(pool) for _ in range(size)]
+
+            legacy_user, table_user = f'bench-blob-{size}', f'bench-table-{size}'
+            app.get_user_data_from_db(legacy_user)
+            db_conn.execute("UPDATE user_data SET inventory = ? WHERE user_id = ?", (json.dumps(items), legacy_user))
+            app.get_user_data_from_db(table_user)
+            app.add_to_inventory(db_conn, table_user, items, 0)
+
+            legacy = timed(lambda: [legacy_blob_pull(db_conn, legacy_user, banner_type) for _ in range(args.repeat)])
+            table = timed(lambda: [table_pull(db_conn, table_user, banner_type) for _ in range(args.repeat)])
+            print(f"{size:>14,} {legacy / args.repeat * 1e3:>16.2f} {table / args.repeat * 1e3:>17.2f}")
+
+    # Legacy inventory and exchange blobs are moved on a player's first read; several first reads at
+    # once (page load plus /get_user_data) must move each blob exactly once
+    players = [f'bench-first-read-{n}' for n in range(args.first_reads)]
+    blob = [random.choice(pool) for _ in range(50)]
+    exchanges = {'exchange_lumen': 3, 'exchange_snc_with_oj': 1}
+    with app.app.app_context():
+        db_conn = app.get_db()
+        for user_id in players:
+            app.read_user_data(user_id)
+        db_conn.executemany("UPDATE user_data SET inventory = ?, monthly_exchanges = ? WHERE user_id = ?",
+                            [(json.dumps(blob), json.dumps(exchanges), user_id) for user_id in players])
+    barrier = threading.Barrier(args.readers)
+
+    def first_read(user_id):
+        with app.app.app_context():
+            barrier.wait()
+            app.read_user_data(user_id)
+
+    for user_id in players:
+        threads = [threading.Thread(target=first_read, args=(user_id,)) for _ in range(args.readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    with app.app.app_context():
+        db_conn = app.get_db()
+        moved = [(db_conn.execute("SELECT COUNT(*) FROM inventory WHERE user_id = ?", (user_id,)).fetchone()[0],
+                  dict(db_conn.execute("SELECT item, count FROM exchange_limits WHERE user_id = ?", (user_id,)).fetchall()))
+                 for user_id in players]
+    duplicated = sum(moved_items != len(blob) or moved_exchanges != exchanges for moved_items, moved_exchanges in moved)
+    print(f"concurrent first reads: {duplicated} of {len(players)} players' blobs moved more or less than once")
+    if duplicated:
+        raise SystemExit(1)
+
+
+def bench_telegram(args):
+    app.BOT_TOKEN = 'bench-token'
+    init_data = signed_init_data(987654321)
+    assert legacy_validate_telegram_data(init_data) == app.validate_telegram_data(init_data) == (True, '987654321')
+    # More distinct sessions than the cache holds, cycled in order, so every lookup misses
+    sessions = [signed_init_data(user_id) for user_id in range(app.TELEGRAM_CACHE_SIZE + 1)]
+
+    print(f"{'validation':<30} {'us/call':>8}")
+    for name, fn in [
+        ('legacy (per call key + parse)', lambda i: legacy_validate_telegram_data(init_data)),
+        ('cache miss', lambda i: app.validate_telegram_data(sessions[i % len(sessions)])),
+        ('cache hit', lambda i: app.validate_telegram_data(init_data)),
+    ]:
+        elapsed = timed(lambda: [fn(i) for i in range(args.calls)])
+        print(f"{name:<30} {elapsed / args.calls * 1e6:>8.2f}")
+
+
+def bench_metrics(args):
+    """Per-request cost of the instrumentation, against the cost of the request it measures.
+
+    End-to-end A/B runs can't resolve a ~1% difference on a shared machine, so the hooks and the
+    per-query wrapper are timed directly and compared with a /get_user_data and a /pull_gacha.
+    """
+    app.BOT_TOKEN = 'bench-token'
+    client = app.app.test_client()
+    headers = {'X-Telegram-Init-Data': signed_init_data('bench-metrics')}
+    client.get('/get_user_data', headers=headers)
+    with app.app.app_context():
+        app.get_db().execute("UPDATE user_data SET star_night_crystals = 1000000000 WHERE user_id = 'bench-metrics'")
+    requests = {
+        'GET /get_user_data': lambda: client.get('/get_user_data', headers=headers),
+        'POST /pull_gacha': lambda: client.post('/pull_gacha', headers=headers,
+                                                json={'pull_type': 'multi', 'banner_type': 'standard_character'}),
+    }
+
+    def best_of(fn, n, repeat=5):
+        return min(timed(lambda: [fn() for _ in range(n)]) for _ in range(repeat)) / n
+
+    def hooks(response):
+        app.start_request_timer()
+        app.record_request_metrics(response)
+
+    plain = sqlite3.connect(':memory:', isolation_level=None)
+    instrumented = sqlite3.connect(':memory:', isolation_level=None, factory=app.InstrumentedConnection)
+    query_overhead = max(best_of(lambda: instrumented.execute("SELECT 1"), 20000, repeat=9)
+                         - best_of(lambda: plain.execute("SELECT 1"), 20000, repeat=9), 0.0)
+    print(f"unsampled query wrapper: {query_overhead * 1e6:.2f} us/query")
+
+    print(f"{'request':<20} {'sample rate':>11} {'request us':>10} {'hooks us':>8} {'queries':>7} {'overhead':>8}")
+    for name, make_request in requests.items():
+        app.METRICS_SAMPLE_RATE = 1.0
+        response = make_request()
+        queries = int(re.search(r'desc="(\d+) queries"', response.headers['Server-Timing']).group(1))
+        for rate in (0.0, 0.05, 1.0):
+            app.METRICS_SAMPLE_RATE = rate
+            request_time = best_of(make_request, args.requests)
+            with app.app.test_request_context(name.split()[1], method=name.split()[0], headers=headers):
+                hook_time = best_of(lambda: hooks(response), args.requests * 10)
+            overhead = hook_time + queries * query_overhead
+            print(f"{name:<20} {rate:>11} {request_time * 1e6:>10.1f} {hook_time * 1e6:>8.2f} {queries:>7} "
+                  f"{overhead / (request_time - overhead) * 100:>7.2f}%")
+
+
+def bench_http(args):
+    """Requests/sec through the Flask stack, connection per request vs pooled WAL connections."""
+    app.BOT_TOKEN = 'bench-token' # real signature checks, one player per thread
+    modes = [
+        ('per-request', 0, {'journal_mode': 'DELETE'}), # the old get_db: new connection, default pragmas
+        ('pooled+WAL', app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS)),
+    ]
+    endpoints = [
+        ('GET /get_user_data', lambda client, headers: client.get('/get_user_data', headers=headers)),
+        ('POST /pull_gacha', lambda client, headers: client.post(
+            '/pull_gacha', headers=headers, json={'pull_type': 'multi', 'banner_type': 'standard_character'})),
+    ]
+    directory = tempfile.mkdtemp(prefix='novaflare-http-')
+    print(f"{'endpoint':<20} {'connections':<12} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, request_fn in endpoints:
+        for mode, pool_size, pragmas in modes:
+            use_database(os.path.join(directory, f'{mode}-{len(name)}.db'), pool_size, pragmas)
+            with app.app.app_context():
+                db_conn = app.get_db()
+                for thread in range(args.threads):
+                    app.read_user_data(f'bench-http-{thread}')
+                db_conn.execute("UPDATE user_data SET star_night_crystals = 1000000000")
+
+            latencies = []
+            lock = threading.Lock()
+
+            def worker(thread):
+                client = app.app.test_client()
+                headers = {'X-Telegram-Init-Data': signed_init_data(f'bench-http-{thread}')}
+                timings = []
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    response = request_fn(client, headers)
+                    timings.append(time.perf_counter() - start)
+                    assert response.status_code == 200, response.get_data(as_text=True)
+                with lock:
+                    latencies.extend(timings)
+
+            threads = [threading.Thread(target=worker, args=(thread,)) for thread in range(args.threads)]
+            elapsed = timed(lambda: [t.start() for t in threads] and [t.join() for t in threads])
+            latencies.sort()
+            print(f"{name:<20} {mode:<12} {len(latencies) / elapsed:>9.0f} "
+                  f"{latencies[len(latencies) // 2] * 1e3:>8.2f} {latencies[int(len(latencies) * 0.99)] * 1e3:>8.2f}")
+
+
+SERVERS = {
+    # Thread per request: the sync Flask app under gunicorn's threaded worker
+    'flask-threads': lambda port, threads: [sys.executable, '-m', 'gunicorn', '--worker-class', 'gthread', '--workers', '1',
+                                            '--threads', str(threads), '--bind', f'127.0.0.1:{port}', 'app:app'],
+    # Event loop: asgi.py under uvicorn, DB work on a pool of the same size
+    'asgi': lambda port, threads: [sys.executable, 'asgi.py'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def run_server(kind, threads, database):
+    """Start one worker process of the given server kind and wait until it accepts connections."""
+    port = free_port()
+    env = dict(os.environ, NOVAFLARE_DATABASE=database, NOVAFLARE_BOT_TOKEN=app.BOT_TOKEN, NOVAFLARE_PORT=str(port),
+               NOVAFLARE_WORKERS='1', NOVAFLARE_DB_THREADS=str(threads), NOVAFLARE_METRICS_SAMPLE_RATE='0')
+    server = subprocess.Popen(SERVERS[kind](port, threads), cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError(f"{kind} server did not start")
+                time.sleep(0.1)
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def _http_connection(port, requests, deadline, latencies, failures):
+    """One keep-alive client connection sending its requests round robin until the deadline."""
+    reader = writer = None
+    i = 0
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            start = time.perf_counter()
+            writer.write(requests[i % len(requests)])
+            i += 1
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            closing = False
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                name = name.strip().lower()
+                if name == 'content-length':
+                    length = int(value)
+                elif name == 'connection' and value.strip().lower() == 'close':
+                    closing = True
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status >= 500:
+                failures.append(status)
+            if closing:
+                writer.close()
+                writer = None
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            failures.append('connection')
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+
+def bench_serve(args):
+    """Throughput and tail latency per core as open connections grow, thread-per-request vs ASGI."""
+    app.BOT_TOKEN = 'bench-token'
+    directory = tempfile.mkdtemp(prefix='novaflare-serve-')
+    pull_body = json.dumps({'pull_type': 'single', 'banner_type': 'standard_character'}).encode()
+    print(f"{'server':<14} {'connections':>11} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>9} {'503s':>6} {'errors':>7}")
+    for kind in args.servers.split(','):
+        for connections in [int(n) for n in args.connections.split(',')]:
+            database = os.path.join(directory, f'{kind}-{connections}.db')
+            use_database(database, app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+            with app.app.app_context():
+                for player in range(args.players):
+                    app.read_user_data(f'bench-serve-{player}')
+                app.get_db().execute("UPDATE user_data SET star_night_crystals = 1000000000")
+            app._db_pool.close()
+            app._db_pool = None
+
+            # Each connection acts for one player: mostly state reads, one pull in every pull_every requests
+            conversations = []
+            for connection in range(connections):
+                init_data = signed_init_data(f'bench-serve-{connection % args.players}')
+                get = (f"GET /get_user_data HTTP/1.1\r\nHost: bench\r\nX-Telegram-Init-Data: {init_data}\r\n\r\n").encode()
+                pull = (f"POST /pull_gacha HTTP/1.1\r\nHost: bench\r\nX-Telegram-Init-Data: {init_data}\r\n"
+                        f"Content-Type: application/json\r\nContent-Length: {len(pull_body)}\r\n\r\n").encode() + pull_body
+                conversations.append([get] * (args.pull_every - 1) + [pull])
+
+            with run_server(kind, args.threads, database) as port:
+                latencies, failures = [], []
+
+                async def drive():
+                    deadline = time.perf_counter() + args.duration
+                    await asyncio.gather(*(_http_connection(port, requests, deadline, latencies, failures)
+                                           for requests in conversations))
+
+                elapsed = timed(asyncio.run, drive())
+            latencies.sort()
+            rejected = failures.count(503) # backpressure, the client should retry
+            errors = len(failures) - rejected
+            if not latencies:
+                print(f"{kind:<14} {connections:>11} {'-':>9} {'-':>8} {'-':>9} {rejected:>6} {errors:>7}")
+                continue
+            print(f"{kind:<14} {connections:>11} {len(latencies) / elapsed:>9.0f} {latencies[len(latencies) // 2] * 1e3:>8.2f} "
+                  f"{latencies[int(len(latencies) * 0.99)] * 1e3:>9.2f} {rejected:>6} {errors:>7}")
+
+
+STARTUP_PROBE = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.init_db()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def bench_startup(args):
+    """Cold-start cost of a worker: importing the app, migrating, and a server's first response."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp(prefix='novaflare-startup-')
+    timings = {}
+
+    def probe(database):
+        env = dict(os.environ, NOVAFLARE_DATABASE=database)
+        output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=repo, env=env, check=True,
+                                capture_output=True, text=True).stdout
+        return [float(value) for value in output.split('\n')[-2].split()]
+
+    migrated = os.path.join(directory, 'migrated.db')
+    probe(migrated)
+    for run in range(args.runs):
+        import_seconds, migrate_seconds = probe(os.path.join(directory, f'new-{run}.db'))
+        timings.setdefault('import app', []).append(import_seconds)
+        timings.setdefault('migrate-db, new database', []).append(migrate_seconds)
+        timings.setdefault('migrate-db, up to date', []).append(probe(migrated)[1])
+
+    # Time from spawning a worker on an already migrated database to its first answered request
+    for kind in args.servers.split(','):
+        for run in range(args.runs):
+            port = free_port()
+            env = dict(os.environ, NOVAFLARE_DATABASE=migrated, NOVAFLARE_PORT=str(port), NOVAFLARE_WORKERS='1')
+            start = time.perf_counter()
+            server = subprocess.Popen(SERVERS[kind](port, 4), cwd=repo, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while True:
+                    try:
+                        with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+                            sock.sendall(b"GET /login HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n")
+                            if sock.recv(12).startswith(b'HTTP/1.1 200'):
+                                break
+                    except OSError:
+                        pass
+                    if server.poll() is not None or time.perf_counter() - start > 30:
+                        raise RuntimeError(f"{kind} server did not start")
+                    time.sleep(0.005)
+                timings.setdefault(f'first response, {kind}', []).append(time.perf_counter() - start)
+            finally:
+                server.terminate()
+                server.wait()
+
+    print(f"{'stage':<32} {'mean ms':>9} {'min ms':>9} {'max ms':>9}")
+    for stage, seconds in timings.items():
+        print(f"{stage:<32} {sum(seconds) / len(seconds) * 1e3:>9.1f} {min(seconds) * 1e3:>9.1f} {max(seconds) * 1e3:>9.1f}")
+
+
+def _crash_worker(mode, users, duration, ack_path):
+    """Child process: pull as fast as possible through the user cache, then die without flushing."""
+    app.USER_CACHE = app.UserStateCache(mode)
+    ack_fd = os.open(ack_path, os.O_WRONLY | os.O_APPEND)
+
+    def worker(user_id):
+        client = app.app.test_client()
+        headers = {'X-Telegram-Init-Data': signed_init_data(user_id)}
+        body = {'pull_type': 'single', 'banner_type': 'limited_weapon_1'}
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            if client.post('/pull_gacha', headers=headers, json=body).status_code == 200:
+                os.write(ack_fd, f"{user_id}\n".encode()) # acknowledged to the player
+
+    threads = [threading.Thread(target=worker, args=(user_id,), daemon=True) for user_id in users]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    os.kill(os.getpid(), signal.SIGKILL) # mid-request, mid-flush, no atexit: like kill -9 or the OOM killer
+
+
+def bench_cache_recovery(args):
+    """Kill a worker mid-load in every user cache mode and check what the database kept.
+
+    Whatever was lost, each player's row must agree with their inventory (no half-written request).
+    In sync/group mode nothing that was acknowledged may be missing; in interval mode at most the
+    pulls of one flush interval plus one flush's write (itself under an interval when flushes keep
+    up), i.e. 2 x USER_CACHE_FLUSH_INTERVAL of traffic.
+    """
+    app.BOT_TOKEN = 'bench-token'
+    users = [f'bench-crash-{n}' for n in range(args.users)]
+    directory = tempfile.mkdtemp(prefix='novaflare-crash-')
+    cost = app.COST_MAP['limited_weapon_1']['snc']
+    starting_snc = 10 ** 9
+    print(f"{'mode':<9} {'acked pulls/s':>13} {'acked':>7} {'stored':>7} {'lost':>6} {'allowed':>8} {'inconsistent':>12}")
+    failures = 0
+    for mode in args.modes.split(','):
+        use_database(os.path.join(directory, f'{mode}.db'), app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+        with app.app.app_context():
+            db_conn = app.get_db()
+            app.ensure_item_catalog(db_conn)
+            for user_id in users:
+                app.read_user_data(user_id)
+            db_conn.execute("UPDATE user_data SET star_night_crystals = ?, halo_orbs = 0", (starting_snc,))
+        app.get_db_pool().close()
+
+        ack_path = os.path.join(directory, f'{mode}.acks')
+        open(ack_path, 'w').close()
+        child = multiprocessing.get_context('fork').Process(target=_crash_worker, args=(mode, users, args.duration, ack_path))
+        child.start()
+        child.join()
+        with open(ack_path) as f:
+            acked = Counter(line.strip() for line in f)
+
+        app._db_pool = None # reopen after the crash, like a restarted worker
+        lost = inconsistent = stored_total = 0
+        with app.app.app_context():
+            db_conn = app.get_db()
+            for user_id in users:
+                user = app.read_user_data(user_id)
+                stored, max_version = db_conn.execute(
+                    "SELECT COUNT(*), COALESCE(MAX(version), 0) FROM inventory WHERE user_id = ?", (user_id,)).fetchone()
+                counted = db_conn.execute(
+                    "SELECT COALESCE(SUM(count), 0) FROM inventory_counts WHERE user_id = ?", (user_id,)).fetchone()[0]
+                stored_total += stored
+                lost += max(acked[user_id] - stored, 0)
+                inconsistent += not (
+                    counted == stored and user['version'] == stored and max_version == stored
+                    and user['star_night_crystals'] == starting_snc - cost * stored
+                    and stored <= acked[user_id] + 1 # at most the one request in flight
+                )
+        total_acked = sum(acked.values())
+        allowed = round(total_acked / args.duration * 2 * app.USER_CACHE_FLUSH_INTERVAL) if mode == 'interval' else 0
+        print(f"{mode:<9} {total_acked / args.duration:>13.0f} {total_acked:>7} {stored_total:>7} {lost:>6} {allowed:>8} {inconsistent:>12}")
+        failures += inconsistent + (lost > allowed)
+    if failures:
+        raise SystemExit(f"{failures} inconsistent player(s) or mode(s) that lost more acknowledged pulls than allowed")
+
+
+def bench_concurrency(args):
+    """Hammer one player with concurrent pulls and shop purchases, then check nothing was lost.
+
+    Every balance must match what the successful responses add up to: SNC spent on pulls and
+    purchases, OJ and AC earned from the pulled items, one inventory row per pulled item.
+    """
+    user_id = 'bench-concurrency'
+    if not app.BOT_TOKEN or app.BOT_TOKEN == 'YOUR_TELEGRAM_BOT_TOKEN_HERE':
+        user_id = '123456789' # validate_telegram_data's local development user wins over the session
+    banner_type = 'limited_weapon_1' # paid in SNC only when the player has no halo orbs
+    starting_snc = 10 * args.threads * args.requests
+    with app.app.app_context():
+        db_conn = app.get_db()
+        app.read_user_data(user_id) # straight from the database, before the user cache sees the player
+        db_conn.execute(
+            "UPDATE user_data SET star_night_crystals = ?, lumen_orbs = 0, halo_orbs = 0, auric_crescents = 0, orbital_jewels = 0 WHERE user_id = ?",
+            (starting_snc, user_id)
+        )
+
+    actions = [
+        ('/pull_gacha', {'pull_type': 'single', 'banner_type': banner_type}),
+        ('/exchange_shop', {'exchange_type': 'buy_lumen_1'}),
+        ('/exchange_shop', {'exchange_type': 'exchange_snc_with_oj'}),
+    ]
+    successes = Counter()
+    errors = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+        for _ in range(args.requests):
+            path, body = rng.choice(actions)
+            response = client.post(path, json=body)
+            with lock:
+                if response.status_code == 200:
+                    successes[body.get('exchange_type', 'pull')] += 1
+                elif response.status_code != 400:
+                    errors.append((response.status_code, response.get_data(as_text=True)[:200]))
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+    with contextlib.redirect_stdout(io.StringIO()): # per-request BOT_TOKEN warnings
+        elapsed = timed(lambda: [t.start() for t in threads] and [t.join() for t in threads])
+
+    app.flush_user_cache()
+    with app.app.app_context():
+        db_conn = app.get_db()
+        user = app.read_user_data(user_id)
+        items = [app.ITEMS_BY_ID[row['item_id']] for row in db_conn.execute(
+            "SELECT item_id FROM inventory WHERE user_id = ? ORDER BY id", (user_id,))]
+        row = db_conn.execute(app.EXCHANGE_COUNT_SQL, (user_id, 'exchange_snc_with_oj', app.exchange_period())).fetchone()
+        oj_exchange_count = row[0] if row else 0
+        # The event log has to tell the same story as the balances
+        sums = ', '.join(f"sum({currency})" for currency in app.CURRENCY_COLUMNS)
+        event_row = db_conn.execute(f"SELECT sum(kind = 'pull'), sum(kind = 'exchange'), {sums} FROM events WHERE user_id = ?",
+                                    (user_id,)).fetchone()
+        logged_pulls, logged_exchanges, logged_changes = event_row[0] or 0, event_row[1] or 0, event_row[2:]
+        # ...and so do the dashboard rollups built from it
+        app.catch_up_rollups(db_conn)
+        flows = ', '.join(f"sum({currency}_earned - {currency}_spent)" for currency in app.CURRENCY_COLUMNS)
+        rollup_row = db_conn.execute(f"SELECT sum(events) FILTER (WHERE kind = 'pull'), {flows} FROM rollup_hourly").fetchone()
+
+    # Replay the rewards in inventory order to get the expected OJ and AC
+    expected_oj = expected_ac = 0
+    owned = set()
+    for item in items:
+        rewards = app.PULL_REWARDS.get(item['rarity'], {})
+        expected_oj += rewards.get('orbital_jewels', 0)
+        expected_ac += rewards.get('auric_crescents', 0)
+        if item['type'] == 'Character' and item['rarity'] in (4, 5) and item['name'] in owned:
+            expected_ac += app.SPECTRA_AC_REWARD
+        owned.add(item['name'])
+
+    buys, oj_exchanges = successes['buy_lumen_1'], successes['exchange_snc_with_oj']
+    checks = [
+        ('inventory rows', len(items), successes['pull']),
+        ('star_night_crystals', user['star_night_crystals'],
+         starting_snc - app.COST_MAP[banner_type]['snc'] * successes['pull']
+         - app.COST_MAP['buy_lumen_1']['cost_amount'] * buys
+         + app.COST_MAP['exchange_snc_with_oj']['reward_amount'] * oj_exchanges),
+        ('lumen_orbs', user['lumen_orbs'], app.COST_MAP['buy_lumen_1']['reward_amount'] * buys),
+        ('orbital_jewels', user['orbital_jewels'], expected_oj - app.COST_MAP['exchange_snc_with_oj']['cost_amount'] * oj_exchanges),
+        ('auric_crescents', user['auric_crescents'], expected_ac),
+        ('OJ exchange count', oj_exchange_count, oj_exchanges),
+        ('logged pulls', logged_pulls, successes['pull']),
+        ('logged exchanges', logged_exchanges, buys + oj_exchanges),
+    ]
+    starting = {'star_night_crystals': starting_snc}
+    checks += [(f'logged {currency}', starting.get(currency, 0) + (change or 0), user[currency])
+               for currency, change in zip(app.CURRENCY_COLUMNS, logged_changes)]
+    checks += [('rollup pulls', rollup_row[0] or 0, logged_pulls)]
+    checks += [(f'rollup {currency}', change or 0, logged or 0)
+               for currency, change, logged in zip(app.CURRENCY_COLUMNS, rollup_row[1:], logged_changes)]
+    total = sum(successes.values())
+    print(f"{args.threads} threads, {total} successful requests in {elapsed:.2f}s ({dict(successes)})")
+    failures = len(errors)
+    for status, text in errors[:5]:
+        print(f"unexpected {status}: {text}")
+    for name, actual, expected in checks:
+        flag = '' if actual == expected else '  MISMATCH'
+        failures += bool(flag)
+        print(f"{name:<28} {actual:>10} {expected:>10}{flag}")
+    if failures:
+        raise SystemExit(f"{failures} consistency check(s) failed")
+
+
+def bench_bulk(args):
+    """A grant to every player while hot players keep pulling: job speed, pull latency, and balances.
+
+    Live pulls are timed with no job running and then during the job. Afterwards every hot player's
+    balances must equal their starting balances plus everything the event log says happened, the
+    grant included, and untouched players must have exactly the grant added.
+    """
+    app.BOT_TOKEN = 'bench-token' # no initData, so requests act for their session's player
+    use_database(os.path.join(tempfile.mkdtemp(prefix='novaflare-bulk-'), 'novaflare.db'),
+                 app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+    hot = [f'bulk-hot-{i}' for i in range(args.threads)]
+    starting_snc = 10 ** 9
+    with app.app.app_context():
+        db_conn = app.get_db()
+        with app.transaction(db_conn):
+            db_conn.executemany("INSERT INTO user_data (user_id) VALUES (?)",
+                                ((f'bulk-{i:08d}',) for i in range(args.players)))
+        for user_id in hot:
+            app.read_user_data(user_id)
+        db_conn.execute("UPDATE user_data SET star_night_crystals = ?, lumen_orbs = 0 WHERE user_id LIKE 'bulk-hot-%'",
+                        (starting_snc,))
+        starting = {row['user_id']: dict(row) for row in db_conn.execute("SELECT * FROM user_data WHERE user_id LIKE 'bulk-hot-%'")}
+
+    phase = {'name': 'baseline'}
+    latencies = {'baseline': [], 'during job': []}
+    stop = threading.Event()
+    errors = []
+
+    def player(user_id):
+        client = app.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+        while not stop.is_set():
+            name = phase['name']
+            start = time.perf_counter()
+            response = client.post('/pull_gacha', json={'pull_type': 'single', 'banner_type': 'limited_weapon_1'})
+            latencies[name].append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors.append((response.status_code, response.get_data(as_text=True)[:200]))
+
+    grant = {'star_night_crystals': 500, 'halo_orbs': 10}
+    threads = [threading.Thread(target=player, args=(user_id,)) for user_id in hot]
+    chunk_seconds = []
+    with contextlib.redirect_stdout(io.StringIO()): # per-request BOT_TOKEN warnings
+        for thread in threads:
+            thread.start()
+        time.sleep(args.baseline)
+        phase['name'] = 'during job'
+        job_conn = app.open_db_connection()
+        job_id = app.create_admin_job(job_conn, 'grant', {'currencies': grant}, {}, created_by='bench')
+        job_start = time.perf_counter()
+        while True:
+            start = time.perf_counter()
+            if not app.run_admin_job_chunk(job_conn, job_id, args.chunk_size):
+                break
+            chunk_seconds.append(time.perf_counter() - start)
+            time.sleep(app.ADMIN_JOB_PAUSE)
+        job_elapsed = time.perf_counter() - job_start
+        stop.set()
+        for thread in threads:
+            thread.join()
+    app.flush_user_cache()
+
+    job = app.admin_job_status(job_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (job_id,)).fetchone())
+    print(f"{args.players + len(hot)} players granted in {job_elapsed:.1f}s ({job['affected'] / job_elapsed:,.0f}/s), "
+          f"{len(chunk_seconds)} chunks of {args.chunk_size}, chunk p50 {sorted(chunk_seconds)[len(chunk_seconds) // 2] * 1e3:.1f}ms "
+          f"max {max(chunk_seconds) * 1e3:.1f}ms (chunk {chunk_seconds.index(max(chunk_seconds)) + 1})")
+    print(f"{'pulls':<12} {'count':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, values in latencies.items():
+        summary = latency_summary(values)
+        print(f"{name:<12} {len(values):>7} {summary['p50_ms']:>8.2f} {summary['p99_ms']:>8.2f} {summary['max_ms']:>8.2f}")
+
+    checks = [('job status', job['status'], 'done'), ('players granted', job['affected'], args.players + len(hot))]
+    sums = ', '.join(f"sum({currency})" for currency in app.CURRENCY_COLUMNS)
+    for user_id in hot:
+        row = job_conn.execute("SELECT * FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        logged = job_conn.execute(f"SELECT {sums} FROM events WHERE user_id = ?", (user_id,)).fetchone()
+        for currency, change in zip(app.CURRENCY_COLUMNS, logged):
+            checks.append((f'{user_id} {currency}', row[currency], starting[user_id][currency] + (change or 0)))
+    sample = job_conn.execute("SELECT star_night_crystals, halo_orbs FROM user_data WHERE user_id = 'bulk-00000000'").fetchone()
+    checks += [('cold player snc', sample[0], 1000 + grant['star_night_crystals']), ('cold player halo', sample[1], grant['halo_orbs'])]
+
+    # The grant's events must not make anyone active: a job for players active in the last day
+    # reaches only the hot ones, and the dashboard counts only them and no exchanges
+    follow_up = app.create_admin_job(job_conn, 'grant', {'currencies': {'orbital_jewels': 1}},
+                                     {'active_since': int(time.time()) - 86400}, created_by='bench')
+    while app.run_admin_job_chunk(job_conn, follow_up, args.chunk_size):
+        pass
+    follow_up = app.admin_job_status(job_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (follow_up,)).fetchone())
+    app.catch_up_rollups(job_conn)
+    stats = app.rollup_stats(job_conn, 2)
+    checks += [('active players granted', follow_up['affected'], len(hot)),
+               ('active players per hour', max(stats['active_users_per_hour']) <= len(hot), True),
+               ('exchanges per hour', sum(stats['exchanges_per_hour']), 0),
+               ('admin events per hour', sum(stats['admin_events_per_hour']), job['affected'] + follow_up['affected'])]
+    job_conn.close()
+    failures = len(errors)
+    for status, text in errors[:5]:
+        print(f"unexpected {status}: {text}")
+    for name, actual, expected in checks:
+        if actual != expected:
+            failures += 1
+            print(f"{name:<40} {actual!s:>12} {expected!s:>12}  MISMATCH")
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed")
+    print(f"{len(checks)} consistency checks passed")
+
+
+def _shared_bucket_worker(rate, burst, duration, results):
+    limits = app.get_limits()
+    granted = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        granted += not limits.take_token('/pull_gacha', 'limits-shared', rate, burst)
+    results.put(granted)
+
+
+def bench_limits(args):
+    """Rate limits and Idempotency-Key handling on /pull_gacha, per backend.
+
+    A player tapping as fast as the client can must get no more pulls than the bucket holds plus
+    its refill. A retried key must get the first response back without pulling again, also when
+    the copies arrive at the same moment. With the shared backend, worker processes draw from one
+    bucket per player.
+    """
+    app.BOT_TOKEN = 'bench-token' # no initData, so requests act for their session's player
+    body = {'pull_type': 'single', 'banner_type': 'standard_weapon'}
+    failures = 0
+
+    def client_for(user_id):
+        client = app.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session['user_id'] = user_id
+        return client
+
+    def funded_player(user_id):
+        client = client_for(user_id)
+        client.get('/get_user_data')
+        with app.app.app_context():
+            db_conn = app.get_db()
+            db_conn.execute(f"UPDATE user_data SET {', '.join(f'{currency} = 1000000000' for currency in app.CURRENCY_COLUMNS)} "
+                            "WHERE user_id = ?", (user_id,))
+        return client
+
+    def version(user_id):
+        with app.app.app_context():
+            return app.get_user_data_from_db(user_id)['version']
+
+    def check(name, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"  {name:<58} {'ok' if ok else 'FAILED'}")
+
+    for backend in args.backends.split(','):
+        app.RATE_LIMIT_BACKEND = backend
+        app._limits = None
+        limits = app.get_limits()
+        print(f"== {backend}")
+
+        # Tapping: sequential pulls as fast as the test client goes
+        app.RATE_LIMITS = {'/pull_gacha': (args.rate, args.burst)}
+        user_id = f'limits-tap-{backend}'
+        client = funded_player(user_id)
+        before = version(user_id)
+        statuses = Counter()
+        start = time.monotonic()
+        for _ in range(args.taps):
+            statuses[client.post('/pull_gacha', json=body).status_code] += 1
+        elapsed = time.monotonic() - start
+        allowed = args.burst + args.rate * elapsed
+        print(f"  {args.taps} taps in {elapsed:.2f}s: {statuses[200]} pulled, {statuses[429]} limited "
+              f"(bucket allows {allowed:.1f})")
+        check('pulls within burst + refill', args.burst <= statuses[200] <= math.floor(allowed))
+        check('only pulls changed the player', version(user_id) - before == statuses[200])
+
+        # Cost of the check itself, distinct players so every call spends a token
+        calls = 20000
+        start = time.perf_counter()
+        for n in range(calls):
+            limits.take_token('/bench', f'cost-{n}', 1.0, 10)
+        print(f"  take_token: {(time.perf_counter() - start) / calls * 1e6:.1f} us/call")
+
+        # Retries: the same key twice in a row, then the copies all at once
+        app.RATE_LIMITS = {}
+        user_id = f'limits-retry-{backend}'
+        client = funded_player(user_id)
+        before = version(user_id)
+        replayed = 0
+        for n in range(args.keys):
+            headers = {'Idempotency-Key': f'{backend}-seq-{n}'}
+            first = client.post('/pull_gacha', json=body, headers=headers)
+            second = client.post('/pull_gacha', json=body, headers=headers)
+            replayed += first.get_json() == second.get_json() and second.headers.get('Idempotent-Replayed') == 'true'
+        check(f'{args.keys} retried keys replayed the first response', replayed == args.keys)
+        check('retried keys pulled once each', version(user_id) - before == args.keys)
+        reused = client.post('/pull_gacha', json=dict(body, pull_type='multi'), headers={'Idempotency-Key': f'{backend}-seq-0'})
+        check('key reused for another request is refused', reused.status_code == 422)
+
+        before = version(user_id)
+        clients = [client_for(user_id) for _ in range(args.threads)]
+        identical = 0
+        for n in range(args.keys):
+            barrier = threading.Barrier(args.threads)
+            responses = [None] * args.threads
+            def send(i, key=f'{backend}-burst-{n}'):
+                barrier.wait()
+                responses[i] = clients[i].post('/pull_gacha', json=body, headers={'Idempotency-Key': key}).get_json()
+            threads = [threading.Thread(target=send, args=(i,)) for i in range(args.threads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            identical += all(response == responses[0] for response in responses) and responses[0]['status'] == 'success'
+        check(f'{args.threads} simultaneous copies got one response, {args.keys} keys', identical == args.keys)
+        check('simultaneous copies pulled once per key', version(user_id) - before == args.keys)
+
+        if backend == 'shared':
+            # Several processes spending from one player's bucket
+            processes, duration = 4, 1.0
+            context = multiprocessing.get_context('fork')
+            results = context.Queue()
+            workers = [context.Process(target=_shared_bucket_worker, args=(args.rate, args.burst, duration, results))
+                       for _ in range(processes)]
+            for worker in workers:
+                worker.start()
+            granted = sum(results.get() for _ in workers)
+            for worker in workers:
+                worker.join()
+            allowed = args.burst + args.rate * (duration + 0.5) # + process start skew
+            print(f"  {processes} processes for {duration:.0f}s drew {granted} tokens (bucket allows {allowed:.1f})")
+            check('processes share one bucket', args.burst <= granted <= allowed)
+
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed")
+
+
+def bench_streams(args):
+    """Per-player pull streams: draw cost, distribution, and replaying real histories.
+
+    Histories come from real requests (threads, with NOVAFLARE_USER_CACHE honoured) with a
+    reset_pity job half way through; verify_pulls must match all of them, then catch each kind of
+    tampering planted afterwards.
+    """
+    failures = 0
+
+    def check(name, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"  {name:<60} {'ok' if ok else 'FAILED'}")
+
+    print("draws per request (10-pull)")
+    seed = app.new_pull_seed()
+    legacy = random.Random(1)
+    calls = 20000
+    for name, draw in [('random module, 2 x 10 calls', lambda: [legacy.random() for _ in range(20)]),
+                       ('philox stream', lambda: app.pull_draws(seed, 12345, 10)),
+                       ('sha256 stream', lambda: app.PULL_STREAMS['sha256'](b'k' * 16, 12345, 10))]:
+        start = time.perf_counter()
+        for _ in range(calls):
+            draw()
+        print(f"  {name:<30} {(time.perf_counter() - start) / calls * 1e6:8.1f} us")
+    start = time.perf_counter()
+    rolls, picks = app.pull_draws(seed, 0, args.draws)
+    print(f"  philox bulk: {args.draws / (time.perf_counter() - start) / 1e6:.1f}M draws/s")
+
+    print(f"distribution ({args.draws} pulls per banner, stream vs numpy default_rng)")
+    for banner_type in ('standard_weapon', 'limited_character_1'):
+        streamed = app.batch_pull(banner_type, args.draws, draws=(rolls, picks))
+        reference = app.batch_pull(banner_type, args.draws, rng=np.random.default_rng(args.seed))
+        names_a = Counter(item['name'] for item in streamed.items)
+        names_b = Counter(item['name'] for item in reference.items)
+        _, _, p_value = chi_square_homogeneity(names_a, names_b)
+        expected = app.get_expected_rates(banner_type)[5]
+        low, high = app.wilson_interval(int((streamed.rarities == 5).sum()), args.draws, z=3.29)
+        print(f"  {banner_type:<22} 5* {(streamed.rarities == 5).mean():.4%} (expected {expected:.4%}), items p={p_value:.3f}")
+        check(f'{banner_type}: 5* rate within 99.9% interval', low <= expected <= high)
+        check(f'{banner_type}: same item distribution as default_rng', p_value > 0.001)
+
+    print(f"histories ({args.players} players x {args.requests} requests, {args.threads} threads, "
+          f"user cache {app.USER_CACHE_MODE})")
+    app.BOT_TOKEN = 'bench-token'
+    players = [f'stream-{n:05d}' for n in range(args.players)]
+    with app.app.app_context():
+        db_conn = app.get_db()
+        for user_id in players:
+            app.read_user_data(user_id)
+        with app.transaction(db_conn):
+            db_conn.execute(f"UPDATE user_data SET {', '.join(f'{c} = 1000000000' for c in app.CURRENCY_COLUMNS)}")
+    app.flush_user_cache()
+    if app.USER_CACHE is not None:
+        app.USER_CACHE.entries.clear() # balances were changed underneath it
+    banners = list(app.GACHA_POOL)
+    body_rng = random.Random(args.seed)
+    plans = [[(body_rng.choice(['single', 'multi']), body_rng.choice(banners)) for _ in range(args.requests)] for _ in players]
+
+    def play(half):
+        def worker(offset):
+            client = app.app.test_client()
+            for n in range(offset, len(players), args.threads):
+                with client.session_transaction() as flask_session:
+                    flask_session['user_id'] = players[n]
+                requests = plans[n][:args.requests // 2] if half == 0 else plans[n][args.requests // 2:]
+                for pull_type, banner_type in requests:
+                    response = client.post('/pull_gacha', json={'pull_type': pull_type, 'banner_type': banner_type})
+                    if response.status_code != 200:
+                        errors.append(response.get_data(as_text=True)[:200])
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    errors = []
+    with contextlib.redirect_stdout(io.StringIO()): # per-request BOT_TOKEN warnings
+        play(0)
+        job_conn = app.open_db_connection()
+        job_id = app.create_admin_job(job_conn, 'reset_pity', {'banners': banners[:3]}, {}, created_by='bench')
+        while app.run_admin_job_chunk(job_conn, job_id):
+            pass
+        play(1)
+    app.flush_user_cache()
+    check('every request succeeded', not errors)
+
+    start = time.perf_counter()
+    report = app.verify_pulls(job_conn)
+    elapsed = time.perf_counter() - start
+    print(f"  verify_pulls: {report['pulls']} pulls of {report['players']} players in {elapsed:.2f}s "
+          f"({report['pulls'] / elapsed:,.0f} pulls/s)")
+    check('every pull replayed', report['replayed'] == report['pulls'] > 0)
+    check('history matches', not report['mismatches'])
+    one = job_conn.execute("SELECT id FROM events WHERE kind = 'pull' ORDER BY id DESC LIMIT 1").fetchone()[0]
+    start = time.perf_counter()
+    replay = app.replay_pull(job_conn, one)
+    print(f"  replay_pull of one event: {(time.perf_counter() - start) * 1e3:.2f} ms")
+    check('single pull replays', replay['match'])
+
+    # Plant one of each, on different players
+    def event_of(user_id, offset):
+        return job_conn.execute("SELECT id FROM events WHERE user_id = ? AND kind = 'pull' ORDER BY id LIMIT 1 OFFSET ?",
+                                (user_id, offset)).fetchone()[0]
+    with app.transaction(job_conn):
+        job_conn.execute("UPDATE events SET item_id = (SELECT id FROM items WHERE id != events.item_id LIMIT 1) WHERE id = ?",
+                         (event_of(players[0], 3),))
+        job_conn.execute("UPDATE events SET pity_5 = pity_5 + 2 WHERE id = ?", (event_of(players[1], 5),))
+        job_conn.execute("DELETE FROM events WHERE id = ?", (event_of(players[2], 4),))
+        job_conn.execute("UPDATE events SET rng_counter = rng_counter - 1 WHERE id = ?", (event_of(players[3], 6),))
+        job_conn.execute("UPDATE user_data SET pity_counters = json_set(pity_counters, '$.standard_weapon.\"4_star\"', 9) "
+                         "WHERE user_id = ?", (players[4],))
+    print(f"  after tampering: {app.verify_pulls(job_conn)['mismatches']}")
+    for name, user_id in [('changed item', players[0]), ('changed pity', players[1]), ('deleted pull', players[2]),
+                          ('reused draw', players[3]), ('changed stored pity', players[4])]:
+        check(f'{name} caught', app.verify_pulls(job_conn, [user_id])['mismatches'])
+    check('nothing else flagged', not app.verify_pulls(job_conn, players[5:])['mismatches'])
+    job_conn.close()
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed")
+
+
+def _shard_pull_worker(users, threads, duration, results):
+    # One worker process: `threads` threads pulling for random players until the deadline
+    latencies, errors = [], []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            with app.app.app_context():
+                _, status = app.perform_pull(rng.choice(users), 'standard_weapon', 1)
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    pool = [threading.Thread(target=worker, args=(os.getpid() * 100 + n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((latencies, len(errors)))
+
+
+def shard_snapshot():
+    """Every player's rows, as {user_id: (shard, state)} with ids left out (a reshard renumbers them)."""
+    snapshot = {}
+    with app.app.app_context():
+        main = app.get_db()
+        for shard in range(app.SHARD_COUNT):
+            db_conn = app.shard_connection(main, shard)
+            for row in db_conn.execute("SELECT * FROM user_data"):
+                user_id = row['user_id']
+                inventory = [tuple(r) for r in db_conn.execute(
+                    "SELECT item_id, version FROM inventory WHERE user_id = ? ORDER BY id", (user_id,))]
+                counts = sorted(tuple(r) for r in db_conn.execute(
+                    "SELECT item_id, count FROM inventory_counts WHERE user_id = ?", (user_id,)))
+                exchanges = sorted(tuple(r) for r in db_conn.execute(
+                    "SELECT item, period, count FROM exchange_limits WHERE user_id = ?", (user_id,)))
+                events = [tuple(r) for r in db_conn.execute(
+                    f"SELECT {', '.join(app.EVENT_COLUMNS)} FROM events WHERE user_id = ? ORDER BY id", (user_id,))]
+                snapshot[user_id] = (shard, (tuple(row), inventory, counts, exchanges, events))
+    return snapshot
+
+
+def bench_shards(args):
+    """Pull throughput against the number of shard files, then resharding a live-looking database.
+
+    Throughput: worker processes pull for random players as fast as they can. Resharding: players
+    with pulls, purchases and an admin grant are moved 1 -> N -> N+1 -> 1 shards; every row must
+    arrive unchanged on the shard shard_of() picks, verify_pulls must pass and the rollups must
+    count every event exactly once.
+
+    Sharding is experimental: the throughput runs report each count's speedup over the first and
+    whether any count beat it, but don't fail when none does, since that depends on the host's cores.
+    """
+    counts = [int(n) for n in args.shards.split(',')]
+    directory = tempfile.mkdtemp(prefix='novaflare-shards-')
+    users = [f'shard-{n:05d}' for n in range(args.players)]
+    print(f"throughput: {args.workers} processes x {args.threads} threads on {os.cpu_count()} CPU(s), {args.players} players, "
+          f"{args.duration:.0f}s per run, single pulls")
+    print(f"{'synchronous':<12} {'shards':>6} {'pulls/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7} {'speedup':>8}")
+    for synchronous in args.synchronous.split(','):
+        baseline = None
+        speedups = {}
+        for count in counts:
+            use_database(os.path.join(directory, f'{synchronous}-{count}.db'), app.DB_POOL_SIZE,
+                         dict(app.SQLITE_PRAGMAS, synchronous=synchronous))
+            app.reshard(count)
+            with app.app.app_context():
+                for user_id in users:
+                    app.read_user_data(user_id)
+                for shard in range(count):
+                    app.shard_connection(app.get_db(), shard).execute("UPDATE user_data SET star_night_crystals = 1000000000")
+                app.ensure_item_catalog(app.get_db())
+            for pool in [app._db_pool] + list(app._shard_pools.values()):
+                pool.close()
+            results = multiprocessing.get_context('fork').Queue()
+            workers = [multiprocessing.get_context('fork').Process(target=_shard_pull_worker,
+                                                                   args=(users, args.threads, args.duration, results))
+                       for _ in range(args.workers)]
+            for worker in workers:
+                worker.start()
+            latencies, errors = [], 0
+            for _ in workers:
+                worker_latencies, worker_errors = results.get()
+                latencies += worker_latencies
+                errors += worker_errors
+            for worker in workers:
+                worker.join()
+            rate = len(latencies) / args.duration
+            baseline = baseline or rate
+            speedups[count] = rate / baseline
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if latencies else (0, 0)
+            print(f"{synchronous:<12} {count:>6} {rate:>9.0f} {p50:>8.2f} {p99:>8.2f} {errors:>7} {rate / baseline:>7.2f}x")
+        best = max(counts[1:], key=speedups.get, default=None)
+        if best is not None and speedups[best] > 1:
+            print(f"{synchronous:<12} sharding scaled: {best} shards at {speedups[best]:.2f}x of {counts[0]}")
+        elif best is not None:
+            print(f"{synchronous:<12} sharding did not scale on this host: no count beat {counts[0]} shard(s), keep a single shard")
+
+    print("resharding")
+    failures = 0
+
+    def check(name, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"  {name:<60} {'ok' if ok else 'FAILED'}")
+
+    app.BOT_TOKEN = 'bench-token'
+    use_database(os.path.join(directory, 'reshard.db'), app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+    players = users[:args.reshard_players]
+    rng = random.Random(args.seed)
+
+    def play(requests):
+        with contextlib.redirect_stdout(io.StringIO()), app.app.app_context():
+            for _ in range(requests):
+                user_id = rng.choice(players)
+                if rng.random() < 0.8:
+                    app.perform_pull(user_id, rng.choice(list(app.GACHA_POOL)), rng.choice([1, 10]))
+                else:
+                    app.perform_exchange(user_id, rng.choice(['buy_lumen_1', 'exchange_snc_with_oj']))
+        app.flush_user_cache()
+
+    def rollup_events():
+        with app.app.app_context():
+            app.catch_up_rollups(app.get_db())
+            return app.get_db().execute("SELECT sum(events) FROM rollup_hourly").fetchone()[0] or 0
+
+    def moved_to(shards, expected):
+        start = time.perf_counter()
+        moved = app.reshard(shards)
+        elapsed = time.perf_counter() - start
+        print(f"  reshard to {shards}: moved {moved} of {len(players)} players in {elapsed:.2f}s ({moved / elapsed:,.0f} players/s)")
+        snapshot = shard_snapshot()
+        check(f'{shards} shard(s): every row arrived unchanged', {u: s[1] for u, s in snapshot.items()} == expected)
+        check(f'{shards} shard(s): every player on their shard', all(s[0] == app.shard_of(u) for u, s in snapshot.items()))
+        with app.app.app_context():
+            report = app.verify_pulls(app.get_db())
+        check(f'{shards} shard(s): verify_pulls matches', not report['mismatches'] and report['pulls'] > 0)
+        logged = sum(len(s[1][4]) for s in snapshot.values())
+        check(f'{shards} shard(s): rollups count every event once', rollup_events() == logged)
+        return moved
+
+    with app.app.app_context():
+        for user_id in players:
+            app.read_user_data(user_id)
+        app.get_db().execute("UPDATE user_data SET star_night_crystals = 1000000000")
+    play(args.requests)
+    rollup_events()
+    expected = {u: s[1] for u, s in shard_snapshot().items()}
+    moved_to(args.reshard_to, expected)
+
+    # Requests and a bulk grant on the new layout, then grow by one and go back to one file
+    play(args.requests)
+    with app.app.app_context():
+        job_conn = app.get_db()
+        job_id = app.create_admin_job(job_conn, 'grant', {'currencies': {'halo_orbs': 7}}, {}, created_by='bench')
+        while app.run_admin_job_chunk(job_conn, job_id, 97):
+            pass
+        job = job_conn.execute("SELECT * FROM admin_jobs WHERE id = ?", (job_id,)).fetchone()
+    check('grant over every shard reached every player', (job['status'], job['scanned'], job['affected']) == ('done', len(players), len(players)))
+    expected = {u: s[1] for u, s in shard_snapshot().items()}
+    moved = moved_to(args.reshard_to + 1, expected)
+    check(f'growing by one moved about 1/{args.reshard_to + 1} of the players',
+          abs(moved / len(players) - 1 / (args.reshard_to + 1)) < 0.05)
+    moved_to(1, expected)
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed")
+
+
+def _session_worker(backend, cookies, results):
+    # A freshly started worker: its own session interface, nothing cached, and for the old
+    # behaviour (a per-process os.urandom key) a key of its own
+    if backend == 'cookie, per-process key':
+        app.app.secret_key = os.urandom(24)
+    app.app.session_interface = app.make_session_interface(backend.split(',')[0])
+    client = app.app.test_client()
+    accepted = 0
+    for cookie in cookies:
+        client.set_cookie(app.app.config['SESSION_COOKIE_NAME'], cookie)
+        accepted += client.get('/get_user_data').status_code == 200
+    results.put(accepted)
+
+
+def bench_sessions(args):
+    """What /login costs against a request riding on its session, and how many sessions a restart
+    throws away (each one a re-login) with each session backend, then checks of the sqlite store:
+    logins rotate the token, logouts and expiry end sessions on every worker, no tokens at rest."""
+    directory = tempfile.mkdtemp(prefix='novaflare-sessions-')
+    use_database(os.path.join(directory, 'novaflare.db'), app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+    app.BOT_TOKEN = 'bench-token' # no initData, so requests act for their session's player
+    app.SESSION_DATABASE = os.path.join(directory, 'sessions.db')
+    password = 'bench-password'
+    names = [f'session{n}' for n in range(args.accounts)]
+    with app.app.app_context():
+        with app.transaction(app.get_db()) as db_conn:
+            db_conn.executemany("INSERT INTO users (username, password, role) VALUES (?, ?, 'player')",
+                                [(name, generate_password_hash(password)) for name in names])
+    cookie_name = app.app.config['SESSION_COOKIE_NAME']
+    saved_interface, saved_key = app.app.session_interface, app.app.secret_key
+
+    def log_in(client, name):
+        start = time.perf_counter()
+        status = client.post('/login', data={'username': name, 'password': password}).status_code
+        return time.perf_counter() - start, status
+
+    print(f"{args.accounts} accounts, {args.requests} authenticated /get_user_data per backend")
+    print(f"{'backend':<26} {'login p50 ms':>13} {'request p50 ms':>15} {'lookup us':>10} {'after restart':>14} {'re-login CPU s':>15}")
+    fork = multiprocessing.get_context('fork')
+    for backend in ('cookie, per-process key', 'cookie', 'memory', 'sqlite', 'sqlite, no cache'):
+        app.app.session_interface = app.make_session_interface(backend.split(',')[0])
+        app.SESSION_CACHE_TTL = 0 if backend == 'sqlite, no cache' else 10.0
+        clients = [app.app.test_client() for _ in names]
+        login_latencies = []
+        for client, name in zip(clients, names):
+            elapsed, status = log_in(client, name)
+            assert status == 302, status
+            login_latencies.append(elapsed)
+        request_latencies = []
+        for n in range(args.requests):
+            start = time.perf_counter()
+            assert clients[n % len(clients)].get('/get_user_data').status_code == 200
+            request_latencies.append(time.perf_counter() - start)
+        cookies = [client.get_cookie(cookie_name).value for client in clients]
+        lookup = timed(lambda: [app.session_user_id(cookies[n % len(cookies)]) for n in range(args.requests)]) / args.requests
+        results = fork.Queue()
+        worker = fork.Process(target=_session_worker, args=(backend, cookies, results))
+        worker.start()
+        accepted = results.get()
+        worker.join()
+        login_p50 = latency_summary(login_latencies)['p50_ms']
+        print(f"{backend:<26} {login_p50:>13.2f} {latency_summary(request_latencies)['p50_ms']:>15.2f} {lookup * 1e6:>10.1f} "
+              f"{accepted:>7}/{len(names):<6} {(len(names) - accepted) * login_p50 / 1e3:>15.2f}")
+    app.SESSION_CACHE_TTL = 10.0
+
+    print("sqlite store")
+    failures = 0
+
+    def check(name, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"  {name:<60} {'ok' if ok else 'FAILED'}")
+
+    def fresh_worker():
+        return app.make_session_interface('sqlite')
+
+    app.app.session_interface = worker_a = fresh_worker()
+    client = app.app.test_client()
+    log_in(client, names[0])
+    first = client.get_cookie(cookie_name).value
+    log_in(client, names[1])
+    second = client.get_cookie(cookie_name).value
+    check('logging in again issues a new token', first != second)
+    check("the previous login's token is dead", fresh_worker().lookup(first) is None)
+    check('the session names the player that logged in',
+          app.session_user_id(second) == worker_a.lookup(second)[0]['user_id'])
+    rows = sqlite3.connect(app.SESSION_DATABASE).execute("SELECT key, data FROM sessions").fetchall()
+    check('the store holds hashes, never tokens', rows and not any(second in key or second in data for key, data in rows))
+
+    worker_b = fresh_worker()
+    check('another worker sees the session', worker_b.lookup(second) is not None)
+    client.get('/logout')
+    check('logout ends it on this worker', worker_a.lookup(second) is None)
+    check('and on a worker starting afresh', fresh_worker().lookup(second) is None)
+    app.SESSION_CACHE_TTL = 0.2
+    cached = worker_b.lookup(second) is not None
+    time.sleep(0.25)
+    check(f'a worker that had it cached drops it after {app.SESSION_CACHE_TTL}s', cached and worker_b.lookup(second) is None)
+    app.SESSION_CACHE_TTL = 10.0
+
+    lifetime = app.SESSION_LIFETIME
+    app.SESSION_LIFETIME = datetime.timedelta(seconds=0.2)
+    log_in(client, names[2])
+    expiring = client.get_cookie(cookie_name).value
+    time.sleep(0.25)
+    check('an idle session expires', client.get('/get_user_data').status_code == 401 and fresh_worker().lookup(expiring) is None)
+    app.SESSION_LIFETIME = lifetime
+    worker_a.store.pruned = 0
+    log_in(client, names[3])
+    check('expired sessions are pruned', not sqlite3.connect(app.SESSION_DATABASE).execute(
+        "SELECT count(*) FROM sessions WHERE expires <= ?", (time.time(),)).fetchone()[0])
+
+    app.app.session_interface, app.app.secret_key = saved_interface, saved_key
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed")
+
+
+def bench_wire(args):
+    """JSON against msgpack on the player API: bytes, server encode and client decode time of
+    /get_user_data at several inventory sizes and of a 10-pull response, requests/s through Flask,
+    and the same numbers for the pity_counters blob kept in user_data. Then checks that both formats
+    carry the same payload, get their own ETags and accept request bodies."""
+    if app.msgpack is None:
+        raise SystemExit("msgpack is not installed")
+    import msgpack
+    from werkzeug.datastructures import ETags, MultiDict
+
+    use_database(os.path.join(tempfile.mkdtemp(prefix='novaflare-wire-'), 'novaflare.db'), app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+    app.BOT_TOKEN = 'bench-token'
+    sizes = [int(n) for n in args.inventory.split(',')]
+    banners = list(app.GACHA_POOL)
+    payloads = []
+    with contextlib.redirect_stdout(io.StringIO()), app.app.app_context():
+        for size in sizes:
+            user_id = f'wire-{size}'
+            app.read_user_data(user_id)
+            app.get_shard_db(user_id).execute("UPDATE user_data SET star_night_crystals = 1000000000 WHERE user_id = ?", (user_id,))
+            for n in range(size // 10):
+                app.perform_pull(user_id, banners[n % len(banners)], 10)
+            query = {'inventory': '1', 'limit': str(max(size, 1))}
+            payload, _ = app.load_user_state(user_id, MultiDict(query), urlencode(query), ETags())
+            payloads.append((f'/get_user_data, {size} items', payload, user_id, query))
+        pull, _ = app.perform_pull(f'wire-{sizes[-1]}', banners[0], 10)
+        pity = app.read_user_data(f'wire-{sizes[-1]}')['pity_counters']
+
+    def per_call(fn, value):
+        calls = max(1, args.calls // max(1, len(app.encode_payload(value, app.JSON_MIMETYPE)) // 1000))
+        return timed(lambda: [fn(value) for _ in range(calls)]) / calls * 1e6
+
+    print(f"{'payload':<30} {'JSON B':>8} {'msgpack B':>10} {'size':>6} {'encode us':>17} {'decode us':>17}")
+    print(f"{'':<30} {'':>8} {'':>10} {'':>6} {'JSON':>8} {'msgpack':>8} {'JSON':>8} {'msgpack':>8}")
+    rows = [(name, payload) for name, payload, _, _ in payloads] + [('/pull_gacha, 10 items', pull), ('stored pity_counters', pity)]
+    for name, payload in rows:
+        as_json, as_msgpack = app.encode_payload(payload, app.JSON_MIMETYPE), app.encode_payload(payload, app.MSGPACK_MIMETYPE)
+        print(f"{name:<30} {len(as_json):>8,} {len(as_msgpack):>10,} {len(as_msgpack) / len(as_json):>6.0%} "
+              f"{per_call(lambda p: app.encode_payload(p, app.JSON_MIMETYPE), payload):>8.1f} "
+              f"{per_call(lambda p: app.encode_payload(p, app.MSGPACK_MIMETYPE), payload):>8.1f} "
+              f"{per_call(lambda p: json.loads(as_json), payload):>8.1f} {per_call(lambda p: msgpack.unpackb(as_msgpack), payload):>8.1f}")
+
+    print(f"through Flask, {args.requests} requests each")
+    print(f"{'payload':<30} {'JSON req/s':>11} {'msgpack req/s':>14}")
+    client = app.app.test_client()
+    for name, _, user_id, query in payloads:
+        headers = {'X-Telegram-Init-Data': signed_init_data(user_id)}
+        rates = []
+        for mimetype in (app.JSON_MIMETYPE, app.MSGPACK_MIMETYPE):
+            elapsed = timed(lambda: [client.get('/get_user_data', query_string=query, headers={**headers, 'Accept': mimetype})
+                                     for _ in range(args.requests)])
+            rates.append(args.requests / elapsed)
+        print(f"{name:<30} {rates[0]:>11,.0f} {rates[1]:>14,.0f}")
+
+    print("checks")
+    failures = 0
+
+    def check(name, ok):
+        nonlocal failures
+        failures += not ok
+        print(f"  {name:<60} {'ok' if ok else 'FAILED'}")
+
+    name, _, user_id, query = payloads[-1]
+    headers = {'X-Telegram-Init-Data': signed_init_data(user_id)}
+    as_json = client.get('/get_user_data', query_string=query, headers=headers)
+    as_msgpack = client.get('/get_user_data', query_string=query, headers={**headers, 'Accept': app.MSGPACK_MIMETYPE})
+    check('same state in both formats', as_json.get_json() == msgpack.unpackb(as_msgpack.data))
+    check('JSON without an Accept header, msgpack when asked for',
+          (as_json.mimetype, as_msgpack.mimetype) == (app.JSON_MIMETYPE, app.MSGPACK_MIMETYPE))
+    check('responses vary on Accept', 'Accept' in as_json.vary and 'Accept' in as_msgpack.vary)
+    check('each format has its own ETag', as_json.get_etag() != as_msgpack.get_etag())
+    revalidated = client.get('/get_user_data', query_string=query, headers={
+        **headers, 'Accept': app.MSGPACK_MIMETYPE, 'If-None-Match': f'"{as_msgpack.get_etag()[0]}"'})
+    crossed = client.get('/get_user_data', query_string=query, headers={**headers, 'If-None-Match': f'"{as_msgpack.get_etag()[0]}"'})
+    check("304 for the format's own ETag, not the other's", (revalidated.status_code, crossed.status_code) == (304, 200))
+    pulled = client.post('/pull_gacha', headers={**headers, 'Accept': app.MSGPACK_MIMETYPE, 'Content-Type': app.MSGPACK_MIMETYPE},
+                         data=msgpack.packb({'pull_type': 'multi', 'banner_type': banners[0]}))
+    check('msgpack request body and response on /pull_gacha',
+          pulled.status_code == 200 and len(msgpack.unpackb(pulled.data)['pulled_items']) == 10)
+    bad = [client.post('/pull_gacha', headers={**headers, 'Content-Type': app.MSGPACK_MIMETYPE}, data=body).status_code
+           for body in (b'\xc1', msgpack.packb([1, 2]), msgpack.packb({'pull_type': b'multi'}))]
+    check('malformed, non-map and bin bodies get 400', bad == [400, 400, 400])
+    error = client.get('/get_user_data', headers={'Accept': app.MSGPACK_MIMETYPE})
+    check('errors come in the asked-for format', error.status_code == 401 and msgpack.unpackb(error.data)['status'] == 'error')
+    if failures:
+        raise SystemExit(f"{failures} check(s) failed")
+
+
+# --- Load tests ---
+# End-to-end runs through the Flask app against a fresh temp database, with a synthetic player
+# population and a traffic profile. Results go to a JSON file that `compare` diffs against another
+# run, so a regression between two commits shows up as numbers rather than impressions.
+LOAD_PASSWORD = 'loadtest-password'
+LOAD_ACCOUNTS = 4 # /login accounts; each costs one password hash to create
+WHALE_SHARE = 0.05 # fraction of the population with whale inventories and balances
+
+# Request mixes: kind -> weight
+STEADY_MIX = {'get_user_data': 50, 'inventory_page': 5, 'pull_single': 18, 'pull_multi': 10, 'exchange': 16, 'login': 1}
+LAUNCH_MIX = {'get_user_data': 40, 'pull_single': 15, 'pull_multi': 30, 'exchange': 14, 'login': 1}
+WHALE_MIX = {'get_user_data': 25, 'inventory_page': 20, 'pull_single': 5, 'pull_multi': 45, 'exchange': 5}
+
+# name -> phases of (share of the duration, concurrency multiplier, mix, who plays)
+# who: 'all' existing players, 'whales' mostly whales, 'new' mostly first-time players
+LOAD_PROFILES = {
+    'steady': [(1.0, 1, STEADY_MIX, 'all')],
+    'launch': [(0.2, 0.25, STEADY_MIX, 'all'), (0.5, 2, LAUNCH_MIX, 'new'), (0.3, 1, LAUNCH_MIX, 'new')],
+    'whales': [(1.0, 1, WHALE_MIX, 'whales')],
+}
+
+
+def create_population(players, seed):
+    """Insert players with heavy-tailed inventory sizes. Returns (regular ids, whale ids, login names)."""
+    rng = np.random.default_rng(seed)
+    pool = [item for items in app.GACHA_POOL.values() for item in items]
+    whales = max(1, int(players * WHALE_SHARE))
+    regular_ids = [f'load-{n}' for n in range(players - whales)]
+    whale_ids = [f'load-whale-{n}' for n in range(whales)]
+    with app.app.app_context():
+        db_conn = app.get_db()
+        app.ensure_item_catalog(db_conn)
+        item_ids = [app.get_item_id(db_conn, item) for item in pool]
+        with app.transaction(db_conn):
+            for ids, median_items, balance in ((regular_ids, 80, 5000), (whale_ids, 6000, 10 ** 8)):
+                sizes = rng.lognormal(math.log(median_items), 1.0, len(ids)).astype(int)
+                for user_id, size in zip(ids, sizes):
+                    app.read_user_data(user_id)
+                    app.insert_inventory(db_conn, user_id, [item_ids[i] for i in rng.integers(0, len(item_ids), size)], 0)
+                db_conn.execute(
+                    f"UPDATE user_data SET star_night_crystals = ?, orbital_jewels = ? WHERE user_id IN ({','.join('?' * len(ids))})",
+                    [balance, balance // 10] + ids
+                )
+        logins = [f'loadtest{n}' for n in range(LOAD_ACCOUNTS)]
+        db_conn.executemany(
+            "INSERT INTO users (username, password, role) VALUES (?, ?, 'player') ON CONFLICT (username) DO NOTHING",
+            [(name, generate_password_hash(LOAD_PASSWORD)) for name in logins]
+        )
+    return regular_ids, whale_ids, logins
+
+
+def load_request(client, kind, headers, login, rng):
+    """Send one request of the given kind as the player in headers. Returns the response status."""
+    if kind == 'get_user_data':
+        return client.get('/get_user_data', headers=headers).status_code
+    if kind == 'inventory_page':
+        return client.get('/get_user_data?inventory=1&limit=100', headers=headers).status_code
+    if kind in ('pull_single', 'pull_multi'):
+        body = {'pull_type': 'multi' if kind == 'pull_multi' else 'single', 'banner_type': rng.choice(list(app.GACHA_POOL))}
+        return client.post('/pull_gacha', headers=headers, json=body).status_code
+    if kind == 'exchange':
+        body = {'exchange_type': rng.choice(['buy_lumen_1', 'buy_lumen_10', 'exchange_snc_with_oj'])}
+        return client.post('/exchange_shop', headers=headers, json=body).status_code
+    if kind == 'login':
+        return client.post('/login', data={'username': login, 'password': LOAD_PASSWORD}).status_code
+    raise ValueError(kind)
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    def at(q):
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1e3
+    return {'mean_ms': sum(latencies) / len(latencies) * 1e3, 'p50_ms': at(0.50), 'p90_ms': at(0.90),
+            'p99_ms': at(0.99), 'max_ms': latencies[-1] * 1e3}
+
+
+def run_load_profile(name, args):
+    use_database(os.path.join(tempfile.mkdtemp(prefix=f'novaflare-load-{name}-'), 'novaflare.db'),
+                 app.DB_POOL_SIZE, dict(app.SQLITE_PRAGMAS))
+    regular_ids, whale_ids, logins = create_population(args.players, args.seed)
+    samples = [] # (kind, status, seconds)
+    lock = threading.Lock()
+    new_players = iter(range(10 ** 9))
+    sessions = {} # user_id -> request headers
+
+    def worker(phase, index, deadline, mix, who):
+        rng = random.Random(f'{args.seed}-{name}-{phase}-{index}')
+        kinds, weights = list(mix), list(mix.values())
+        client = app.app.test_client()
+        fresh = [] # this worker's first-time players
+        local = []
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            if who == 'whales' and rng.random() < 0.8:
+                user_id = rng.choice(whale_ids)
+            elif who == 'new' and (not fresh or rng.random() < 0.5):
+                with lock:
+                    user_id = f'load-new-{next(new_players)}'
+                fresh.append(user_id)
+            elif who == 'new':
+                user_id = rng.choice(fresh)
+            else:
+                user_id = rng.choice(regular_ids if rng.random() > WHALE_SHARE else whale_ids)
+            headers = sessions.get(user_id) # the Mini App signs once per session, not per request
+            if headers is None:
+                headers = sessions[user_id] = {'X-Telegram-Init-Data': signed_init_data(user_id)}
+            start = time.perf_counter()
+            status = load_request(client, kind, headers, rng.choice(logins), rng)
+            local.append((kind, status, time.perf_counter() - start))
+        with lock:
+            samples.extend(local)
+
+    started = time.perf_counter()
+    for phase, (share, multiplier, mix, who) in enumerate(LOAD_PROFILES[name]):
+        deadline = time.perf_counter() + args.duration * share
+        threads = [threading.Thread(target=worker, args=(phase, index, deadline, mix, who))
+                   for index in range(max(1, round(args.concurrency * multiplier)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - started
+
+    by_kind = {}
+    for kind, status, seconds in samples:
+        by_kind.setdefault(kind, []).append((status, seconds))
+    result = {
+        'requests': len(samples),
+        'seconds': elapsed,
+        'throughput_rps': len(samples) / elapsed,
+        'errors': sum(status >= 500 for _, status, _ in samples),
+        'latency': latency_summary([seconds for _, _, seconds in samples]),
+        'by_kind': {},
+    }
+    for kind, rows in sorted(by_kind.items()):
+        result['by_kind'][kind] = dict(
+            requests=len(rows),
+            statuses=dict(Counter(str(status) for status, _ in rows)),
+            throughput_rps=len(rows) / elapsed,
+            **latency_summary([seconds for _, seconds in rows]),
+        )
+    return result
+
+
+def micro_benchmarks(args):
+    """Per-operation costs of the hot helpers, in microseconds."""
+    def per_op(fn, n):
+        return min(timed(lambda: [fn() for _ in range(n)]) for _ in range(5)) / n * 1e6
+
+    results = {}
+    random.seed(args.seed)
+    for banner_type in ('standard_character', 'limited_weapon_1'):
+        results[f'get_pull_result[{banner_type}]'] = per_op(lambda: app.get_pull_result(banner_type, 30, 30), 20000)
+
+    init_data = signed_init_data(987654321)
+    sessions = [signed_init_data(user_id) for user_id in range(app.TELEGRAM_CACHE_SIZE + 1)]
+    misses = iter(range(10 ** 9))
+    results['validate_telegram_data[hit]'] = per_op(lambda: app.validate_telegram_data(init_data), 20000)
+    results['validate_telegram_data[miss]'] = per_op(
+        lambda: app.validate_telegram_data(sessions[next(misses) % len(sessions)]), 20000)
+
+    # get_user_data_from_db's decoding of a row and save_user_data_to_db's encoding of it
+    with app.app.app_context():
+        db_conn = app.get_db()
+        app.read_user_data('load-micro')
+        row = db_conn.execute(app.USER_SELECT_SQL, ('load-micro',)).fetchone()
+    def decode(): # the decoding half of read_user_data
+        data = dict(row)
+        data.pop('inventory')
+        data.pop('monthly_exchanges')
+        data['pity_counters'] = json.loads(data['pity_counters'])
+        return data
+    user = decode()
+    results['user_row_decode'] = per_op(decode, 20000)
+    results['user_row_encode'] = per_op(lambda: json.dumps(user['pity_counters']), 20000)
+    return {name: {'us_per_op': us} for name, us in results.items()}
+
+
+def run_metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k != 'func'},
+    }
+
+
+def bench_load(args):
+    app.BOT_TOKEN = 'bench-token'
+    app.USER_CACHE = None if args.user_cache == 'off' else app.UserStateCache(args.user_cache)
+    profiles = list(LOAD_PROFILES) if args.profile == 'all' else args.profile.split(',')
+    report = {'meta': run_metadata(args), 'micro': micro_benchmarks(args), 'profiles': {}}
+    print(f"{'profile':<8} {'kind':<15} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}")
+    for name in profiles:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run_load_profile(name, args)
+        report['profiles'][name] = result
+        for kind, row in [('(all)', dict(result['latency'], requests=result['requests'], throughput_rps=result['throughput_rps']))] + list(result['by_kind'].items()):
+            print(f"{name:<8} {kind:<15} {row['requests']:>8} {row['throughput_rps']:>8.1f} "
+                  f"{row['p50_ms']:>8.2f} {row['p90_ms']:>8.2f} {row['p99_ms']:>8.2f}")
+    for name, row in report['micro'].items():
+        print(f"micro    {name:<40} {row['us_per_op']:>8.2f} us/op")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def bench_compare(args):
+    """Compare two bench.py load reports; exit non-zero on regressions above the threshold."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    print(f"baseline {baseline['meta'].get('commit')}  current {current['meta'].get('commit')}")
+    rows = []
+    for name, result in current['profiles'].items():
+        before = baseline['profiles'].get(name)
+        if before is None:
+            continue
+        rows.append((f'{name} throughput', before['throughput_rps'], result['throughput_rps'], True))
+        for kind, row in result['by_kind'].items():
+            if kind in before['by_kind']:
+                rows.append((f'{name}/{kind} p50', before['by_kind'][kind]['p50_ms'], row['p50_ms'], False))
+                rows.append((f'{name}/{kind} p99', before['by_kind'][kind]['p99_ms'], row['p99_ms'], False))
+    for name, row in current.get('micro', {}).items():
+        if name in baseline.get('micro', {}):
+            rows.append((f'micro {name}', baseline['micro'][name]['us_per_op'], row['us_per_op'], False))
+
+    regressions = 0
+    print(f"{'metric':<45} {'baseline':>10} {'current':>10} {'change':>8}")
+    for metric, before, after, higher_is_better in rows:
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = '  REGRESSION' if worse > args.threshold else ''
+        regressions += bool(flag)
+        print(f"{metric:<45} {before:>10.2f} {after:>10.2f} {change * 100:>7.1f}%{flag}")
+    if regressions:
+        raise SystemExit(f"{regressions} metric(s) regressed by more than {args.threshold:.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pulls = subparsers.add_parser('pulls', help='get_pull_result throughput, legacy vs compiled tables')
+    pulls.add_argument('--pulls', type=int, default=200000)
+    pulls.add_argument('--seed', type=int, default=1234)
+    pulls.set_defaults(func=bench_pulls)
+
+    batch = subparsers.add_parser('batch', help='batch_pull throughput and equivalence with the per-pull loop')
+    batch.add_argument('--sequences', type=int, default=2000)
+    batch.add_argument('--length', type=int, default=200, help='pulls per sequence')
+    batch.add_argument('--alpha', type=float, default=0.001)
+    batch.add_argument('--seed', type=int, default=1234)
+    batch.set_defaults(func=bench_batch)
+
+    inventory = subparsers.add_parser('inventory', help='pull latency vs inventory size, JSON blob vs inventory table')
+    inventory.add_argument('--sizes', default='0,1000,10000,50000')
+    inventory.add_argument('--repeat', type=int, default=20, help='10-pulls timed per size')
+    inventory.add_argument('--first-reads', type=int, default=20, help='players whose blob is read concurrently on first load')
+    inventory.add_argument('--readers', type=int, default=4, help='concurrent first reads per player')
+    inventory.set_defaults(func=bench_inventory)
+
+    concurrency = subparsers.add_parser('concurrency', help='concurrent pulls and purchases on one player, balances must add up')
+    concurrency.add_argument('--threads', type=int, default=8)
+    concurrency.add_argument('--requests', type=int, default=50, help='requests per thread')
+    concurrency.set_defaults(func=bench_concurrency)
+
+    bulk = subparsers.add_parser('bulk', help='bulk grant to every player under live pulls')
+    bulk.add_argument('--players', type=int, default=1000000)
+    bulk.add_argument('--threads', type=int, default=4, help='hot players pulling during the job')
+    bulk.add_argument('--chunk-size', type=int, default=2000)
+    bulk.add_argument('--baseline', type=float, default=3.0, help='seconds of pulls timed before the job')
+    bulk.set_defaults(func=bench_bulk)
+
+    sessions = subparsers.add_parser('sessions', help='login cost and session survival across restarts, per session backend')
+    sessions.add_argument('--accounts', type=int, default=20, help='accounts logged in (one password hash each)')
+    sessions.add_argument('--requests', type=int, default=2000, help='authenticated requests per backend')
+    sessions.set_defaults(func=bench_sessions)
+
+    wire = subparsers.add_parser('wire', help='JSON vs msgpack on the player API: bytes, encode/decode time, req/s')
+    wire.add_argument('--inventory', default='0,100,1000', help='inventory sizes of the /get_user_data payloads')
+    wire.add_argument('--calls', type=int, default=20000, help='encode/decode calls per small payload (fewer for larger ones)')
+    wire.add_argument('--requests', type=int, default=500, help='requests per format and payload through Flask')
+    wire.set_defaults(func=bench_wire)
+
+    shards = subparsers.add_parser('shards', help='pull throughput vs shard files, and resharding correctness')
+    shards.add_argument('--shards', default='1,2,4,8', help='shard counts to compare')
+    shards.add_argument('--workers', type=int, default=4, help='pulling processes')
+    shards.add_argument('--threads', type=int, default=4, help='threads per process')
+    shards.add_argument('--players', type=int, default=2000)
+    shards.add_argument('--duration', type=float, default=5.0, help='seconds per run')
+    shards.add_argument('--synchronous', default='NORMAL,FULL', help='SQLite synchronous settings to compare')
+    shards.add_argument('--reshard-players', type=int, default=1000)
+    shards.add_argument('--reshard-to', type=int, default=3)
+    shards.add_argument('--requests', type=int, default=3000, help='requests before each reshard')
+    shards.add_argument('--seed', type=int, default=1234)
+    shards.set_defaults(func=bench_shards)
+
+    streams = subparsers.add_parser('streams', help='per-player pull streams: draw cost, distribution, history replay')
+    streams.add_argument('--draws', type=int, default=1000000, help='pulls per banner for the distribution check')
+    streams.add_argument('--players', type=int, default=300)
+    streams.add_argument('--requests', type=int, default=20, help='pull requests per player')
+    streams.add_argument('--threads', type=int, default=4)
+    streams.add_argument('--seed', type=int, default=1234)
+    streams.set_defaults(func=bench_streams)
+
+    limits = subparsers.add_parser('limits', help='per-player rate limits and idempotency keys, per backend')
+    limits.add_argument('--backends', default='memory,shared')
+    limits.add_argument('--rate', type=float, default=2.0, help='pulls per second')
+    limits.add_argument('--burst', type=int, default=10)
+    limits.add_argument('--taps', type=int, default=200, help='back-to-back pulls by one player')
+    limits.add_argument('--keys', type=int, default=50, help='idempotency keys retried')
+    limits.add_argument('--threads', type=int, default=8, help='simultaneous copies of a request')
+    limits.set_defaults(func=bench_limits)
+
+    startup = subparsers.add_parser('startup', help='cold start: import, migrations and time to first response')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--servers', default='flask-threads,asgi')
+    startup.set_defaults(func=bench_startup)
+
+    telegram = subparsers.add_parser('telegram', help='initData validation cost, legacy vs cached')
+    telegram.add_argument('--calls', type=int, default=100000)
+    telegram.set_defaults(func=bench_telegram)
+
+    http = subparsers.add_parser('http', help='requests/sec for /get_user_data and /pull_gacha, per-request vs pooled connections')
+    http.add_argument('--threads', type=int, default=8)
+    http.add_argument('--requests', type=int, default=200, help='requests per thread')
+    http.set_defaults(func=bench_http)
+
+    serve = subparsers.add_parser('serve', help='real servers under many keep-alive connections, thread-per-request vs ASGI')
+    serve.add_argument('--servers', default=','.join(SERVERS))
+    serve.add_argument('--connections', default='16,256,1024', help='open client connections, comma separated')
+    serve.add_argument('--threads', type=int, default=app.DB_POOL_SIZE or 16, help='request threads / DB threads per server')
+    serve.add_argument('--players', type=int, default=256)
+    serve.add_argument('--pull-every', type=int, default=5, help='one single pull per this many requests')
+    serve.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    serve.set_defaults(func=bench_serve)
+
+    metrics = subparsers.add_parser('metrics', help='instrumentation overhead per request at several sample rates')
+    metrics.add_argument('--requests', type=int, default=500)
+    metrics.set_defaults(func=bench_metrics)
+
+    recovery = subparsers.add_parser('cache-recovery', help='kill a worker under load in each user cache mode, check what survived')
+    recovery.add_argument('--modes', default='sync,group,interval')
+    recovery.add_argument('--users', type=int, default=8, help='players, one pulling thread each')
+    recovery.add_argument('--duration', type=float, default=3.0, help='seconds of load before the kill')
+    recovery.set_defaults(func=bench_cache_recovery)
+
+    load = subparsers.add_parser('load', help='end-to-end traffic profiles plus micro-benchmarks, optionally saved as JSON')
+    load.add_argument('--profile', default='all', help=f"comma separated, or all: {', '.join(LOAD_PROFILES)}")
+    load.add_argument('--players', type=int, default=2000)
+    load.add_argument('--concurrency', type=int, default=8, help='client threads in a 1x phase')
+    load.add_argument('--duration', type=float, default=10.0, help='seconds per profile')
+    load.add_argument('--user-cache', default='off', choices=['off', 'sync', 'group', 'interval'])
+    load.add_argument('--seed', type=int, default=1234)
+    load.add_argument('--output', help='write the report to this JSON file')
+    load.set_defaults(func=bench_load)
+
+    compare = subparsers.add_parser('compare', help='diff two load reports, exit 1 on regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.15, help='relative change counted as a regression')
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    with contextlib.redirect_stdout(io.StringIO()): # default account messages
+        app.init_db() # the throwaway database, as `flask migrate-db` would before a deploy
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""gunicorn settings picked up from the working directory (gunicorn app:app).
+
+Schema migrations run once in the arbiter before any worker is forked; see Schema Migrations in
+app.py. Workers then start without touching the database.
+"""
+
+def on_starting(server):
+    import app
+    app.init_db()